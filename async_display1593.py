@@ -0,0 +1,638 @@
+"""asyncio version of Display1593.
+
+All serial I/O runs on the event loop through the ports' file descriptors
+(loop.add_reader/add_writer) so no thread has to poll the ports.
+Requires a POSIX platform where pyserial exposes fileno().
+"""
+import os
+import time
+import asyncio
+import logging
+from itertools import chain
+from functools import partial
+from collections import deque
+
+import numpy as np
+
+from serial_comm.serial_comm import (
+    FrameBuffer, FrameParser, PreparedCommand, MAX_PACKAGE_LEN, HELLO_TIMEOUT
+)
+from display1593 import (
+    Display1593, PendingCommand, ResponseError, is_debug_message,
+    SERIAL_PORTS, BAUD_RATE, NUMBER_OF_LEDS, MAX_IN_FLIGHT, MAX_RECOVERIES
+)
+from led_commands import COMMAND_GT
+from clock_sync import parse_clock_reply
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 4096
+
+
+class AsyncBoardConnection():
+    """Non-blocking serial connection to one board driven by the event loop.
+
+    send() frames the command and queues it without blocking. Commands
+    are written to the port as long as fewer than max_in_flight are
+    waiting to be acknowledged, and acks are matched in FIFO order as
+    they arrive.
+
+    Writes never block, so the write stage recorded in the metrics is the
+    time a command waits in the write buffer until the port accepts it.
+
+    When a command is not acknowledged within timeout (counted from when
+    it has been written), or its acknowledgement doesn't match, the
+    connection resynchronises and sends the unacknowledged commands
+    again, up to max_recoveries times before failing them with
+    TimeoutError (or the command with ResponseError). When the port fails
+    (e.g. the board is unplugged) it is reopened and the board restored,
+    like BoardConnection does, or the commands fail with ConnectionError.
+    """
+
+    def __init__(
+        self,
+        ser,
+        name,
+        max_in_flight=MAX_IN_FLIGHT,
+        timeout=1,
+        metrics=None,
+        board=0,
+        reopen=None,
+        restore=None,
+        max_recoveries=MAX_RECOVERIES
+    ):
+        self.ser = ser
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.metrics = metrics
+        self.board = board
+        self.reopen = reopen
+        self.restore = restore
+        self.max_recoveries = max_recoveries
+        self.n_recoveries = 0
+        self._attempts = 0  # Recoveries since the last acknowledgement
+        self._t_failure = None  # perf_counter() time of the first failure
+        # Command whose acknowledgement didn't match and the response, and
+        # the number of acks still to come for the commands sent after it
+        self._corrupted = None
+        self._stale_acks = 0
+        self.frame_buffer = FrameBuffer()
+        self.parser = FrameParser()
+        self.pending = deque()  # PendingCommand objects
+        # (PendingCommand, wire bytes, encode and build time) to be written
+        self._outbox = deque()
+        self._write_buf = bytearray()
+        self._unwritten = []  # (PendingCommand, wire length, times, t queued)
+        self._hello = None
+        self._idle = None
+        self._loop = asyncio.get_running_loop()
+        self._fd = ser.fileno()
+        os.set_blocking(self._fd, False)
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    @property
+    def port(self):
+        return self.ser.port
+
+    async def wait_for_hello(
+        self, hello_message=b'My name is ', timeout=HELLO_TIMEOUT
+    ):
+        """Wait for the board's hello message and set name from it."""
+        self._hello = (hello_message, self._loop.create_future())
+        try:
+            self.name = await asyncio.wait_for(self._hello[1], timeout)
+        finally:
+            self._hello = None
+        return self.name
+
+    def send(self, cmd, reply=False, build_time=0.0):
+        """Queue cmd for sending and return an asyncio Future that
+        completes when it is acknowledged (or with the board's reply if
+        reply is True)."""
+        future = self._loop.create_future()
+        t0 = time.perf_counter()
+        if isinstance(cmd, PreparedCommand):
+            data, wire, ack = cmd.data, cmd.wire, cmd.ack
+        else:
+            data = cmd
+            wire, ack = self.frame_buffer.build_ack(cmd)
+            wire = bytes(wire)
+        encode_time = time.perf_counter() - t0
+        entry = PendingCommand(data, None if reply else ack, future)
+        self._outbox.append((entry, wire, (build_time, encode_time)))
+        self._pump()
+        return future
+
+    async def drain(self):
+        """Wait until every queued command has been written to the port."""
+        while len(self._outbox) > 0 or len(self._write_buf) > 0:
+            self._idle = self._loop.create_future()
+            await self._idle
+
+    async def flush(self):
+        """Wait until every queued command has been acknowledged."""
+        await self.drain()
+        futures = [entry.future for entry in self.pending]
+        if futures:
+            await asyncio.gather(*futures, return_exceptions=True)
+
+    def set_max_in_flight(self, max_in_flight):
+        """Change how many commands can await acknowledgement at once."""
+        self.max_in_flight = max_in_flight
+        if len(self._outbox) > 0:
+            self._pump()
+
+    def _pump(self):
+        while len(self._outbox) > 0 and len(self.pending) < self.max_in_flight:
+            entry, wire, times = self._outbox.popleft()
+            self.pending.append(entry)
+            if self._corrupted is not None:
+                self._stale_acks += 1
+            self._write_buf += wire
+            self._unwritten.append(
+                (entry, len(wire), times, time.perf_counter())
+            )
+        self._on_writable()
+
+    def _on_writable(self):
+        if len(self._write_buf) > 0:
+            try:
+                n = os.write(self._fd, self._write_buf)
+            except BlockingIOError:
+                n = 0
+            except OSError as e:
+                self._port_failed(e)
+                return
+            del self._write_buf[:n]
+        if len(self._write_buf) > 0:
+            self._loop.add_writer(self._fd, self._on_writable)
+        else:
+            self._loop.remove_writer(self._fd)
+            self._written()
+            if len(self._outbox) == 0:
+                self._set_idle()
+
+    def _set_idle(self):
+        if self._idle is not None:
+            if not self._idle.done():
+                self._idle.set_result(None)
+            self._idle = None
+
+    def _written(self):
+        # Everything in the write buffer has been handed to the port, so
+        # the commands' timeouts start now
+        t = time.perf_counter()
+        for entry, n_bytes, times, t_queued in self._unwritten:
+            entry.t_sent = t
+            self._loop.call_later(
+                self.timeout, self._check_timeout, entry.future,
+                self.n_recoveries
+            )
+            if self.metrics is not None and times is not None:
+                build_time, encode_time = times
+                entry.seq = self.metrics.record_command(
+                    time.time(),
+                    self.board,
+                    entry.cmd,
+                    n_bytes,
+                    n_bytes - len(entry.cmd) - 2,
+                    build_time,
+                    encode_time,
+                    t - t_queued
+                )
+        self._unwritten.clear()
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._port_failed(e)
+            return
+        if len(data) == 0:
+            # End of file: the device is gone
+            self._port_failed(OSError(f'{self.port} closed'))
+            return
+        n_recoveries = self.n_recoveries
+        for response in self.parser.feed(data):
+            self._handle_response(response)
+            if self.n_recoveries != n_recoveries:
+                # The rest answer commands sent before the recovery
+                break
+        self._pump()
+
+    def _handle_response(self, response):
+        if is_debug_message(response, self.pending):
+            message = bytes(response[2:])
+            if self._hello is not None and message.startswith(self._hello[0]):
+                hello_message, future = self._hello
+                if not future.done():
+                    future.set_result(
+                        message.removeprefix(hello_message).decode(
+                            'utf', errors='replace'
+                        )
+                    )
+            else:
+                logger.info(f"Debug msg: {message.decode(errors='replace')}")
+            return
+        if len(self.pending) == 0:
+            logger.info(f"Unexpected response from {self.name}: {response}")
+            return
+        if self._stale_acks > 0:
+            # Answers a command sent after the corrupted one, which are all
+            # sent again once their acks are in
+            self._stale_acks -= 1
+            if self._stale_acks == 0:
+                self._resend_corrupted()
+            return
+        entry = self.pending[0]
+        expected_response, future = entry.expected_response, entry.future
+        if expected_response is not None and not np.array_equal(
+            response, expected_response
+        ):
+            self._bad_response(entry, response)
+            return
+        self.pending.popleft()
+        if (
+            self.metrics is not None and entry.seq is not None
+            and entry.t_sent is not None
+        ):
+            self.metrics.record_ack(
+                entry.seq, entry.cmd, time.perf_counter() - entry.t_sent
+            )
+        self._attempts = 0
+        if self._t_failure is not None:
+            if self.metrics is not None:
+                self.metrics.observe(
+                    'recovery', time.perf_counter() - self._t_failure
+                )
+            self._t_failure = None
+        if not future.done():
+            future.set_result(response)
+
+    def _bad_response(self, entry, response):
+        # The command or its acknowledgement was corrupted on the way:
+        # send the unacknowledged commands again, as after a timeout, once
+        # the acks of the commands already sent after it are in
+        logger.info(
+            f"Resp invalid, expected {entry.expected_response}, "
+            f"got {response}"
+        )
+        self._corrupted = entry, response
+        self._stale_acks = len(self.pending) - 1
+        if self._stale_acks == 0:
+            self._resend_corrupted()
+
+    def _resend_corrupted(self):
+        entry, response = self._corrupted
+        self._corrupted = None
+        if self._attempts < self.max_recoveries:
+            try:
+                self.recover()
+            except OSError as e:
+                self._port_failed(e)
+            return
+        self._attempts = 0
+        self._t_failure = None
+        if self.metrics is not None:
+            self.metrics.count('recoveries.failed')
+        if entry in self.pending:
+            self.pending.remove(entry)
+        if not entry.future.done():
+            entry.future.set_exception(ResponseError(
+                f"expected {entry.expected_response}, got {response}"
+            ))
+
+    def _check_timeout(self, future, n_recoveries):
+        if future.done() or n_recoveries != self.n_recoveries:
+            return  # Acknowledged, or sent again with a new timeout
+        logger.info(f'Timeout waiting for response from {self.name}')
+        if self._attempts < self.max_recoveries:
+            try:
+                self.recover()
+            except OSError as e:
+                self._port_failed(e)
+            return
+        self._attempts = 0
+        self._t_failure = None
+        if self.metrics is not None:
+            self.metrics.count('recoveries.failed')
+        # Drop everything up to and including the expired command
+        while len(self.pending) > 0:
+            expired = self.pending.popleft().future
+            if not expired.done():
+                expired.set_exception(
+                    TimeoutError(f"no response from {self.name}")
+                )
+            if expired is future:
+                break
+        self._pump()
+
+    def _port_failed(self, error):
+        """Reopen the port after an I/O error, failing the commands not
+        yet acknowledged if it can't be reopened."""
+        logger.info(f'I/O on {self.name} failed: {error}')
+        self._loop.remove_reader(self._fd)
+        self._loop.remove_writer(self._fd)
+        while self.reopen is not None and self._attempts < self.max_recoveries:
+            try:
+                self.recover(reopen=True)
+                return
+            except OSError as e:
+                logger.info(f'Recovery of {self.name} failed: {e}')
+        self._attempts = 0
+        self._t_failure = None
+        if self.metrics is not None:
+            self.metrics.count('recoveries.failed')
+        self._fail(ConnectionError(f"{self.name}: {error}"))
+
+    def _fail(self, error):
+        # Fail every command queued or waiting for an acknowledgement
+        for entry in chain(
+            self.pending, (entry for entry, _, _ in self._outbox)
+        ):
+            if not entry.future.done():
+                entry.future.set_exception(error)
+        self.pending.clear()
+        self._outbox.clear()
+        self._write_buf.clear()
+        self._unwritten.clear()
+        self._set_idle()
+
+    def recover(self, reopen=False):
+        """Discard the partial packet, unread input and unwritten output
+        and send the unacknowledged commands again.
+
+        If reopen is True the port is closed and reopened (with the reopen
+        function) and the restore commands are sent first, in case the
+        board was reset (see BoardConnection).
+        """
+        if self._t_failure is None:
+            self._t_failure = time.perf_counter()
+        self._attempts += 1
+        self.n_recoveries += 1
+        self._corrupted = None
+        self._stale_acks = 0
+        if self.metrics is not None:
+            self.metrics.count('recoveries')
+            self.metrics.count(f'recoveries.{self.name}')
+        logger.info(f'Recovering connection to {self.name} (reopen={reopen})')
+        self.parser.reset()
+        restore = []
+        if reopen:
+            self._loop.remove_reader(self._fd)
+            self._loop.remove_writer(self._fd)
+            try:
+                self.ser.close()
+            except OSError:
+                pass
+            self.ser = self.reopen()
+            self._fd = self.ser.fileno()
+            os.set_blocking(self._fd, False)
+            self._loop.add_reader(self._fd, self._on_readable)
+            if self.restore is not None:
+                restore = self.restore()
+        else:
+            self.ser.reset_input_buffer()
+        # Commands never fully written keep their metrics times
+        times = {
+            id(entry): (item_times, t_queued)
+            for entry, _, item_times, t_queued in self._unwritten
+        }
+        entries = [
+            PendingCommand(
+                cmd, self.frame_buffer.build_ack(cmd)[1],
+                self._loop.create_future()
+            )
+            for cmd in restore
+        ]
+        entries.extend(self.pending)
+        self.pending.clear()
+        self._write_buf.clear()
+        self._unwritten.clear()
+        for entry in entries:
+            wire, _ = self.frame_buffer.build_ack(entry.cmd)
+            item_times, t_queued = times.get(
+                id(entry), (None, time.perf_counter())
+            )
+            self.pending.append(entry)
+            self._write_buf += wire
+            self._unwritten.append((entry, len(wire), item_times, t_queued))
+        self._on_writable()
+
+    def close(self):
+        self._loop.remove_reader(self._fd)
+        self._loop.remove_writer(self._fd)
+        for entry in self.pending:
+            entry.future.cancel()
+        for entry, _, _ in self._outbox:
+            entry.future.cancel()
+        self.pending.clear()
+        self._outbox.clear()
+        self._unwritten.clear()
+        self.ser.close()
+
+
+class AsyncDisplay1593(Display1593):
+    """Display1593 with awaitable methods running on the event loop.
+
+    Each method returns once its commands have been written to the ports
+    (or are waiting in the in-flight window). Use flush() to wait for the
+    acknowledgements.
+    """
+
+    def __init__(
+        self,
+        ports=SERIAL_PORTS,
+        baud_rate=BAUD_RATE,
+        number_of_leds=NUMBER_OF_LEDS,
+        max_in_flight=MAX_IN_FLIGHT,
+        timeout=1,
+        metrics=None,
+        recorder=None,
+        port_map=None,
+        max_packet_len=MAX_PACKAGE_LEN
+    ):
+        # Ports are driven through their file descriptors, so they must be
+        # real (or pseudo) terminals opened by serial.Serial
+        super().__init__(
+            ports=ports,
+            baud_rate=baud_rate,
+            number_of_leds=number_of_leds,
+            max_in_flight=max_in_flight,
+            timeout=timeout,
+            metrics=metrics,
+            recorder=recorder,
+            port_map=port_map,
+            max_packet_len=max_packet_len
+        )
+
+    async def _connect_port(self, port):
+        conn = AsyncBoardConnection(
+            self._open_port(port),
+            port,
+            max_in_flight=self.max_in_flight,
+            timeout=self.timeout,
+            metrics=self.metrics
+        )
+        try:
+            await conn.wait_for_hello()
+        except asyncio.TimeoutError:
+            conn.close()
+            logger.debug('Connection to port %s failed.', port)
+            raise ConnectionError(f'{port}: Timeout')
+        logger.info(f'Connected to port {port}.')
+        logger.info(f"Hello from: {conn.name}")
+        return conn
+
+    async def connect(self):
+        opened = None
+        if self.port_map is not None:
+            opened = self._open_known_ports()
+        if opened is not None:
+            conns = [
+                AsyncBoardConnection(
+                    ser,
+                    name,
+                    max_in_flight=self.max_in_flight,
+                    timeout=self.timeout,
+                    metrics=self.metrics
+                )
+                for name, ser in opened.items()
+            ]
+        else:
+            results = await asyncio.gather(
+                *(self._connect_port(port) for port in self.ports),
+                return_exceptions=True
+            )
+            conns = [r for r in results if isinstance(r, AsyncBoardConnection)]
+            errors = [r for r in results if isinstance(r, BaseException)]
+        connections = {conn.name: conn for conn in conns}
+        try:
+            if opened is None and errors:
+                raise errors[0]
+            if len(connections) < len(conns):
+                raise ValueError(
+                    f"duplicate board names {[conn.name for conn in conns]}"
+                )
+            self._check_board_names(connections.keys())
+        except Exception:
+            for conn in conns:
+                conn.close()
+            raise
+        if opened is None and self.port_map is not None:
+            self.port_map.update({conn.port: conn.name for conn in conns})
+        self._connections = [connections[name] for name in self.board_names]
+        for board, conn in enumerate(self._connections):
+            conn.board = board
+            conn.reopen = partial(self._reopen_port, board)
+            conn.restore = partial(self._restore_commands, board)
+
+    async def _drain(self):
+        await asyncio.gather(*(conn.drain() for conn in self._connections))
+
+    async def flush(self):
+        """Wait until all commands sent have been acknowledged."""
+        await asyncio.gather(*(conn.flush() for conn in self._connections))
+
+    async def send_command(self, board, cmd, reply=False):
+        future = Display1593.send_command(self, board, cmd, reply)
+        await self._drain()
+        return future
+
+    async def request(self, board, cmd):
+        future = Display1593.send_command(self, board, cmd, reply=True)
+        return await asyncio.wait_for(future, self.timeout)
+
+    async def clear_all(self):
+        Display1593.clear_all(self)
+        await self._drain()
+
+    async def set_led(self, i, rgb):
+        Display1593.set_led(self, i, rgb)
+        await self._drain()
+
+    async def set_leds(self, leds, rgb_array):
+        Display1593.set_leds(self, leds, rgb_array)
+        await self._drain()
+
+    async def set_leds_one_colour(self, leds, rgb):
+        Display1593.set_leds_one_colour(self, leds, rgb)
+        await self._drain()
+
+    async def set_all_leds(self, rgb_array):
+        Display1593.set_all_leds(self, rgb_array)
+        await self._drain()
+
+    async def set_all_leds_one_colour(self, rgb):
+        Display1593.set_all_leds_one_colour(self, rgb)
+        await self._drain()
+
+    async def submit_frame(self, rgb_array, command_overhead=None):
+        Display1593.submit_frame(self, rgb_array, command_overhead)
+        await self._drain()
+
+    async def play(self, frames, fps=None, diff=False, show=True):
+        frames = self.open_frames(frames)
+        t0 = time.perf_counter()
+        for k in range(frames.shape[0]):
+            if fps is not None:
+                delay = t0 + k / fps - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if diff:
+                Display1593.submit_frame(self, frames[k])
+            else:
+                Display1593.set_all_leds(self, frames[k])
+            if show:
+                Display1593.show_now(self)
+            await self._drain()
+        return frames.shape[0]
+
+    async def show_now(self):
+        Display1593.show_now(self)
+        await self._drain()
+
+    async def sync_clocks(self, n_samples=8):
+        await self.flush()
+        for board in range(len(self._connections)):
+            for _ in range(n_samples):
+                t_send = time.time()
+                reply = await self.request(board, COMMAND_GT)
+                t_receive = time.time()
+                self.clock_sync.add_sample(
+                    board, t_send, parse_clock_reply(reply), t_receive
+                )
+
+    async def show_at(self, t):
+        Display1593.show_at(self, t)
+        await self._drain()
+
+    async def disconnect(self):
+        try:
+            await asyncio.wait_for(self.flush(), self.timeout)
+        except asyncio.TimeoutError:
+            logger.info('Unacknowledged commands at disconnect.')
+        errors = []
+        while len(self._connections) > 0:
+            conn = self._connections.pop()
+            try:
+                conn.close()
+            except Exception as e:
+                errors.append(e)
+                continue
+            logger.info(f'Closed connection to {conn.port}.')
+        for e in errors[1:]:
+            logger.info(f'Error at disconnect: {e}')
+        if errors:
+            raise errors[0]
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.disconnect()
+        return False
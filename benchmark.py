@@ -0,0 +1,278 @@
+"""Benchmarks of the serial codec, the Display1593 command builders and
+the end-to-end frame rate against an emulated, throttled link.
+
+Results are written as JSON so that runs can be compared between
+releases:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+"""
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from concurrent.futures import Future
+
+import numpy as np
+
+from serial_comm import serial_comm
+from serial_comm._jit import _numba
+from serial_comm.serial_comm import (
+    encode_data, decode_data, FrameBuffer, PreparedCommand
+)
+from display1593 import Display1593, NUMBER_OF_LEDS, BAUD_RATE, RED, BLUE
+from led_emulator import EmulatorPorts
+
+
+PAYLOAD_SIZES = [16, 256, 2396, 8192]
+ESCAPE_DENSITIES = [0.0, 0.1, 0.5]
+
+
+def time_call(func, min_time=0.2, repeat=3):
+    """Best time per call of func() over repeat runs of at least
+    min_time seconds each."""
+    func()  # Warm up (and JIT compile)
+    n = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(n):
+            func()
+        t = time.perf_counter() - t0
+        if t >= min_time / 10:
+            break
+        n *= 10
+    n = max(1, int(n * min_time / max(t, 1e-9)))
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(n):
+            func()
+        best = min(best, (time.perf_counter() - t0) / n)
+    return best
+
+
+def make_payload(size, escape_density, rng):
+    """Random payload where escape_density of the bytes need escaping."""
+    data = rng.integers(0, 253, size, dtype=np.uint8)
+    escaped = rng.random(size) < escape_density
+    data[escaped] = rng.integers(253, 256, np.count_nonzero(escaped))
+    return data
+
+
+def bench_codec(min_time):
+    rng = np.random.default_rng(0)
+    frame_buffer = FrameBuffer()
+    results = []
+    for size in PAYLOAD_SIZES:
+        for escape_density in ESCAPE_DENSITIES:
+            data = make_payload(size, escape_density, rng)
+            encoded = encode_data(data)
+            cases = [
+                ('encode_data', lambda: encode_data(data)),
+                ('decode_data', lambda: decode_data(encoded)),
+                ('frame_buffer.build', lambda: frame_buffer.build(data)),
+                ('frame_buffer.build_ack',
+                    lambda: frame_buffer.build_ack(data)),
+                ('PreparedCommand', lambda: PreparedCommand(data)),
+            ]
+            for name, func in cases:
+                t = time_call(func, min_time)
+                results.append({
+                    'benchmark': name,
+                    'size': size,
+                    'escape_density': escape_density,
+                    'seconds_per_call': t,
+                    'mb_per_s': size / t / 1e6,
+                })
+    return results
+
+
+class _NullConnection():
+    """Stands in for a BoardConnection and discards commands."""
+
+    def __init__(self):
+        self.n_bytes = 0
+        self._done = Future()
+        self._done.set_result(None)
+
+    def send(self, cmd, reply=False, build_time=0.0):
+        self.n_bytes += len(cmd)
+        return self._done
+
+    def flush(self):
+        pass
+
+
+def bench_commands(min_time):
+    """Cost of building the commands for each Display1593 method."""
+    dis = Display1593()
+    dis._connections = [_NullConnection() for _ in dis.board_names]
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (dis.n_leds, 3), dtype=np.uint8)
+    leds = rng.choice(dis.n_leds, 100, replace=False).astype('int32')
+    rgb_array = rng.integers(0, 256, (100, 3), dtype=np.uint8)
+    palette_rgb = np.array([RED, BLUE])[rng.integers(0, 2, 100)]
+
+    def submit_sparse():
+        # Change 5% of the LEDs from the previous frame
+        changed = rng.choice(dis.n_leds, dis.n_leds // 20, replace=False)
+        frame[changed] = rng.integers(0, 256, (changed.shape[0], 3))
+        dis.submit_frame(frame)
+
+    cases = [
+        ('clear_all', dis.clear_all),
+        ('show_now', dis.show_now),
+        ('set_led', lambda: dis.set_led(1000, RED)),
+        ('set_leds', lambda: dis.set_leds(leds, rgb_array)),
+        ('set_leds (2 colours)', lambda: dis.set_leds(leds, palette_rgb)),
+        ('set_leds_one_colour', lambda: dis.set_leds_one_colour(leds, RED)),
+        ('set_all_leds', lambda: dis.set_all_leds(frame)),
+        ('set_all_leds_one_colour',
+            lambda: dis.set_all_leds_one_colour(BLUE)),
+        ('submit_frame (5% changed)', submit_sparse),
+    ]
+    results = []
+    for name, func in cases:
+        results.append({
+            'benchmark': f'Display1593.{name}',
+            'seconds_per_call': time_call(func, min_time),
+        })
+    return results
+
+
+def bench_frame_rate(n_frames, baud_rate, latency, max_in_flight_values):
+    """Frames per second through Display1593 to emulated boards on a link
+    throttled to baud_rate / 10 bytes per second."""
+    rng = np.random.default_rng(0)
+    results = []
+    scenarios = ['set_all_leds', 'submit_frame (5% changed)']
+    for max_in_flight in max_in_flight_values:
+        for scenario in scenarios:
+            ports = EmulatorPorts.from_number_of_leds(
+                NUMBER_OF_LEDS, bytes_per_second='baud', latency=latency
+            )
+            with Display1593(
+                ports=ports.names,
+                baud_rate=baud_rate,
+                max_in_flight=max_in_flight,
+                serial_factory=ports
+            ) as dis:
+                frame = rng.integers(0, 256, (dis.n_leds, 3), dtype=np.uint8)
+                dis.set_all_leds(frame)
+                dis.flush()
+                t0 = time.perf_counter()
+                for _ in range(n_frames):
+                    if scenario == 'set_all_leds':
+                        dis.set_all_leds(frame)
+                    else:
+                        changed = rng.choice(
+                            dis.n_leds, dis.n_leds // 20, replace=False
+                        )
+                        frame[changed] = rng.integers(
+                            0, 256, (changed.shape[0], 3)
+                        )
+                        dis.submit_frame(frame)
+                    dis.show_now()
+                dis.flush()
+                t = time.perf_counter() - t0
+            results.append({
+                'benchmark': f'frame_rate {scenario}',
+                'baud_rate': baud_rate,
+                'latency': latency,
+                'max_in_flight': max_in_flight,
+                'n_frames': n_frames,
+                'frames_per_s': n_frames / t,
+            })
+    return results
+
+
+def metadata():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'numba': None if _numba() is None else _numba().__version__,
+        'kernels': 'aot' if serial_comm._aot is not None else (
+            'numba' if _numba() is not None else 'numpy'
+        ),
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+    }
+
+
+def _key(result):
+    return tuple(
+        (k, v) for k, v in sorted(result.items())
+        if k not in ('seconds_per_call', 'mb_per_s', 'frames_per_s')
+    )
+
+
+def compare(results, baseline):
+    """Print the change of each result relative to the baseline run."""
+    old = {_key(r): r for r in baseline['results']}
+    for r in results:
+        b = old.get(_key(r))
+        if b is None:
+            continue
+        if 'frames_per_s' in r:
+            ratio = r['frames_per_s'] / b['frames_per_s']
+        else:
+            ratio = b['seconds_per_call'] / r['seconds_per_call']
+        desc = ', '.join(
+            f'{k}={v}' for k, v in _key(r) if k != 'benchmark'
+        )
+        print(f"{ratio:6.2f}x  {r['benchmark']} {desc}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', help='JSON file to write results to')
+    parser.add_argument('--compare', help='JSON results to compare with')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum time per timing run (s)')
+    parser.add_argument('--frames', type=int, default=20,
+                        help='number of frames in frame rate tests')
+    parser.add_argument('--baud', type=int, default=BAUD_RATE,
+                        help='emulated link speed in frame rate tests')
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='emulated one-way link latency (s)')
+    parser.add_argument('--max-in-flight', type=int, nargs='+',
+                        default=[1, 4])
+    parser.add_argument('--skip', nargs='*', default=[],
+                        choices=['codec', 'commands', 'frame_rate'])
+    args = parser.parse_args(argv)
+
+    results = []
+    if 'codec' not in args.skip:
+        results += bench_codec(args.min_time)
+    if 'commands' not in args.skip:
+        results += bench_commands(args.min_time)
+    if 'frame_rate' not in args.skip:
+        results += bench_frame_rate(
+            args.frames, args.baud, args.latency, args.max_in_flight
+        )
+    output = {'metadata': metadata(), 'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,89 +1,271 @@
-import pandas as pd
+"""Timing statistics of the Display1593 method calls in a log file.
+
+The log is read in fixed-size chunks so that logs of any size are
+analyzed in constant memory. For every method logged with a
+'Method <name>.' (or 'Method <name> called.') line it reports the time
+between consecutive calls and, where a 'Method <name> done.' line
+follows, the duration of the call. The longest gaps between calls are
+printed with the log lines around them, which are read back in a second
+pass over the file.
+
+The method lines are logged at debug level, so set the level of the
+display1593 logger to DEBUG when recording a log to analyze.
+
+    python check_log_timing.py display1593.log --gap-method show_now
+"""
 import re
-from datetime import datetime
+import heapq
+import bisect
+import argparse
+
+import numpy as np
+
+from metrics import TimingStats
+
+
+CHUNK_SIZE = 16 * 2**20
+
+# Timestamp, method name and whether it is the end of the call
+LINE_PATTERN = re.compile(
+    rb'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d{3})\|[^|\n]*\|[^|\n]*\|'
+    rb'Method (\w+)( done)?[ .]',
+    re.MULTILINE
+)
+
+
+class MethodTiming():
+    """Timing of the calls of one method."""
+
+    def __init__(self):
+        self.interval = TimingStats()
+        self.duration = TimingStats()
+        self.last_start = None  # (time, line number) of the last call
+
+
+def _read_chunks(f, chunk_size):
+    """Yield chunks of whole lines from f."""
+    rest = b''
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        data = rest + data
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            rest = data
+            continue
+        yield data[:end]
+        rest = data[end:]
+    if rest:
+        yield rest
+
+
+def _top_gaps(gaps, method, times, lines, last_start, n_top):
+    """Push the gaps between calls at times (after last_start) onto the
+    gaps heap, keeping the n_top longest."""
+    if last_start is not None:
+        times = np.concatenate([[last_start[0]], times])
+        lines = np.concatenate([[last_start[1]], lines])
+    intervals = np.diff(times)
+    if n_top == 0 or intervals.shape[0] == 0:
+        return intervals
+    candidates = np.argsort(intervals)[-n_top:]
+    for i in candidates:
+        item = (
+            float(intervals[i]), method, int(lines[i]), int(lines[i + 1]),
+            times[i], times[i + 1]
+        )
+        if len(gaps) < n_top:
+            heapq.heappush(gaps, item)
+        elif item > gaps[0]:
+            heapq.heapreplace(gaps, item)
+    return intervals
+
+
+def _process_chunk(chunk, first_line, methods, gaps, gap_method, n_top):
+    matches = [
+        (m.start(), m.group(1), m.group(2), m.group(3) is not None)
+        for m in LINE_PATTERN.finditer(chunk)
+    ]
+    n_lines = chunk.count(b'\n')
+    if not matches:
+        return n_lines
+    starts, stamps, names, done = zip(*matches)
+    times = np.array(stamps).astype('datetime64[ms]').astype(np.int64) / 1000
+    newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 10)
+    line_numbers = first_line + np.searchsorted(newlines, starts)
+    names = np.array(names)
+    done = np.array(done)
+    for name in np.unique(names):
+        method = name.decode()
+        timing = methods.setdefault(method, MethodTiming())
+        in_method = names == name
+        call = in_method & ~done
+        call_times = times[call]
+        call_lines = line_numbers[call]
+        n_top_method = n_top if gap_method in (None, method) else 0
+        timing.interval.add(_top_gaps(
+            gaps, method, call_times, call_lines, timing.last_start,
+            n_top_method
+        ))
+
+        # Pair each 'done' line with the last call before it
+        end = in_method & done
+        previous = np.searchsorted(np.flatnonzero(call), np.flatnonzero(end))
+        start_times = np.concatenate([
+            [np.nan if timing.last_start is None else timing.last_start[0]],
+            call_times
+        ])
+        durations = times[end] - start_times[previous]
+        timing.duration.add(durations[~np.isnan(durations)])
+
+        if call_times.shape[0] > 0:
+            timing.last_start = (call_times[-1], call_lines[-1])
+    return n_lines
+
+
+def _context(log_file_path, gaps, n_context, chunk_size):
+    """Dict of line number to text of the lines around each gap, read back
+    from the log."""
+    wanted = sorted({
+        i
+        for gap in gaps
+        for line in gap[2:4]
+        for i in range(max(line - n_context, 0), line + n_context + 1)
+    })
+    context = {}
+    first_line = 0
+    with open(log_file_path, 'rb') as f:
+        for chunk in _read_chunks(f, chunk_size):
+            if len(context) == len(wanted):
+                break
+            n_lines = chunk.count(b'\n')
+            i = bisect.bisect_left(wanted, first_line)
+            j = bisect.bisect_left(wanted, first_line + n_lines + 1)
+            if j > i:
+                lines = chunk.split(b'\n')
+                for line in wanted[i:j]:
+                    if line - first_line < len(lines):
+                        context[line] = lines[line - first_line].decode(
+                            errors='replace'
+                        )
+            first_line += n_lines
+    return context
+
+
+def analyze_log_timing(
+    log_file_path,
+    gap_method='show_now',
+    n_top=5,
+    n_context=5,
+    chunk_size=CHUNK_SIZE,
+    verbose=True
+):
+    """Timing statistics of each Display1593 method in a log file.
 
-def analyze_log_timing(log_file_path):
-    """
-    Extract datetimes from log file and compute time differences between 
-    'Method show_now called.' entries.
-    
     Args:
-        log_file_path: Path to the log file
+        log_file_path: path to the log file.
+        gap_method: method whose longest gaps between calls are reported
+            (None for all methods).
+        n_top: number of longest gaps to report.
+        n_context: number of log lines to print before and after each
+            end of a gap.
+        chunk_size: number of bytes read at a time.
+        verbose: print the report.
+
+    Returns:
+        Dict with, for each method, summaries of the 'interval' between
+        calls and the 'duration' of calls, and the list of longest 'gaps'
+        as (gap, method, line before, line after, time before, time after)
+        tuples with 0-based line numbers, longest first.
     """
-    # Read the log file
-    with open(log_file_path, 'r') as f:
-        lines = f.readlines()
-    
-    # Pattern to match datetime and the specific log message
-    pattern = r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}\.\d{3})\|.*Method show_now called\.'
-    
-    # Extract datetimes and line numbers for "Method show_now called." entries
-    datetimes = []
-    line_numbers = []
-    for i, line in enumerate(lines):
-        match = re.match(pattern, line)
-        if match:
-            dt_str = match.group(1)
-            dt = datetime.strptime(dt_str, '%Y-%m-%d %H:%M:%S.%f')
-            datetimes.append(dt)
-            line_numbers.append(i)
-    
-    print(f"Found {len(datetimes)} 'Method show_now called.' entries\n")
-    
-    if len(datetimes) < 2:
-        print("Need at least 2 entries to compute time differences.")
-        return
-    
-    # Convert to pandas Series
-    dt_series = pd.Series(datetimes)
-    
-    # Compute time differences (in seconds)
-    time_diffs = dt_series.diff().dt.total_seconds()
-    
-    # Remove the first NaN value
-    time_diffs_clean = time_diffs.dropna()
-    
-    print("Time differences between consecutive 'Method show_now called.' entries:")
-    print(time_diffs_clean.describe())
-    
-    # Find the longest gap
-    max_gap_idx = time_diffs.idxmax()  # Index in original series (includes NaN at 0)
-    max_gap = time_diffs[max_gap_idx]
-    
-    print(f"\n{'='*80}")
-    print(f"LONGEST GAP: {max_gap:.3f} seconds")
-    print(f"Between entry #{max_gap_idx-1} and entry #{max_gap_idx}")
-    print(f"{'='*80}\n")
-    
-    # Get the line numbers for the entries before and after the gap
-    line_before = line_numbers[max_gap_idx - 1]
-    line_after = line_numbers[max_gap_idx]
-    
-    # Calculate range to show (5 lines before the first entry, 5 lines after the second)
-    start_line = max(0, line_before - 5)
-    end_line = min(len(lines), line_after + 6)  # +6 to include 5 lines after
-    
-    print(f"Context around the longest gap (lines {start_line+1} to {end_line}):")
-    print(f"Time before gap: {datetimes[max_gap_idx-1]}")
-    print(f"Time after gap:  {datetimes[max_gap_idx]}")
-    print(f"\n{'-'*80}")
-    
-    for i in range(start_line, end_line):
-        # Highlight the two entries that bracket the gap
-        if i == line_before:
-            print(f">>> LINE {i+1} (BEFORE GAP) <<<")
-        elif i == line_after:
-            print(f">>> LINE {i+1} (AFTER GAP) <<<")
-        
-        print(f"{i+1:5d}: {lines[i]}", end='')
-    
-    print(f"{'-'*80}\n")
-    
-    return time_diffs_clean
+    methods = {}
+    gaps = []
+    n_lines = 0
+    with open(log_file_path, 'rb') as f:
+        for chunk in _read_chunks(f, chunk_size):
+            n_lines += _process_chunk(
+                chunk, n_lines, methods, gaps, gap_method, n_top
+            )
+    gaps = sorted(gaps, reverse=True)
+    result = {
+        'methods': {
+            method: {
+                'interval': timing.interval.summary(),
+                'duration': timing.duration.summary(),
+            }
+            for method, timing in sorted(methods.items())
+        },
+        'gaps': gaps,
+    }
+    if verbose:
+        print_report(
+            result, _context(log_file_path, gaps, n_context, chunk_size),
+            n_context
+        )
+    return result
+
+
+def _format_stats(name, summary):
+    if summary['count'] == 0:
+        return f"  {name:<9}        0"
+    return (
+        f"  {name:<9}{summary['count']:9d}"
+        + ''.join(
+            f"{summary[k]:10.4f}"
+            for k in ('mean', 'std', 'min', 'p50', 'p90', 'p99', 'max')
+        )
+    )
+
+
+def print_report(result, context, n_context):
+    columns = ('mean', 'std', 'min', 'p50', 'p90', 'p99', 'max')
+    header = f"  {'':<9}{'count':>9}" + ''.join(f"{c:>10}" for c in columns)
+    print("Time (s) between calls ('interval') and of calls ('duration'):")
+    for method, stats in result['methods'].items():
+        print(f"\n{method}\n{header}")
+        print(_format_stats('interval', stats['interval']))
+        print(_format_stats('duration', stats['duration']))
+
+    for gap, method, line_before, line_after, t_before, t_after in (
+        result['gaps']
+    ):
+        print(f"\n{'=' * 80}")
+        print(f"GAP OF {gap:.3f} s between {method} calls on lines "
+              f"{line_before + 1} and {line_after + 1}")
+        print(f"{'=' * 80}")
+        shown = -1
+        for line in (line_before, line_after):
+            start = max(line - n_context, shown + 1)
+            if start > shown + 1 and shown >= 0:
+                print('  ...')
+            for i in range(start, line + n_context + 1):
+                text = context.get(i)
+                if text is None:
+                    continue
+                marker = '>>>' if i in (line_before, line_after) else '   '
+                print(f"{marker}{i + 1:7d}: {text}")
+                shown = i
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('log_file', help='log file to analyze')
+    parser.add_argument('--gap-method', default='show_now',
+                        help="method whose gaps are reported ('all' for "
+                             "every method)")
+    parser.add_argument('--top', type=int, default=5,
+                        help='number of longest gaps to report')
+    parser.add_argument('--context', type=int, default=5,
+                        help='log lines shown around each gap')
+    args = parser.parse_args(argv)
+    analyze_log_timing(
+        args.log_file,
+        gap_method=None if args.gap_method == 'all' else args.gap_method,
+        n_top=args.top,
+        n_context=args.context
+    )
+
 
 if __name__ == "__main__":
-    # Example usage with your log data
-    log_file = "sample_log.txt"  # Replace with your actual log file path
-    
-    # Analyze the log file
-    time_diffs = analyze_log_timing("sample_log.txt")
+    main()
@@ -0,0 +1,90 @@
+"""Estimation of the boards' clocks relative to the host clock.
+
+Used to schedule the SA (show at clock time) command so that all boards
+show an update at the same instant. The board clock is read with the GT
+command, which the board answers with [T1, T2, T3, T4], its millisecond
+clock as a 32-bit big-endian integer.
+"""
+from collections import deque
+
+import numpy as np
+
+
+CLOCK_WRAP = 2 ** 32  # Board clock is a 32-bit millisecond counter
+SA_WRAP = 2 ** 16  # SA only takes the low 16 bits of the board clock
+# Furthest ahead (ms) a show time can be: the board compares the SA time
+# with its clock modulo SA_WRAP, so later times look like past times
+SA_HORIZON = SA_WRAP // 2
+
+
+def parse_clock_reply(reply):
+    """Board clock in milliseconds from the reply to a GT command."""
+    return int.from_bytes(bytes(reply[:4]), 'big')
+
+
+class ClockSync():
+    """Estimates the offset and drift of each board's clock.
+
+    Each sample pairs a board clock reading with the midpoint of the host
+    times at which the GT command was sent and the reply received. Only
+    the samples with the shortest round trips are used in a least-squares
+    fit of board time against host time. Drift is only estimated once the
+    samples span at least min_drift_span seconds, before that the board
+    clock is assumed to run at the same rate as the host clock.
+    """
+
+    def __init__(self, n_boards, max_samples=64, min_drift_span=10.0):
+        self.samples = [deque(maxlen=max_samples) for _ in range(n_boards)]
+        self.min_drift_span = min_drift_span
+        self._fits = [None] * n_boards
+
+    def add_sample(self, board, t_send, board_ms, t_receive):
+        """Record a GT round trip.
+
+        Args:
+            board: board index.
+            t_send: host time (seconds) when GT was sent.
+            board_ms: board clock reading in the reply.
+            t_receive: host time (seconds) when the reply was received.
+        """
+        samples = self.samples[board]
+        if len(samples) > 0:
+            # Unwrap the 32-bit counter relative to the last reading
+            last_ms = samples[-1][1]
+            board_ms = last_ms + (board_ms - last_ms) % CLOCK_WRAP
+        samples.append(
+            ((t_send + t_receive) / 2, board_ms, t_receive - t_send)
+        )
+        self._fits[board] = None
+
+    def fit(self, board):
+        """Return (t0, board_ms0, rate) such that the board clock at host
+        time t is board_ms0 + rate * (t - t0) * 1000."""
+        if self._fits[board] is None:
+            if len(self.samples[board]) == 0:
+                raise ValueError(f"no clock samples for board {board}")
+            t, board_ms, rtt = np.array(self.samples[board]).T
+            best = np.argsort(rtt)[:max(1, (len(rtt) + 1) // 2)]
+            t, board_ms = t[best], board_ms[best]
+            t0 = t.mean()
+            if t.max() - t.min() >= self.min_drift_span:
+                rate, board_ms0 = np.polyfit((t - t0) * 1000, board_ms, 1)
+            else:
+                rate = 1.0
+                board_ms0 = np.mean(board_ms - (t - t0) * 1000)
+            self._fits[board] = (t0, board_ms0, rate)
+        return self._fits[board]
+
+    def drift(self, board):
+        """Fractional rate difference of the board clock (e.g. 1e-5 means
+        it gains 10 us per second)."""
+        return self.fit(board)[2] - 1
+
+    def round_trip_time(self, board):
+        """Shortest GT round trip time measured (seconds)."""
+        return min(rtt for _, _, rtt in self.samples[board])
+
+    def board_time(self, board, t):
+        """Predicted board clock (ms, unwrapped) at host time t."""
+        t0, board_ms0, rate = self.fit(board)
+        return board_ms0 + rate * (t - t0) * 1000
@@ -1,16 +1,31 @@
 import os
 import time
 import logging
+import queue
+import threading
 import serial
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import partial
 from itertools import cycle, chain, pairwise
 from collections import deque
 
 import numpy as np
-from numba import jit, types
 
 from serial_comm.serial_comm import (
-    connect_to_arduino, send_data_to_arduino, receive_data_from_arduino
+    connect_to_arduino, receive_packets, as_uint8_array, FrameBuffer,
+    FrameParser, PreparedCommand, CommandCache, MAX_PACKAGE_LEN
 )
+from led_commands import (
+    COMMAND_LC, COMMAND_SN, COMMAND_GT, make_idx_array, cmd_l1, cmd_cn,
+    cmd_la, cmd_ca, cmd_sa
+)
+from frame_planner import (
+    plan_board_update, plan_colour_groups, split_command
+)
+from clock_sync import ClockSync, parse_clock_reply, SA_WRAP, SA_HORIZON
+from metrics import MetricsRegistry
+from link_profiler import command_overhead
+from frame_scheduler import FrameScheduler
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -24,9 +39,6 @@ logging.basicConfig(
     format=LOG_FORMAT
 )
 
-COMMAND_LC = np.array(list(b'LC'), dtype=np.uint8)  # implemented
-COMMAND_SN = np.array(list(b'SN'), dtype=np.uint8)
-
 B2 = 32
 BLACK = np.zeros(3, dtype='uint8')
 WHITE = np.full_like(BLACK, B2)
@@ -39,6 +51,27 @@ CYAN = np.array([0, B2, B2], dtype='uint8')
 
 # Arduino communication
 BAUD_RATE = 57600
+READ_TIMEOUT = 0.1  # seconds, serial read timeout while waiting for acks
+
+# Number of commands sent to a board before waiting for an acknowledgement
+# (see benchmark.py --max-in-flight, 1 turns pipelining off)
+MAX_IN_FLIGHT = 4
+
+# Number of recovery attempts (resync, then reopen) after a board stops
+# responding or its port fails, before giving up
+MAX_RECOVERIES = 3
+
+# Number of commands that can be queued for a board's I/O threads
+SUBMIT_QUEUE_SIZE = 64
+
+# Maximum number of LA command buffers kept for reuse per board
+LA_POOL_SIZE = 64
+
+# Number of prepared short commands (LC, SN, CA, L1, ...) kept for reuse
+COMMAND_CACHE_SIZE = 1024
+
+# Codes of the commands that change the colours of a board's LEDs
+LED_COMMAND_CODES = frozenset((b'L1', b'LN', b'LA', b'CN', b'CA', b'LC'))
 
 # Serial ports of Teensy devices
 # Find these by running ls /dev/tty.* from command line
@@ -66,122 +99,526 @@ NUMBER_OF_LEDS = {
 }
 
 
-@jit(
-    [
-        types.uint8[:, :](types.int32[:]), 
-        types.uint8[:, :](types.int64[:])
-    ], 
-    nopython=True
-)
-def make_idx_array(leds):
-    idx = np.empty((leds.shape[0], 2), dtype=np.uint8)
-    for i in range(leds.shape[0]):
-        idx[i, 0] = leds[i] // 256 % 256
-        idx[i, 1] = leds[i] % 256
-    #idx = np.array([(i // 256 % 256, i % 256) for i in leds], dtype=np.uint8)
-    return idx
-
-
-@jit(nopython=True)
-def _board_leds(leds, led_idx):
-    """Filter led ids into separate lists for each board."""
-    n = len(leds)
-
-    # Pre-allocate with maximum possible size
-    board_leds_0 = np.empty(n, dtype=leds.dtype)
-    board_leds_1 = np.empty(n, dtype=leds.dtype)
-
-    # Fill arrays and track actual sizes
-    idx0 = 0
-    idx1 = 0
-    for i in range(n):
-        led = leds[i]
-        if led < led_idx[1]:
-            board_leds_0[idx0] = led - led_idx[0]
-            idx0 += 1
-        elif led < led_idx[2]:
-            board_leds_1[idx1] = led - led_idx[1]
-            idx1 += 1
+def is_debug_message(response, pending):
+    """Whether response is a debug message rather than the response to the
+    oldest of the pending commands.
+
+    Debug messages start with [0, 0]. So does the 4 byte reply to GT while
+    the board clock is below 65536 ms, so the two can only be told apart by
+    what is pending: a response starting with [0, 0] is taken as the GT
+    reply only if it is exactly 4 bytes long and the oldest pending command
+    is one that is replied to (GT). A 4 byte debug message arriving while
+    GT is pending is still mistaken for the reply. The GT reply format is
+    the one assumed by the host and the emulator (see led_commands.md).
+    """
+    if not np.array_equal(response[:2], [0, 0]):
+        return False
+    return (
+        len(pending) == 0
+        or pending[0].expected_response is not None
+        or len(response) != 4
+    )
+
+
+class ResponseError(Exception):
+    """Board acknowledged a command with an unexpected response."""
+
+
+class PendingCommand():
+    """Command sent to a board and waiting for its acknowledgement."""
+
+    __slots__ = ('cmd', 'expected_response', 'future', 't_sent', 'seq')
+
+    def __init__(self, cmd, expected_response, future):
+        self.cmd = cmd
+        self.expected_response = expected_response  # None if cmd is replied to
+        self.future = future
+        self.t_sent = None  # perf_counter() time the write finished
+        self.seq = None  # Metrics record of the command
+
+
+class BoardConnection():
+    """Serial connection to one board with a window of unacknowledged
+    commands.
+
+    Each command sent is recorded with its expected response and matched
+    in order (FIFO) against the responses coming back from the board.
+    send() only blocks when max_in_flight commands are already waiting to
+    be acknowledged and returns a Future that completes when the command
+    is acknowledged. The serial port should be opened with a read timeout
+    so that waiting for a response never blocks indefinitely.
+
+    If a MetricsRegistry is given, the time taken to encode and write each
+    command and to receive its acknowledgement is recorded in it.
+
+    When no response arrives within timeout, an acknowledgement doesn't
+    match its command or the port fails, the connection recovers (see
+    recover()) up to max_recoveries times before raising (failing the
+    command, for a mismatched acknowledgement). reopen is a function
+    returning a newly opened port for the board and restore a function
+    returning the commands that bring a board back to its last state
+    after its port was reopened. The time from detecting a failure to the
+    first acknowledgement after it is recorded in the 'recovery'
+    histogram of the metrics.
+    """
+
+    def __init__(
+        self,
+        ser,
+        name,
+        max_in_flight=MAX_IN_FLIGHT,
+        timeout=1,
+        metrics=None,
+        board=0,
+        reopen=None,
+        restore=None,
+        max_recoveries=MAX_RECOVERIES
+    ):
+        self.ser = ser
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.metrics = metrics
+        self.board = board
+        self.reopen = reopen
+        self.restore = restore
+        self.max_recoveries = max_recoveries
+        self.frame_buffer = FrameBuffer()
+        self.parser = FrameParser()
+        self.pending = deque()  # PendingCommand objects
+        self.n_recoveries = 0
+        self._attempts = 0  # Recoveries since the last acknowledgement
+        self._t_failure = None  # perf_counter() time of the first failure
+        # Command whose acknowledgement didn't match and the error, and the
+        # number of acks still to come for the commands sent after it
+        self._corrupted = None
+        self._stale_acks = 0
+
+    @property
+    def port(self):
+        return self.ser.port
+
+    def send(self, cmd, reply=False, build_time=0.0):
+        """Send cmd, waiting first if the in-flight window is full.
+
+        cmd is a uint8 array or a PreparedCommand, which is sent without
+        framing it again. If reply is True the board answers cmd with data
+        instead of an acknowledgement and the Future's result is that
+        data. build_time is the time it took to build cmd, for the
+        metrics.
+        """
+        if len(self.pending) > 0:
+            self.poll()
+        while len(self.pending) >= self.max_in_flight:
+            self.wait_for_response()
+        future = Future()
+        self._write(cmd, future, reply, build_time)
+        return future
+
+    def set_max_in_flight(self, max_in_flight):
+        """Change how many commands can await acknowledgement at once."""
+        self.max_in_flight = max_in_flight
+
+    def _pending_command(self, cmd, future, reply):
+        """Frame cmd and compute the response expected, in one pass.
+
+        Returns the PendingCommand, the packet (only valid until the next
+        command is framed) and the time taken.
+        """
+        t0 = time.perf_counter()
+        if isinstance(cmd, PreparedCommand):
+            data, frame, ack = cmd.data, cmd.wire, cmd.ack
         else:
-            raise ValueError("invalid led id")
+            data = cmd
+            frame, ack = self.frame_buffer.build_ack(cmd)
+        entry = PendingCommand(data, None if reply else ack, future)
+        return entry, frame, time.perf_counter() - t0
+
+    def _write(self, cmd, future, reply=False, build_time=0.0):
+        entry, frame, encode_time = self._pending_command(cmd, future, reply)
+        self._transmit(entry, frame, build_time, encode_time)
 
-    # Trim to actual sizes
-    board_leds_0 = board_leds_0[:idx0]
-    board_leds_1 = board_leds_1[:idx1]
-
-    return board_leds_0, board_leds_1
-
-
-@jit(nopython=True)
-def _board_leds_with_rgb(leds, rgb_array, led_idx):
-    """Filter led ids into separate lists for each board."""
-    n = len(leds)
-
-    # Pre-allocate with maximum possible size
-    board_leds_0 = np.empty(n, dtype=leds.dtype)
-    board_leds_1 = np.empty(n, dtype=leds.dtype)
-    rgb_arrays_0 = np.empty((n, 3), dtype=np.uint8)
-    rgb_arrays_1 = np.empty((n, 3), dtype=np.uint8)
-
-    # Fill arrays and track actual sizes
-    idx0 = 0
-    idx1 = 0
-    for i in range(n):
-        led = leds[i]
-        if led < led_idx[1]:
-            board_leds_0[idx0] = led - led_idx[0]
-            rgb_arrays_0[idx0] = rgb_array[i]
-            idx0 += 1
-        elif led < led_idx[2]:
-            board_leds_1[idx1] = led - led_idx[1]
-            rgb_arrays_1[idx1] = rgb_array[i]
-            idx1 += 1
+    def _transmit(self, entry, frame, build_time=0.0, encode_time=0.0):
+        # entry only becomes pending once it has been written, so that a
+        # recovery never sends it as well
+        t1 = time.perf_counter()
+        while True:
+            ser = self.ser
+            try:
+                ser.write(frame)
+                break
+            except OSError as e:
+                self._port_failed(ser, e)
+                # The recovery reused the frame buffer
+                frame, _ = self.frame_buffer.build_ack(entry.cmd)
+        self.pending.append(entry)
+        if self._corrupted is not None:
+            self._stale_acks += 1
+        entry.t_sent = t2 = time.perf_counter()
+        if self.metrics is not None:
+            entry.seq = self.metrics.record_command(
+                time.time(),
+                self.board,
+                entry.cmd,
+                len(frame),
+                len(frame) - len(entry.cmd) - 2,
+                build_time,
+                encode_time,
+                t2 - t1
+            )
+
+    def result(self, future):
+        """Wait for a Future returned by send() and return its result."""
+        while not future.done():
+            self.wait_for_response()
+        return future.result()
+
+    def poll(self):
+        """Process any responses already received without blocking."""
+        try:
+            responses = list(receive_packets(self.ser, self.parser))
+        except OSError as e:
+            self._port_failed(self.ser, e)
+            return
+        self._handle_responses(responses)
+
+    def _read(self):
+        # Blocks until at least one byte arrives or the read times out
+        try:
+            data = self.ser.read(max(1, self.ser.in_waiting))
+        except OSError as e:
+            self._port_failed(self.ser, e)
+            return
+        self._handle_responses(self.parser.feed(data))
+
+    def wait_for_response(self):
+        """Block until at least one response has been processed."""
+        n_pending = len(self.pending)
+        timeout_time = time.time() + self.timeout
+        while len(self.pending) == n_pending:
+            self._read()
+            if len(self.pending) == n_pending and time.time() > timeout_time:
+                logger.info(f'Timeout waiting for response from {self.name}')
+                self._recover(
+                    False, TimeoutError(f"no response from {self.name}")
+                )
+                timeout_time = time.time() + self.timeout
+
+    def recover(self, reopen=False):
+        """Resynchronise with the board and send the unacknowledged
+        commands again.
+
+        The partial packet in the parser and any unread input are
+        discarded. If reopen is True the port is closed and reopened and
+        the restore commands are sent first, in case the board was reset.
+        The commands set LEDs to absolute values, so sending them again
+        leaves the board in the same state.
+        """
+        if self._t_failure is None:
+            self._t_failure = time.perf_counter()
+        self.n_recoveries += 1
+        if self.metrics is not None:
+            self.metrics.count('recoveries')
+            self.metrics.count(f'recoveries.{self.name}')
+        logger.info(f'Recovering connection to {self.name} (reopen={reopen})')
+        self.parser.reset()
+        self._corrupted = None
+        self._stale_acks = 0
+        if reopen and self.reopen is not None:
+            try:
+                self.ser.close()
+            except OSError:
+                pass
+            self.ser = self.reopen()
+            restore = [] if self.restore is None else self.restore()
         else:
-            raise ValueError("invalid led id")
+            self.ser.reset_input_buffer()
+            restore = []
+        entries = [
+            PendingCommand(cmd, self.frame_buffer.build_ack(cmd)[1], Future())
+            for cmd in restore
+        ]
+        # Commands not written yet are sent by their writer
+        entries.extend(
+            entry for entry in self.pending if entry.t_sent is not None
+        )
+        for entry in entries:
+            frame, _ = self.frame_buffer.build_ack(entry.cmd)
+            self.ser.write(frame)
+            entry.t_sent = time.perf_counter()
+        # Only replaced once everything was written, so that a failed
+        # attempt leaves them pending for the next one
+        self.pending.clear()
+        self.pending.extend(entries)
 
-    # Trim to actual sizes
-    board_leds_0 = board_leds_0[:idx0]
-    board_leds_1 = board_leds_1[:idx1]
-    rgb_arrays_0 = rgb_arrays_0[:idx0]
-    rgb_arrays_1 = rgb_arrays_1[:idx1]
+    def _port_failed(self, ser, e):
+        logger.info(f'I/O on {self.name} failed: {e}')
+        self._recover(True, ConnectionError(f"{self.name}: {e}"))
 
-    return board_leds_0, board_leds_1, rgb_arrays_0, rgb_arrays_1
+    def _recover(self, reopen, error):
+        """recover(), reopening the port if resynchronising fails, and
+        raise error after max_recoveries attempts."""
+        while True:
+            if self._attempts >= self.max_recoveries:
+                self._attempts = 0
+                self._t_failure = None
+                if self.metrics is not None:
+                    self.metrics.count('recoveries.failed')
+                raise error
+            self._attempts += 1
+            try:
+                self.recover(reopen)
+                return
+            except OSError as e:
+                logger.info(f'Recovery of {self.name} failed: {e}')
+                reopen = True
 
+    def flush(self):
+        """Wait until all commands sent have been acknowledged."""
+        while len(self.pending) > 0:
+            self.wait_for_response()
 
-@jit(nopython=True)
-def calc_expected_response(cmd):
-    """
-    Calculate the expected response of the Arduino to the command. 
-
-    Args:
-        cmd: NumPy array of uint8 values
-        
-    Returns:
-        NumPy array of 6 uint8 values:
-        - Bytes 0-1: length of cmd (16-bit big-endian)
-        - Bytes 2-5: sum of cmd values (32-bit big-endian)
+    def _record_ack(self, entry):
+        if self.metrics is not None and entry.seq is not None:
+            self.metrics.record_ack(
+                entry.seq, entry.cmd, time.perf_counter() - entry.t_sent
+            )
+
+    def _handle_responses(self, responses):
+        n_recoveries = self.n_recoveries
+        for response in responses:
+            self._handle_response(response)
+            if self.n_recoveries != n_recoveries:
+                # The rest answer commands sent before the recovery
+                break
+
+    def _handle_response(self, response):
+        if is_debug_message(response, self.pending):
+            message = bytes(response[2:]).decode(errors='replace')
+            logger.info(f"Debug msg: {message}")
+            return
+        if len(self.pending) == 0:
+            logger.info(f"Unexpected response from {self.name}: {response}")
+            return
+        if self._stale_acks > 0:
+            # Answers a command sent after the corrupted one, which are all
+            # sent again once their acks are in
+            self._stale_acks -= 1
+            if self._stale_acks == 0:
+                self._resend_corrupted()
+            return
+        entry = self.pending[0]
+        expected_response = entry.expected_response
+        if expected_response is not None and not np.array_equal(
+            response, expected_response
+        ):
+            self._bad_response(entry, response)
+            return
+        self.pending.popleft()
+        self._record_ack(entry)
+        self._attempts = 0
+        if self._t_failure is not None:
+            # First acknowledgement since the failure
+            if self.metrics is not None:
+                self.metrics.observe(
+                    'recovery', time.perf_counter() - self._t_failure
+                )
+            self._t_failure = None
+        entry.future.set_result(response)
+
+    def _bad_response(self, entry, response):
+        # The command or its acknowledgement was corrupted on the way:
+        # send the unacknowledged commands again, as after a timeout, but
+        # only once the acks of the commands already sent after it are in
+        # so that they aren't taken for the acks of the commands sent again
+        logger.info(
+            f"Resp invalid, expected {entry.expected_response}, "
+            f"got {response}"
+        )
+        self._corrupted = entry, ResponseError(
+            f"expected {entry.expected_response}, got {response}"
+        )
+        self._stale_acks = sum(
+            1 for later in self.pending
+            if later is not entry and later.t_sent is not None
+        )
+        if self._stale_acks == 0:
+            self._resend_corrupted()
+
+    def _resend_corrupted(self):
+        entry, error = self._corrupted
+        self._corrupted = None
+        try:
+            self._recover(False, error)
+        except ResponseError:
+            # Give up on the command after max_recoveries attempts
+            if entry in self.pending:
+                self.pending.remove(entry)
+            entry.future.set_exception(error)
+
+    def close(self):
+        for entry in self.pending:
+            entry.future.cancel()
+        self.pending.clear()
+        self.ser.close()
+
+
+class ThreadedBoardConnection(BoardConnection):
+    """BoardConnection owned by a writer thread and a reader thread.
+
+    send() only puts the command on a bounded submit queue and returns its
+    Future, so the caller never blocks in ser.write or while waiting for
+    acknowledgements (unless the queue is full). The writer thread applies
+    the in-flight window and the reader thread matches responses.
     """
-    expected_response = np.empty(6, dtype=np.uint8)
 
-    # Get the length of cmd
-    cmd_length = len(cmd)
+    def __init__(
+        self,
+        ser,
+        name,
+        max_in_flight=MAX_IN_FLIGHT,
+        timeout=1,
+        metrics=None,
+        board=0,
+        reopen=None,
+        restore=None,
+        max_recoveries=MAX_RECOVERIES,
+        queue_size=SUBMIT_QUEUE_SIZE
+    ):
+        super().__init__(
+            ser, name, max_in_flight, timeout, metrics, board, reopen,
+            restore, max_recoveries
+        )
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._window = threading.Condition()
+        self._last_future = None
+        self._stopping = threading.Event()
+        self._writer = threading.Thread(
+            target=self._writer_loop, name=f'{name}-writer', daemon=True
+        )
+        self._reader = threading.Thread(
+            target=self._reader_loop, name=f'{name}-reader', daemon=True
+        )
+        self._writer.start()
+        self._reader.start()
+
+    def send(self, cmd, reply=False, build_time=0.0):
+        """Queue cmd for sending and return its Future."""
+        future = Future()
+        self._queue.put((cmd, future, reply, build_time))
+        self._last_future = future
+        return future
+
+    def set_max_in_flight(self, max_in_flight):
+        with self._window:
+            super().set_max_in_flight(max_in_flight)
+            self._window.notify_all()
+
+    def result(self, future):
+        return future.result(
+            timeout=self.timeout * (self._queue.qsize() + self.max_in_flight)
+        )
+
+    def _writer_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            cmd, future, reply, build_time = item
+            with self._window:
+                while len(self.pending) >= self.max_in_flight:
+                    if not self._window.wait(self.timeout):
+                        logger.info(
+                            f'Timeout waiting for response from {self.name}'
+                        )
+                        try:
+                            self._recover(False, TimeoutError(
+                                f"no response from {self.name}"
+                            ))
+                        except Exception as e:
+                            # Give up on the oldest command so we don't stall
+                            self.pending.popleft().future.set_exception(e)
+                entry, frame, encode_time = self._pending_command(
+                    cmd, future, reply
+                )
+                # Written under the lock, as a recovery by the reader
+                # thread reuses the frame buffer and writes to the port
+                try:
+                    self._transmit(entry, frame, build_time, encode_time)
+                except Exception as e:
+                    logger.info(f'Write to {self.name} failed: {e}')
+                    future.set_exception(e)
+
+    def _port_failed(self, ser, e):
+        with self._window:
+            if ser is self.ser:  # Not already reopened by the reader
+                super()._port_failed(ser, e)
+
+    def _reader_loop(self):
+        while not self._stopping.is_set():
+            ser = self.ser
+            try:
+                data = ser.read(max(1, ser.in_waiting))
+            except Exception as e:
+                if self._stopping.is_set():
+                    break
+                try:
+                    self._port_failed(ser, e)
+                except Exception as error:
+                    with self._window:
+                        for entry in self.pending:
+                            entry.future.set_exception(error)
+                        self.pending.clear()
+                        self._window.notify_all()
+                        break
+                continue
+            with self._window:
+                # Under the lock as recover() resets the parser
+                try:
+                    self._handle_responses(self.parser.feed(data))
+                except Exception as e:
+                    # A bad packet must not stop the reader thread
+                    logger.warning(f'Dropped a packet from {self.name}: {e}')
+                self._window.notify_all()
+
+    def poll(self):
+        # Responses are processed by the reader thread
+        pass
 
-    # Bytes 0-1: length as 16-bit big-endian (high byte first)
-    expected_response[0] = (cmd_length >> 8) & 0xFF  # High byte
-    expected_response[1] = cmd_length & 0xFF         # Low byte
+    def wait_for_response(self):
+        with self._window:
+            n_pending = len(self.pending)
+            if n_pending > 0:
+                self._window.wait_for(
+                    lambda: len(self.pending) < n_pending, self.timeout
+                )
 
-    # Calculate sum of all values in cmd
-    cmd_sum = np.uint32(0)
-    for i in range(len(cmd)):
-        cmd_sum += cmd[i]
+    def flush(self):
+        """Wait until all commands queued so far have been acknowledged."""
+        future = self._last_future
+        if future is None:
+            return
+        timeout = self.timeout * (self._queue.qsize() + self.max_in_flight)
+        done, _ = wait([future], timeout=timeout)
+        if not done:
+            logger.info(f'Timeout waiting for response from {self.name}')
+            raise TimeoutError(f"no response from {self.name}")
 
-    # Bytes 2-5: sum as 32-bit big-endian (high byte first)
-    expected_response[2] = (cmd_sum >> 24) & 0xFF  # Highest byte
-    expected_response[3] = (cmd_sum >> 16) & 0xFF
-    expected_response[4] = (cmd_sum >> 8) & 0xFF
-    expected_response[5] = cmd_sum & 0xFF          # Lowest byte
-    
-    return expected_response
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+        self._stopping.set()
+        self._reader.join()
+        with self._window:
+            super().close()
+
+
+def _per_board(value, board_names, default):
+    # Array with one value per board from a single value or a dict of
+    # board name to value
+    if not isinstance(value, dict):
+        return np.full(len(board_names), default if value is None else value)
+    return np.array([value.get(name, default) for name in board_names])
 
 
 class Display1593():
@@ -190,182 +627,566 @@ class Display1593():
         self,
         ports=SERIAL_PORTS,
         baud_rate=BAUD_RATE,
-        number_of_leds=NUMBER_OF_LEDS
+        number_of_leds=NUMBER_OF_LEDS,
+        max_in_flight=MAX_IN_FLIGHT,
+        timeout=1,
+        io_threads=False,
+        serial_factory=serial.Serial,
+        metrics=None,
+        recorder=None,
+        port_map=None,
+        max_packet_len=MAX_PACKAGE_LEN
     ):
         self.ports = ports
         self.baud_rate = baud_rate
+        self.serial_factory = serial_factory
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.io_threads = io_threads
         self.board_names = list(number_of_leds.keys())
         self.leds_per_board = np.fromiter(number_of_leds.values(), dtype='int32')
         self.led_idx = np.concatenate(
             [np.zeros(1, dtype='int32'), np.cumsum(self.leds_per_board)]
         )
         self.n_leds = self.led_idx[-1]
+        # Lookup tables from global LED id to board, LED id on the board
+        # and the high and low bytes of that id
+        self._led_board = np.repeat(
+            np.arange(len(self.board_names), dtype='int32'),
+            self.leds_per_board
+        )
+        self._led_local = (
+            np.arange(self.n_leds, dtype='int32')
+            - self.led_idx[self._led_board]
+        )
+        self._led_id_bytes = make_idx_array(self._led_local)
+        # Host-side copy of the colours last sent to each board
+        self._shadow = np.zeros((self.n_leds, 3), dtype=np.uint8)
+        self._shadow_valid = np.zeros(len(self.board_names), dtype=bool)
+        self.clock_sync = ClockSync(len(self.board_names))
+        # Per-command counters and timings, see metrics.py
+        self.metrics = MetricsRegistry() if metrics is None else metrics
+        self._t_build = time.perf_counter()
+        # FrameRecorder to record the commands sent, see frame_recorder.py
+        self.recorder = recorder
+        # PortMap of the boards' USB serial numbers, see port_map.py
+        self.port_map = port_map
+        # LA commands sent to each board, with their Futures, for reuse
+        # once acknowledged
+        self._la_pools = [deque() for _ in self.board_names]
+        # Framed short commands with their expected responses
+        self.command_cache = CommandCache(COMMAND_CACHE_SIZE)
+        # Packet buffer size of each board, which limits the length of the
+        # commands sent. It can be given as a single value or a dict of
+        # board name to value.
+        self.max_packet_len = _per_board(
+            max_packet_len, self.board_names, MAX_PACKAGE_LEN
+        ).astype(np.int64)
+        # Cost in bytes of each additional command to a board when
+        # planning updates, see apply_link_profile
+        self.command_overhead = np.zeros(len(self.board_names), dtype=np.int64)
         self._connections = []
 
-    def connect(self):
-        connections = {}
-        for port in self.ports:
-            ser = serial.Serial(port, baudrate=self.baud_rate)
-            status, message = connect_to_arduino(ser)
-            if status == 0:
-                logger.info(f'Connected to port {port}.')
-                worker_name = message
-            else:
-                logger.debug(f'Connection to port {port} failed.')
-                raise Exception(message)
-            logger.info(f"Hello from: {worker_name}")
-            connections[worker_name] = ser
+    def _open_port(self, port):
+        return self.serial_factory(
+            port, baudrate=self.baud_rate, timeout=READ_TIMEOUT
+        )
 
-        if set(connections.keys()) != set(self.board_names):
+    def _check_board_names(self, names):
+        if set(names) != set(self.board_names):
             raise ValueError(
                 f"board name mismatch, expected {self.board_names}, "
-                f"got {list(connections.keys())}"
+                f"got {list(names)}"
+            )
+
+    def _handshake(self, port):
+        # Open port and wait for the board's hello message
+        ser = self._open_port(port)
+        status, message = connect_to_arduino(ser)
+        if status != 0:
+            ser.close()
+            logger.debug('Connection to port %s failed.', port)
+            raise ConnectionError(f'{port}: {message}')
+        logger.info(f'Connected to port {port}.')
+        logger.info(f"Hello from: {message}")
+        return message, ser
+
+    def _open_known_ports(self):
+        # Open the boards found in the port map without handshakes
+        devices = self.port_map.find(self.board_names)
+        if len(devices) < len(self.board_names):
+            return None
+        opened = {}
+        try:
+            for name, device in devices.items():
+                opened[name] = self._open_port(device)
+        except (OSError, serial.SerialException) as e:
+            logger.info(f'Opening known ports {devices} failed: {e}')
+            for ser in opened.values():
+                ser.close()
+            return None
+        logger.info(f'Opened known ports {devices}.')
+        return opened
+
+    def _open_ports(self):
+        """Dict of board name to open serial port.
+
+        If a port map is set and knows the ports of all the boards, they
+        are opened directly. Otherwise all ports are handshaken
+        concurrently and the port map is updated.
+        """
+        if self.port_map is not None:
+            opened = self._open_known_ports()
+            if opened is not None:
+                return opened
+        with ThreadPoolExecutor(max_workers=len(self.ports)) as executor:
+            futures = [
+                executor.submit(self._handshake, port) for port in self.ports
+            ]
+        results, error = [], None
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                error = error or e
+        opened = dict(results)
+        try:
+            if error is not None:
+                raise error
+            if len(opened) < len(results):
+                raise ValueError(
+                    f"duplicate board names {[name for name, _ in results]}"
+                )
+            self._check_board_names(opened.keys())
+        except Exception:
+            for _, ser in results:
+                ser.close()
+            raise
+        if self.port_map is not None:
+            self.port_map.update(
+                {ser.port: name for name, ser in opened.items()}
             )
+        return opened
+
+    def connect(self):
+        connections = self._open_ports()
 
         # Store connections in same order as expected board names
+        connection_class = (
+            ThreadedBoardConnection if self.io_threads else BoardConnection
+        )
+        self.invalidate_shadow()
         self._connections = []
-        for name in self.board_names:        
-            self._connections.append(connections[name])
-
-    def check_response(self, ser, cmd, timeout_after=1):
-        expected_response = calc_expected_response(cmd)
-        waiting = True
-        timeout_time = time.time() + timeout_after
-        while waiting:
-            if ser.in_waiting > 0:
-                waiting = False
-                response = receive_data_from_arduino(ser)
-                if np.array_equal(response, expected_response):
-                    #logger.info("Resp rec'd")
-                    pass
-                elif np.array_equal(response[:2], [0, 0]):
-                    logger.info(f"Debug msg: {bytes(response[2:]).decode()}")
-                else:
-                    logger.info(
-                        f"Resp invalid, expected {expected_response}, got {response}"
-                    )
-            if time.time() > timeout_time:
-                logger.info(f'Timeout')
-                breakpoint()
-                break
+        for board, name in enumerate(self.board_names):
+            self._connections.append(
+                connection_class(
+                    connections[name],
+                    name,
+                    max_in_flight=self.max_in_flight,
+                    timeout=self.timeout,
+                    metrics=self.metrics,
+                    board=board,
+                    reopen=partial(self._reopen_port, board),
+                    restore=partial(self._restore_commands, board)
+                )
+            )
+
+    def _reopen_port(self, board):
+        # The port of a board that was plugged in again can change, look
+        # it up by USB serial number if there is a port map
+        name = self.board_names[board]
+        port = self._connections[board].port
+        if self.port_map is not None:
+            port = self.port_map.find([name]).get(name, port)
+        logger.info(f'Reopening port {port} of {name}.')
+        return self._open_port(port)
+
+    def _restore_commands(self, board):
+        # Commands setting every LED of a reopened board to its last colour
+        if not self._shadow_valid[board]:
+            return []
+        i, j = self.led_idx[board], self.led_idx[board + 1]
+        return split_command(cmd_la(self._shadow[i:j]), self.chunk_len(board))
+
+    def invalidate_shadow(self, board=None):
+        """Forget the colours last sent to board (to every board if board is
+        None), after its LEDs were changed other than through this class.
+        The next frame submitted to it is then sent in full."""
+        if board is None:
+            self._shadow_valid[:] = False
+        else:
+            self._shadow_valid[board] = False
+
+    def _split_by_board(self, leds):
+        """Group LED ids by board.
+
+        Returns a list of (board, positions) pairs, one for each board with
+        at least one LED in leds, where positions are the indices into leds
+        of the LEDs on that board in their original order.
+        """
+        if leds.shape[0] > 0 and (
+            leds.min() < 0 or leds.max() >= self.n_leds
+        ):
+            raise ValueError("invalid led id")
+        boards = self._led_board[leds]
+        order = np.argsort(boards, kind='stable')
+        bounds = np.searchsorted(
+            boards[order], np.arange(len(self.board_names) + 1)
+        )
+        return [
+            (board, order[i:j])
+            for board, (i, j) in enumerate(pairwise(bounds)) if j > i
+        ]
+
+    def apply_link_profile(self, links):
+        """Use the link profiles measured by link_profiler (a dict of
+        board name to profile, see link_profiler.load_profile) to size
+        commands and plan updates."""
+        for board, name in enumerate(self.board_names):
+            link = links.get(name)
+            if link is None:
+                continue
+            self.max_packet_len[board] = link.get(
+                'max_packet_len', self.max_packet_len[board]
+            )
+            self.command_overhead[board] = command_overhead(
+                link, self.max_in_flight
+            )
+
+    def set_max_in_flight(self, board, max_in_flight):
+        """Change the in-flight window of board, returning the previous
+        one. Commands already sent are not affected."""
+        conn = self._connections[board]
+        previous = conn.max_in_flight
+        conn.set_max_in_flight(max_in_flight)
+        return previous
+
+    def chunk_len(self, board):
+        """Length above which commands to board are split."""
+        return int(self.max_packet_len[board])
+
+    def _start(self, method):
+        # Commands built from here until the next _send() are timed as
+        # the build stage of that command
+        self.metrics.count(f'calls.{method}')
+        self._t_build = time.perf_counter()
+
+    def _send(self, board, cmd):
+        build_time = time.perf_counter() - self._t_build
+        if self.recorder is not None:
+            self.recorder.write(board, cmd)
+        future = self._connections[board].send(cmd, build_time=build_time)
+        self._t_build = time.perf_counter()
+        return future
+
+    def send_command(self, board, cmd, reply=False):
+        """Send a raw command to a board.
+
+        Returns a Future that completes when the board acknowledges it,
+        or with the data the board replies with if reply is True. cmd can
+        be a PreparedCommand to send it without framing it again. The
+        shadow copy of the board is invalidated if cmd changes its LEDs,
+        so the next frame submitted is sent in full.
+        """
+        if not isinstance(cmd, PreparedCommand):
+            cmd = as_uint8_array(cmd)
+        data = cmd.data if isinstance(cmd, PreparedCommand) else cmd
+        if bytes(data[:2]) in LED_COMMAND_CODES:
+            self.invalidate_shadow(board)
+        if self.recorder is not None:
+            self.recorder.write(board, cmd, reply)
+        return self._connections[board].send(cmd, reply)
+
+    def request(self, board, cmd):
+        """Send a command that the board answers with data and wait for
+        the reply."""
+        conn = self._connections[board]
+        return conn.result(self.send_command(board, cmd, reply=True))
+
+    def flush(self):
+        """Wait until all commands sent have been acknowledged."""
+        for conn in self._connections:
+            conn.flush()
+
+    def poll(self):
+        """Process the acknowledgements already received without
+        blocking."""
+        for conn in self._connections:
+            conn.poll()
 
     def clear_all(self):
-        logger.info(f'Method clear_all.')
-        cmd = COMMAND_LC
-        for ser in self._connections:
-            send_data_to_arduino(ser, cmd)
-        for ser in self._connections:
-            self.check_response(ser, cmd)
-        logger.info(f'Method clear_all done.')
+        self._start('clear_all')
+        logger.debug('Method clear_all.')
+        cmd = self.command_cache.get(COMMAND_LC)
+        for board in range(len(self._connections)):
+            self._send(board, cmd)
+        self._shadow[:] = 0
+        self._shadow_valid[:] = True
+        logger.debug('Method clear_all done.')
 
     def set_led(self, i, rgb):
-        logger.info(f'Method set_led.')
-        if i < self.led_idx[0]:
+        self._start('set_led')
+        logger.debug('Method set_led.')
+        if i < 0 or i >= self.n_leds:
             raise ValueError("invalid led id")
         assert len(rgb) == 3
-        if i < self.led_idx[1]:
-            led_id = i
-            ser = self._connections[0]
-        elif i < self.led_idx[2]:
-            led_id = i - self.led_idx[1]
-            ser = self._connections[1]
-        else:
-            raise ValueError("invalid led id")
+        board = int(self._led_board[i])
+        led_id = self._led_local[i]
         # Command L1 - implemented
-        cmd = np.array(
-            (76, 49, led_id // 256 % 256, led_id % 256, *rgb), dtype=np.uint8
-        )
-        send_data_to_arduino(ser, cmd)
-        self.check_response(ser, cmd)
-        logger.info(f'Method set_led done.')
+        cmd = self.command_cache.get(cmd_l1(led_id, rgb))
+        self._send(board, cmd)
+        self._shadow[i] = rgb
+        logger.debug('Method set_led done.')
+
+    def prepare_leds(self, leds, colours):
+        """Prepare the L1 commands setting each of leds to each of colours
+        so that set_led sends them without building them."""
+        for i in leds:
+            led_id = self._led_local[i]
+            for rgb in colours:
+                self.command_cache.get(cmd_l1(led_id, rgb))
 
     def set_leds(self, leds, rgb_array):
+        self._start('set_leds')
         assert rgb_array.shape[1] == 3
         leds = np.array(leds, dtype='int32')
-        logger.info(f'Method set_leds with {leds.shape[0]} leds.')
-        board_leds_0, board_leds_1, rgb_arrays_0, rgb_arrays_1 = _board_leds_with_rgb(
-            leds, rgb_array, self.led_idx
-        )
-        board_leds = [board_leds_0, board_leds_1]
-        rgb_arrays = [rgb_arrays_0, rgb_arrays_1]
-        cmds_sent = {}
-        for leds, rgb_array, ser in zip(board_leds, rgb_arrays, self._connections):
-            n = leds.shape[0]
-            if n == 0:
-                continue
-            idx = make_idx_array(leds)
-            # Command LN - implemented
-            cmd = np.concatenate(
-                [
-                    (76, 78, n // 256 % 256, n % 256),
-                    np.hstack((idx, rgb_array)).flatten()
-                ]
-            ).astype(np.uint8)
-            send_data_to_arduino(ser, cmd)
-            cmds_sent[ser] = cmd
-        for ser, cmd in cmds_sent.items():
-            self.check_response(ser, cmd)
+        logger.debug('Method set_leds with %s leds.', leds.shape[0])
+        for board, pos in self._split_by_board(leds):
+            board_leds = leds[pos]
+            # Commands CN and LN - implemented
+            cmds = plan_colour_groups(
+                self._led_local[board_leds],
+                rgb_array[pos],
+                command_overhead=self.command_overhead[board],
+                idx=self._led_id_bytes[board_leds],
+                max_len=self.chunk_len(board)
+            )
+            for cmd in cmds:
+                self._send(board, cmd)
+            self._shadow[board_leds] = rgb_array[pos]
 
     def set_leds_one_colour(self, leds, rgb):
+        self._start('set_leds_one_colour')
         assert len(rgb) == 3
         leds = np.array(leds, dtype='int32')
-        logger.info(f'Method set_leds_one_colour with {leds.shape[0]} leds.')
-        board_leds_0, board_leds_1 = _board_leds(leds, self.led_idx)
-        board_leds = [board_leds_0, board_leds_1]
-        cmds_sent = {}
-        for leds, ser in zip(board_leds, self._connections):
-            n = leds.shape[0]
-            if n == 0:
-                continue
-            idx = make_idx_array(leds)
+        logger.debug('Method set_leds_one_colour with %s leds.', leds.shape[0])
+        for board, pos in self._split_by_board(leds):
+            board_leds = leds[pos]
             # Command CN - implemented
-            cmd = np.concatenate(
-                [(67, 78, n // 256 % 256, n % 256, *rgb), idx.flatten()]
-            ).astype(np.uint8)
-            send_data_to_arduino(ser, cmd)
-            cmds_sent[ser] = cmd
-        for ser, cmd in cmds_sent.items():
-            self.check_response(ser, cmd)
+            cmd = cmd_cn(
+                self._led_local[board_leds],
+                rgb,
+                idx=self._led_id_bytes[board_leds]
+            )
+            for cmd in split_command(cmd, self.chunk_len(board)):
+                self._send(board, cmd)
+            self._shadow[board_leds] = rgb
+
+    def _send_la(self, board, rgb_array):
+        # Send LA reusing the buffer of an LA command already acknowledged
+        max_len = self.chunk_len(board)
+        if 2 + rgb_array.size > max_len:
+            for cmd in split_command(cmd_la(rgb_array), max_len):
+                self._send(board, cmd)
+            return
+        pool = self._la_pools[board]
+        if len(pool) > 0 and pool[0][1].done():
+            cmd = pool.popleft()[0]
+            np.copyto(cmd[2:].reshape(rgb_array.shape), rgb_array)
+        else:
+            cmd = cmd_la(rgb_array)
+            if len(pool) >= LA_POOL_SIZE:
+                pool.popleft()
+        pool.append((cmd, self._send(board, cmd)))
 
     def set_all_leds(self, rgb_array):
-        logger.info(f'Method set_all_leds.')
+        self._start('set_all_leds')
+        logger.debug('Method set_all_leds.')
         assert rgb_array.shape == (self.n_leds, 3)
-        cmds_sent = {}
-        for (i, j), ser in zip(pairwise(self.led_idx), self._connections):
+        for board, (i, j) in enumerate(pairwise(self.led_idx)):
             # Command LA - implemented
-            cmd = np.concatenate(
-                [(76, 65), rgb_array[i:j].flatten()]
-            ).astype(np.uint8)
-            send_data_to_arduino(ser, cmd)
-            cmds_sent[ser] = cmd
-        for ser, cmd in cmds_sent.items():
-            self.check_response(ser, cmd)
+            self._send_la(board, rgb_array[i:j])
+        self._shadow[:] = rgb_array
+        self._shadow_valid[:] = True
 
     def set_all_leds_one_colour(self, rgb):
-        logger.info(f'Method set_all_leds_one_colour.')
+        self._start('set_all_leds_one_colour')
+        logger.debug('Method set_all_leds_one_colour.')
         assert len(rgb) == 3
         # Command CA - implemented
-        cmd = np.array((67, 65, *rgb), dtype=np.uint8)
-        for ser in self._connections:
-            send_data_to_arduino(ser, cmd)
-        for ser in self._connections:
-            self.check_response(ser, cmd)
+        cmd = self.command_cache.get(cmd_ca(rgb))
+        for board in range(len(self._connections)):
+            self._send(board, cmd)
+        self._shadow[:] = rgb
+        self._shadow_valid[:] = True
+
+    def submit_frame(self, rgb_array, command_overhead=None):
+        """Update the boards to show rgb_array, sending only what changed.
+
+        The frame is compared with the host-side shadow copy of the
+        colours last sent and, for each board, the cheapest combination of
+        commands (by bytes on the wire) is sent. A board whose state is not
+        known (e.g. just after connecting) gets a full update. Call
+        show_now() to display the frame.
+
+        Args:
+            rgb_array: uint8 array of shape (n_leds, 3).
+            command_overhead: cost in bytes added per command when
+                comparing plans, by default the board's (see
+                apply_link_profile).
+        """
+        self._start('submit_frame')
+        assert rgb_array.shape == (self.n_leds, 3)
+        for board, (i, j) in enumerate(pairwise(self.led_idx)):
+            old = self._shadow[i:j] if self._shadow_valid[board] else None
+            cmds = plan_board_update(
+                rgb_array[i:j],
+                old,
+                command_overhead=(
+                    self.command_overhead[board] if command_overhead is None
+                    else command_overhead
+                ),
+                max_len=self.chunk_len(board)
+            )
+            for cmd in cmds:
+                self._send(board, cmd)
+            self._shadow[i:j] = rgb_array[i:j]
+            self._shadow_valid[board] = True
+
+    def open_frames(self, frames):
+        """Frame sequence of shape (T, n_leds, 3) from an array or a file.
+
+        frames can be an array (e.g. from np.load(path, mmap_mode='r')), a
+        .npy file or a raw file of uint8 RGB values, frame after frame.
+        Files are memory-mapped rather than read into memory.
+        """
+        if isinstance(frames, (str, os.PathLike)):
+            if os.fspath(frames).endswith('.npy'):
+                frames = np.load(frames, mmap_mode='r')
+            else:
+                frames = np.memmap(frames, dtype=np.uint8, mode='r')
+                if frames.shape[0] % (3 * self.n_leds) != 0:
+                    raise ValueError(
+                        f"file size is not a multiple of the frame size "
+                        f"({3 * self.n_leds} bytes)"
+                    )
+                frames = frames.reshape(-1, self.n_leds, 3)
+        if frames.dtype != np.uint8 or frames.shape[1:] != (self.n_leds, 3):
+            raise ValueError(
+                f"frames must be uint8 of shape (T, {self.n_leds}, 3), "
+                f"got {frames.dtype} {frames.shape}"
+            )
+        return frames
+
+    def play_frame(self, frame, diff=False, show=True):
+        """Send one frame with LA commands, or with the cheapest commands
+        for what changed if diff is True (see submit_frame), and show it
+        if show is True."""
+        if diff:
+            self.submit_frame(frame)
+        else:
+            self.set_all_leds(frame)
+        if show:
+            self.show_now()
+
+    def play(self, frames, fps=None, diff=False, show=True):
+        """Send a sequence of frames to the boards.
+
+        Each frame is sent straight from frames (see open_frames) with LA
+        commands, or with the cheapest commands for what changed since the
+        previous frame if diff is True, and shown if show is True.
+
+        Args:
+            frames: array or file of shape (T, n_leds, 3).
+            fps: frames per second, or None to send frames as fast as the
+                boards acknowledge them. Late frames are not dropped, use
+                a FrameScheduler for that.
+            diff: only send the changes between frames (see submit_frame).
+            show: show each frame with SN.
+
+        Returns:
+            Number of frames sent.
+        """
+        frames = self.open_frames(frames)
+        if fps is not None:
+            scheduler = FrameScheduler(
+                self, fps, policy='delay', diff=diff, show=show
+            )
+            return scheduler.run(frames)['n_sent']
+        for k in range(frames.shape[0]):
+            self.play_frame(frames[k], diff, show)
+        return frames.shape[0]
 
     def show_now(self):
-        logger.info(f'Method show_now.')
+        self._start('show_now')
+        logger.debug('Method show_now.')
         # Command SN - implemented
-        # TODO: In future this will be synchronized by comms between boards
-        cmd = COMMAND_SN
-        for ser in self._connections:
-            send_data_to_arduino(ser, cmd)
-        for ser in self._connections:
-            self.check_response(ser, cmd)
+        # Boards show one after the other, use show_at to synchronize them
+        cmd = self.command_cache.get(COMMAND_SN)
+        for board in range(len(self._connections)):
+            self._send(board, cmd)
+
+    def sync_clocks(self, n_samples=8):
+        """Measure the offset of each board's clock with GT round trips.
+
+        Call this before show_at and again from time to time so that the
+        drift of the board clocks can be estimated.
+        """
+        self._start('sync_clocks')
+        logger.debug('Method sync_clocks.')
+        self.flush()
+        for board in range(len(self._connections)):
+            for _ in range(n_samples):
+                t_send = time.time()
+                reply = self.request(board, COMMAND_GT)
+                t_receive = time.time()
+                self.clock_sync.add_sample(
+                    board, t_send, parse_clock_reply(reply), t_receive
+                )
+
+    def _show_at_commands(self, t):
+        if not 0 <= t - time.time() < SA_HORIZON / 1000:
+            raise ValueError(
+                f"show time must be in the next {SA_HORIZON / 1000:.3f}s"
+            )
+        return [
+            cmd_sa(int(round(self.clock_sync.board_time(board, t))) % SA_WRAP)
+            for board in range(len(self._connections))
+        ]
+
+    def show_at(self, t):
+        """Show LED updates on all boards at host time t (as returned by
+        time.time()), using the clock offsets measured by sync_clocks."""
+        self._start('show_at')
+        logger.debug('Method show_at.')
+        # Command SA
+        for board, cmd in enumerate(self._show_at_commands(t)):
+            self._send(board, cmd)
 
     def disconnect(self):
+        """Wait for the commands sent to be acknowledged and close the
+        connections to all boards. An error from one board is raised once
+        every connection is closed."""
+        errors = []
+        for conn in self._connections:
+            try:
+                conn.flush()
+            except TimeoutError:
+                logger.info(f'Unacknowledged commands to {conn.name}.')
+            except Exception as e:
+                errors.append(e)
         while len(self._connections) > 0:
-            ser = self._connections.pop()
-            ser.close()
-            logger.info(f'Closed connection to {ser.port}.')
+            conn = self._connections.pop()
+            try:
+                conn.close()
+            except Exception as e:
+                errors.append(e)
+                continue
+            logger.info(f'Closed connection to {conn.port}.')
+        for e in errors[1:]:
+            logger.info(f'Error at disconnect: {e}')
+        if errors:
+            raise errors[0]
 
     def __enter__(self):
         """Enter context manager method"""
@@ -0,0 +1,206 @@
+"""Planning of the cheapest set of commands to update a board.
+
+Costs are the number of bytes each command occupies on the wire,
+including the start and end markers and the escape bytes added by
+encode_data, plus an optional fixed overhead per command to account for
+the acknowledgement round trip.
+
+Commands longer than the board's packet buffer (max_len bytes) are split
+into several commands with the same effect, and the plans are compared
+after splitting.
+"""
+from itertools import pairwise
+
+import numpy as np
+
+from serial_comm.serial_comm import encoded_len, SPECIAL_BYTE, MAX_PACKAGE_LEN
+from led_commands import (
+    make_idx_array, cmd_l1, cmd_ln, cmd_cn, cmd_la, cmd_ca
+)
+
+
+def _split_rows(header, body, max_len):
+    # Commands made of header, with its count (bytes 2-3) updated, followed
+    # by consecutive slices of the rows of body, as equal in size as
+    # possible
+    n_header = len(header)
+    per_chunk = (max_len - n_header) // body.shape[1]
+    if per_chunk < 1:
+        raise ValueError(f"max_len {max_len} too small to split command")
+    n = body.shape[0]
+    n_chunks = -(-n // per_chunk)
+    bounds = np.arange(n_chunks + 1) * n // n_chunks
+    cmds = []
+    for i, j in pairwise(bounds):
+        cmd = np.empty(n_header + body.shape[1] * (j - i), dtype=np.uint8)
+        cmd[:n_header] = header
+        cmd[2:4] = ((j - i) // 256 % 256, (j - i) % 256)
+        cmd[n_header:] = body[i:j].reshape(-1)
+        cmds.append(cmd)
+    return cmds
+
+
+def split_command(cmd, max_len=MAX_PACKAGE_LEN):
+    """Split a command longer than max_len bytes into commands with the
+    same effect.
+
+    LN and CN commands are split into commands of nearly equal length. An
+    LA command shorter than the board has LEDs is not defined by the
+    protocol, so an LA command that is too long is sent as LN commands.
+
+    Returns:
+        List of commands (uint8 arrays), [cmd] if it isn't too long.
+    """
+    if len(cmd) <= max_len:
+        return [cmd]
+    code = bytes(cmd[:2])
+    if code == b'LN':
+        return _split_rows(cmd[:4], cmd[4:].reshape(-1, 5), max_len)
+    if code == b'CN':
+        return _split_rows(cmd[:7], cmd[7:].reshape(-1, 2), max_len)
+    if code == b'LA':
+        rgb_array = cmd[2:].reshape(-1, 3)
+        leds = np.arange(rgb_array.shape[0])
+        return split_command(cmd_ln(leds, rgb_array), max_len)
+    raise ValueError(
+        f"{code.decode(errors='replace')} command of {len(cmd)} bytes "
+        f"exceeds {max_len} bytes"
+    )
+
+
+def split_commands(cmds, max_len=MAX_PACKAGE_LEN):
+    """split_command applied to each of a list of commands."""
+    return [part for cmd in cmds for part in split_command(cmd, max_len)]
+
+
+def command_cost(cmd, command_overhead=0):
+    """Number of bytes cmd occupies on the wire plus command_overhead."""
+    return encoded_len(cmd) + 2 + command_overhead
+
+
+def commands_cost(cmds, command_overhead=0):
+    return sum(command_cost(cmd, command_overhead) for cmd in cmds)
+
+
+def changed_leds(new, old):
+    """Indices of the LEDs whose colour differs between new and old."""
+    return np.flatnonzero(np.any(new != old, axis=1))
+
+
+def _n_escapes(a, axis=-1):
+    return np.count_nonzero(a >= SPECIAL_BYTE, axis=axis)
+
+
+def unique_leds(leds, rgb_array, idx=None):
+    """Remove repeated LED ids, keeping the colour given last (which is
+    the one the board ends up with when an LN command is applied)."""
+    n = leds.shape[0]
+    _, last = np.unique(leds[::-1], return_index=True)
+    if last.shape[0] == n:
+        return leds, rgb_array, idx
+    keep = n - 1 - last
+    return leds[keep], rgb_array[keep], None if idx is None else idx[keep]
+
+
+def plan_colour_groups(
+    leds, rgb_array, command_overhead=0, idx=None, max_len=MAX_PACKAGE_LEN
+):
+    """Cheapest mix of CN and LN commands to set leds to rgb_array.
+
+    LEDs are grouped by colour. Groups for which a CN command (2 bytes per
+    LED plus a 7-byte header) costs less than their share of an LN command
+    (5 bytes per LED) are sent as CN commands and the remaining LEDs in a
+    single LN command.
+
+    Args:
+        leds: int array of LED ids on one board.
+        rgb_array: uint8 array of shape (N, 3) of colours.
+        command_overhead: fixed cost added for each command.
+        idx: optional array of shape (N, 2) of the high and low bytes of
+            the LED ids (see make_idx_array).
+        max_len: longest command to return.
+
+    Returns:
+        List of commands (uint8 arrays).
+    """
+    leds, rgb_array, idx = unique_leds(np.asarray(leds), rgb_array, idx)
+    if leds.shape[0] == 0:
+        return []
+    if idx is None:
+        idx = make_idx_array(leds.astype(np.int64))
+    rgb_array = np.asarray(rgb_array, dtype=np.uint8)
+    packed = (
+        rgb_array[:, 0].astype(np.uint32) << 16
+        | rgb_array[:, 1].astype(np.uint32) << 8
+        | rgb_array[:, 2]
+    )
+    _, first, inverse = np.unique(
+        packed, return_index=True, return_inverse=True
+    )
+    if first.shape[0] == 1:
+        return split_command(cmd_cn(leds, rgb_array[0], idx), max_len)
+
+    # Approximate wire bytes for each LED in a CN or an LN command
+    id_cost = 2 + _n_escapes(idx)
+    rgb_cost = 3 + _n_escapes(rgb_array)
+    group_cn = np.bincount(inverse, weights=id_cost)
+    group_ln = group_cn + np.bincount(inverse, weights=rgb_cost)
+    group_cn += 2 + 7 + _n_escapes(rgb_array[first]) + command_overhead
+    use_cn = group_cn < group_ln
+
+    candidates = [[cmd_ln(leds, rgb_array, idx)]]
+    if np.any(use_cn):
+        cmds = []
+        for g in np.flatnonzero(use_cn):
+            in_group = inverse == g
+            cmds.append(
+                cmd_cn(leds[in_group], rgb_array[first[g]], idx[in_group])
+            )
+        in_ln = ~use_cn[inverse]
+        if np.any(in_ln):
+            cmds.append(cmd_ln(leds[in_ln], rgb_array[in_ln], idx[in_ln]))
+        candidates.append(cmds)
+    candidates = [split_commands(cmds, max_len) for cmds in candidates]
+    costs = [commands_cost(cmds, command_overhead) for cmds in candidates]
+    return candidates[int(np.argmin(costs))]
+
+
+def plan_board_update(
+    new, old=None, command_overhead=0, max_l1=8, max_len=MAX_PACKAGE_LEN
+):
+    """Cheapest list of commands that changes a board from old to new.
+
+    Args:
+        new: uint8 array of shape (n, 3), the colours wanted on the board.
+        old: uint8 array of shape (n, 3), the colours the board is known to
+            have, or None if unknown (every LED is then treated as changed).
+        command_overhead: fixed cost added for each command.
+        max_l1: only consider individual L1 commands for up to this many
+            changed LEDs.
+        max_len: longest command to return.
+
+    Returns:
+        List of commands (uint8 arrays), empty if nothing changed.
+    """
+    if old is None:
+        leds = np.arange(new.shape[0])
+    else:
+        leds = changed_leds(new, old)
+    if leds.shape[0] == 0:
+        return []
+
+    candidates = [split_command(cmd_la(new), max_len)]
+    colours = new[leds]
+    if np.all(colours == colours[0]):
+        if leds.shape[0] == new.shape[0] or np.all(new == colours[0]):
+            candidates.append([cmd_ca(colours[0])])
+    candidates.append(
+        plan_colour_groups(leds, colours, command_overhead, max_len=max_len)
+    )
+    if leds.shape[0] <= max_l1:
+        candidates.append(
+            [cmd_l1(led, rgb) for led, rgb in zip(leds, colours)]
+        )
+
+    costs = [commands_cost(cmds, command_overhead) for cmds in candidates]
+    return candidates[int(np.argmin(costs))]
@@ -0,0 +1,221 @@
+"""Recording of the commands sent by Display1593 and replay of recordings.
+
+A FrameRecorder appends every command to a binary file together with the
+time it was sent and the board it was sent to. Pass one as the recorder of
+Display1593 (or set dis.recorder) to record a show. A Recording
+memory-maps the file so that commands are read without copying, and
+replays them to a display at their original pace or as fast as the links
+allow, e.g. to compare the throughput of two versions:
+
+    python frame_recorder.py show.rec --emulate --max-speed
+
+File layout: the 8 byte MAGIC, then one record per command made of a
+RECORD_HEADER (send time from time.time(), board, flags, command length)
+followed by the command bytes.
+"""
+import sys
+import time
+import struct
+import argparse
+
+import numpy as np
+
+from serial_comm.serial_comm import PreparedCommand
+
+
+MAGIC = b'D1593RC1'
+RECORD_HEADER = struct.Struct('<dHHI')  # time, board, flags, length
+FLAG_REPLY = 1
+
+
+class FrameRecorder():
+    """Append-only binary recorder of the commands sent to the boards.
+
+    Args:
+        path: file to append to (created if it doesn't exist).
+        buffering: size of the write buffer in bytes.
+    """
+
+    def __init__(self, path, buffering=2**20):
+        self.path = path
+        self.n_commands = 0
+        self._file = open(path, 'ab', buffering=buffering)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+
+    def write(self, board, cmd, reply=False, t=None):
+        """Record that cmd (uint8 array, bytes or PreparedCommand) was
+        sent to board at time t (default now)."""
+        if isinstance(cmd, PreparedCommand):
+            cmd = cmd.data
+        self._file.write(RECORD_HEADER.pack(
+            time.time() if t is None else t,
+            board,
+            FLAG_REPLY if reply else 0,
+            len(cmd)
+        ))
+        self._file.write(memoryview(cmd))
+        self.n_commands += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+class Recording():
+    """Memory-mapped recording made by a FrameRecorder.
+
+    The record index (times, boards, flags, offsets and lengths of the
+    commands) is built when the recording is opened; the command bytes
+    stay in the file until they are sent.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._data = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(self._data[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not a frame recording")
+        self._index()
+
+    def _index(self):
+        buf = memoryview(self._data)
+        size = len(buf)
+        offset = len(MAGIC)
+        times, boards, flags, offsets, lengths = [], [], [], [], []
+        unpack_from = RECORD_HEADER.unpack_from
+        header_size = RECORD_HEADER.size
+        while offset + header_size <= size:
+            t, board, flag, length = unpack_from(buf, offset)
+            offset += header_size
+            if offset + length > size:
+                break  # Truncated last record, e.g. recorder not closed
+            times.append(t)
+            boards.append(board)
+            flags.append(flag)
+            offsets.append(offset)
+            lengths.append(length)
+            offset += length
+        self.times = np.array(times, dtype=np.float64)
+        self.boards = np.array(boards, dtype=np.int32)
+        self.flags = np.array(flags, dtype=np.uint16)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.lengths = np.array(lengths, dtype=np.int64)
+
+    def __len__(self):
+        return self.times.shape[0]
+
+    def command(self, i):
+        """Command i as a read-only view of the file."""
+        offset = self.offsets[i]
+        return self._data[offset:offset + self.lengths[i]]
+
+    def __iter__(self):
+        """Iterate over (time, board, command) of each record."""
+        for i in range(len(self)):
+            yield self.times[i], int(self.boards[i]), self.command(i)
+
+    @property
+    def duration(self):
+        return self.times[-1] - self.times[0] if len(self) > 0 else 0.0
+
+    def replay(self, display, speed=1.0):
+        """Send the recorded commands to a connected display.
+
+        Args:
+            display: connected Display1593 with (at least) the boards in
+                the recording.
+            speed: replay speed relative to the recording, or None to send
+                the commands as fast as possible.
+
+        Returns:
+            Dict with the number of commands and bytes sent, the time it
+            took and the resulting rates.
+        """
+        t0 = time.perf_counter()
+        for i in range(len(self)):
+            if speed is not None:
+                delay = (
+                    t0 + (self.times[i] - self.times[0]) / speed
+                    - time.perf_counter()
+                )
+                if delay > 0:
+                    time.sleep(delay)
+            display.send_command(
+                int(self.boards[i]),
+                self.command(i),
+                reply=bool(self.flags[i] & FLAG_REPLY)
+            )
+        display.flush()
+        elapsed = time.perf_counter() - t0
+        n_bytes = int(np.sum(self.lengths))
+        return {
+            'n_commands': len(self),
+            'n_bytes': n_bytes,
+            'seconds': elapsed,
+            'commands_per_s': len(self) / elapsed if elapsed > 0 else np.inf,
+            'bytes_per_s': n_bytes / elapsed if elapsed > 0 else np.inf,
+        }
+
+    def close(self):
+        # The file is unmapped once no command views remain
+        self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+def main(argv=None):
+    from display1593 import (
+        Display1593, NUMBER_OF_LEDS, SERIAL_PORTS, MAX_IN_FLIGHT
+    )
+    from led_emulator import EmulatorPorts
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('recording', help='file recorded by FrameRecorder')
+    parser.add_argument('--ports', nargs='+', default=SERIAL_PORTS)
+    parser.add_argument('--emulate', action='store_true',
+                        help='replay to emulated boards at the baud rate')
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT)
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--speed', type=float, default=1.0,
+                       help='replay speed relative to the recording')
+    group.add_argument('--max-speed', action='store_true',
+                       help='send commands as fast as possible')
+    args = parser.parse_args(argv)
+
+    kwargs = {'max_in_flight': args.max_in_flight}
+    if args.emulate:
+        ports = EmulatorPorts.from_number_of_leds(
+            NUMBER_OF_LEDS, bytes_per_second='baud'
+        )
+        kwargs.update(ports=ports.names, serial_factory=ports)
+    else:
+        kwargs.update(ports=args.ports)
+    with Recording(args.recording) as recording, Display1593(**kwargs) as dis:
+        result = recording.replay(
+            dis, speed=None if args.max_speed else args.speed
+        )
+    print(
+        f"{result['n_commands']} commands ({result['n_bytes']} bytes) "
+        f"in {result['seconds']:.3f} s: "
+        f"{result['commands_per_s']:.1f} commands/s, "
+        f"{result['bytes_per_s'] / 1000:.1f} kB/s",
+        file=sys.stderr
+    )
+
+
+if __name__ == "__main__":
+    main()
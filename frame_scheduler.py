@@ -0,0 +1,156 @@
+"""Pacing of frames sent to a Display1593 at a target frame rate.
+
+Frame k is due at t0 + k / fps. The scheduler sleeps until each frame is
+due (spinning only for the last spin_time seconds), sends the frame and
+shows it. It never waits for the acknowledgements of a frame before
+sending the next one: the time until the next frame is due is used to
+process the acks that have arrived, and with max_in_flight > 1 (or
+io_threads) the next frame is sent while the current one is still being
+acknowledged.
+
+When sending falls behind, the 'drop' policy skips the frames whose
+successor is already due, so that the frames shown stay on the timeline.
+The last frame is always sent, so the display ends on it.
+With diff=True the changes in the skipped frames are merged into the
+next frame sent, which is compared with the frame last sent. The 'delay'
+policy sends every frame and moves the timeline back instead.
+"""
+import os
+import time
+
+import numpy as np
+
+from metrics import TimingStats
+
+
+# Time (s) before a frame is due from which to spin instead of sleeping
+SPIN_TIME = 0.0005
+
+POLICIES = ('drop', 'delay')
+
+
+def sleep_until(
+    t, spin_time=SPIN_TIME, timer=time.perf_counter, sleep=time.sleep
+):
+    """Sleep until timer() reaches t."""
+    remaining = t - timer()
+    if remaining > spin_time:
+        sleep(remaining - spin_time)
+    while timer() < t:
+        pass
+
+
+def _mark_last(iterable):
+    """Pairs of each item of iterable and whether it is the last one."""
+    iterator = iter(iterable)
+    try:
+        item = next(iterator)
+    except StopIteration:
+        return
+    for following in iterator:
+        yield item, False
+        item = following
+    yield item, True
+
+
+class FrameScheduler():
+    """Sends frames to a display at a target frame rate.
+
+    Args:
+        display: connected Display1593.
+        fps: target frames per second.
+        policy: what to do with late frames, 'drop' or 'delay'.
+        diff: send only the changes from the previous frame (see
+            Display1593.submit_frame) instead of LA commands.
+        show: show each frame with SN.
+        spin_time: time before a frame is due from which to spin.
+        timer: clock the frames are paced by, in seconds.
+        sleep: function sleeping for a number of seconds of timer.
+    """
+
+    def __init__(
+        self,
+        display,
+        fps,
+        policy='drop',
+        diff=False,
+        show=True,
+        spin_time=SPIN_TIME,
+        timer=time.perf_counter,
+        sleep=time.sleep
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"policy must be one of {POLICIES}")
+        self.display = display
+        self.fps = fps
+        self.policy = policy
+        self.diff = diff
+        self.show = show
+        self.spin_time = spin_time
+        self.timer = timer
+        self.sleep = sleep
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.n_sent = 0
+        self.n_dropped = 0
+        self.lateness = TimingStats()  # Time sent after being due
+        self._t_first = None
+        self._t_last = None
+
+    def _send(self, frame):
+        t = self.timer()
+        self.display.play_frame(frame, self.diff, self.show)
+        if self._t_first is None:
+            self._t_first = t
+        self._t_last = t
+        self.n_sent += 1
+        return t
+
+    def run(self, frames):
+        """Send frames, a sequence (array or file, see
+        Display1593.open_frames) or any iterable of (n_leds, 3) arrays.
+
+        Returns the statistics (see stats()).
+        """
+        if isinstance(frames, (np.ndarray, str, os.PathLike)):
+            frames = self.display.open_frames(frames)
+        period = 1 / self.fps
+        metrics = self.display.metrics
+        t0 = self.timer()
+        k = 0  # Index of the next frame on the timeline
+        for frame, last in _mark_last(frames):
+            due = t0 + k * period
+            now = self.timer()
+            if now >= due + period:
+                if self.policy == 'delay':
+                    t0 += now - due
+                    due = now
+                elif not last:
+                    # A later frame is due already
+                    k += 1
+                    self.n_dropped += 1
+                    metrics.count('frames.dropped')
+                    continue
+            self.display.poll()
+            sleep_until(due, self.spin_time, self.timer, self.sleep)
+            lateness = self._send(frame) - due
+            self.lateness.add(np.array([lateness]))
+            metrics.observe('frames.lateness', lateness)
+            k += 1
+        return self.stats()
+
+    def stats(self):
+        """Number of frames sent and dropped, achieved frames per second
+        and the jitter (standard deviation of the lateness of frames)."""
+        fps = np.nan
+        if self.n_sent > 1 and self._t_last > self._t_first:
+            fps = (self.n_sent - 1) / (self._t_last - self._t_first)
+        lateness = self.lateness.summary()
+        return {
+            'n_sent': self.n_sent,
+            'n_dropped': self.n_dropped,
+            'fps': fps,
+            'jitter': lateness.get('std', np.nan),
+            'lateness': lateness,
+        }
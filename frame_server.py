@@ -0,0 +1,483 @@
+"""Daemon owning the connections to the boards and serving local clients.
+
+Only one process can open the serial ports of the boards. A FrameServer
+keeps a connected Display1593 and accepts frames and commands from any
+number of clients over a Unix domain socket (or a loopback TCP port), so
+that animation generators, a web UI and sensors can drive the display at
+the same time without connecting to the boards themselves:
+
+    python frame_server.py --socket /tmp/display1593.sock
+
+    with FrameClient('/tmp/display1593.sock', priority=1) as client:
+        client.set_leds([0, 1, 2], colours)
+
+Each client draws on its own layer: FRAME sets every LED of the layer and
+LEDS some of them. Layers are stacked by priority (the priority of the
+last message from the client, the most recently updated layer on top
+among equal priorities) and the LEDs no layer sets are black. The server
+sends the stacked frame with Display1593.submit_frame and shows it at most
+fps times per second, so only the changes are sent and a client sending
+frames faster than that only has its latest frame shown. A client's layer
+is removed when it disconnects.
+
+Protocol: each message is a HEADER (message type, priority, board, payload
+length, little-endian) followed by the payload:
+
+    MSG_FRAME    n_leds x 3 colour bytes
+    MSG_LEDS     N uint16 LED ids, then N x 3 colour bytes
+    MSG_CLEAR    empty, unsets every LED of the client's layer
+    MSG_COMMAND  raw command to send to board (sent in order, not layered)
+    MSG_INFO     empty, answered with a MSG_INFO message whose payload is
+                 the JSON of the display's board names and LED counts
+"""
+import os
+import json
+import stat
+import time
+import socket
+import struct
+import logging
+import argparse
+import threading
+import socketserver
+from collections import deque
+
+import numpy as np
+
+from serial_comm.serial_comm import as_uint8_array
+from frame_scheduler import sleep_until
+
+logger = logging.getLogger(__name__)
+
+SOCKET_PATH = '/tmp/display1593.sock'
+
+# Most frames per second shown
+MAX_FPS = 60
+
+HEADER = struct.Struct('<BBHI')  # message type, priority, board, length
+MSG_FRAME = 1
+MSG_LEDS = 2
+MSG_CLEAR = 3
+MSG_COMMAND = 4
+MSG_INFO = 5
+
+# Longest payload accepted, to bound the memory a client can claim
+MAX_PAYLOAD_LEN = 2**24
+
+
+def _remove_stale_socket(path):
+    """Remove the socket file at path if it was left by a server that is no
+    longer running.
+
+    Raises:
+        FileExistsError: path is not a socket, or a server is listening on
+            it.
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"{path} exists and is not a socket")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)  # Left by a server that crashed
+            return
+    raise FileExistsError(f"a server is already listening on {path}")
+
+
+class ProtocolError(Exception):
+    """Client sent a malformed message."""
+
+
+def _recv_exact(sock, n):
+    """n bytes read from sock, or None if the connection closed first."""
+    buf = bytearray(n)
+    view = memoryview(buf)
+    received = 0
+    while received < n:
+        k = sock.recv_into(view[received:])
+        if k == 0:
+            return None
+        received += k
+    return buf
+
+
+def _send_message(sock, msg_type, payload=b'', priority=0, board=0):
+    payload = memoryview(payload).cast('B')
+    sock.sendall(HEADER.pack(msg_type, priority, board, payload.nbytes))
+    if payload.nbytes > 0:
+        sock.sendall(payload)
+
+
+def _recv_message(sock):
+    """(type, priority, board, payload) of the next message, or None if
+    the connection closed."""
+    header = _recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+    msg_type, priority, board, length = HEADER.unpack(header)
+    if length > MAX_PAYLOAD_LEN:
+        raise ProtocolError(f"payload of {length} bytes too long")
+    payload = _recv_exact(sock, length)
+    if payload is None:
+        return None
+    return msg_type, priority, board, payload
+
+
+class _Layer():
+    """Colours a client has set and which LEDs it has set."""
+
+    __slots__ = ('priority', 'frame', 'mask', 'updated')
+
+    def __init__(self, n_leds):
+        self.priority = 0
+        self.frame = np.zeros((n_leds, 3), dtype=np.uint8)
+        self.mask = np.zeros(n_leds, dtype=bool)
+        self.updated = 0  # Order of the last update among all layers
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        self.server.frame_server._serve_client(self.request)
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FrameServer():
+    """Serves a connected display to clients on a local socket.
+
+    Args:
+        display: connected Display1593, used only by the server's render
+            thread from start() until close().
+        address: path of a Unix domain socket, or (host, port) of a TCP
+            socket (use a loopback host).
+        fps: most frames per second shown.
+
+    The frames shown and the failures to send to the display are counted
+    in the 'server.frames' and 'server.send_failures' counters of the
+    display's metrics.
+    """
+
+    def __init__(self, display, address=SOCKET_PATH, fps=MAX_FPS):
+        self.display = display
+        self.address = address
+        self.fps = fps
+        self._layers = {}  # Client id: _Layer
+        self._commands = deque()  # (board, command) to send
+        self._n_updates = 0
+        self._dirty = True
+        self._stopping = False
+        self._changed = threading.Condition()
+        self._clients = set()
+        self._next_client = 0
+        self._server = None
+        self._threads = []
+
+    def start(self):
+        """Start accepting clients and showing their frames.
+
+        A socket file left at the address by a server that crashed is
+        removed. FileExistsError is raised if the address is taken.
+        """
+        if isinstance(self.address, (str, os.PathLike)):
+            _remove_stale_socket(self.address)
+            self._server = _UnixServer(self.address, _Handler)
+        else:
+            self._server = _TCPServer(self.address, _Handler)
+            self.address = self._server.server_address
+        self._server.frame_server = self
+        self._threads = [
+            threading.Thread(
+                target=self._server.serve_forever, name='frame-server',
+                daemon=True
+            ),
+            threading.Thread(
+                target=self._render_loop, name='frame-render', daemon=True
+            ),
+        ]
+        for thread in self._threads:
+            thread.start()
+        logger.info(f'Frame server listening on {self.address}.')
+
+    def serve_forever(self):
+        """start() and serve until interrupted."""
+        self.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        with self._changed:
+            self._stopping = True
+            for sock in list(self._clients):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self._changed.notify_all()
+        for thread in self._threads:
+            thread.join()
+        if isinstance(self.address, (str, os.PathLike)):
+            try:
+                os.unlink(self.address)
+            except FileNotFoundError:
+                pass
+        self._server = None
+        logger.info('Frame server closed.')
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+    def info(self):
+        return {
+            'board_names': self.display.board_names,
+            'leds_per_board': self.display.leds_per_board.tolist(),
+            'n_leds': int(self.display.n_leds),
+        }
+
+    def _serve_client(self, sock):
+        with self._changed:
+            client = self._next_client
+            self._next_client += 1
+            self._clients.add(sock)
+        logger.info(f'Client {client} connected.')
+        try:
+            while True:
+                message = _recv_message(sock)
+                if message is None:
+                    break
+                self._handle_message(client, sock, *message)
+        except (ProtocolError, OSError) as e:
+            logger.info(f'Dropping client {client}: {e}')
+        finally:
+            with self._changed:
+                self._clients.discard(sock)
+                if self._layers.pop(client, None) is not None:
+                    self._dirty = True
+                    self._changed.notify_all()
+            logger.info(f'Client {client} disconnected.')
+
+    def _handle_message(self, client, sock, msg_type, priority, board,
+                        payload):
+        n_leds = int(self.display.n_leds)
+        if msg_type == MSG_INFO:
+            _send_message(sock, MSG_INFO, json.dumps(self.info()).encode())
+            return
+        if msg_type == MSG_COMMAND:
+            if board >= len(self.display.board_names) or len(payload) < 2:
+                raise ProtocolError(f"invalid command for board {board}")
+            with self._changed:
+                self._commands.append(
+                    (board, np.frombuffer(payload, dtype=np.uint8))
+                )
+                self._changed.notify_all()
+            return
+        if msg_type == MSG_FRAME:
+            if len(payload) != 3 * n_leds:
+                raise ProtocolError(
+                    f"frame of {len(payload)} bytes, expected {3 * n_leds}"
+                )
+            leds = slice(None)
+            rgb = np.frombuffer(payload, dtype=np.uint8).reshape(-1, 3)
+        elif msg_type == MSG_LEDS:
+            if len(payload) % 5 != 0:
+                raise ProtocolError("LEDS payload is not 5 bytes per LED")
+            n = len(payload) // 5
+            leds = np.frombuffer(payload, dtype='<u2', count=n)
+            if n > 0 and leds.max() >= n_leds:
+                raise ProtocolError("invalid led id")
+            rgb = np.frombuffer(
+                payload, dtype=np.uint8, offset=2 * n
+            ).reshape(-1, 3)
+        elif msg_type != MSG_CLEAR:
+            raise ProtocolError(f"unknown message type {msg_type}")
+        with self._changed:
+            layer = self._layers.get(client)
+            if layer is None:
+                layer = self._layers[client] = _Layer(n_leds)
+            if msg_type == MSG_CLEAR:
+                layer.mask[:] = False
+            else:
+                layer.frame[leds] = rgb
+                layer.mask[leds] = True
+            layer.priority = priority
+            self._n_updates += 1
+            layer.updated = self._n_updates
+            self._dirty = True
+            self._changed.notify_all()
+
+    def compose(self):
+        """Frame made by stacking the layers of the clients."""
+        frame = np.zeros((self.display.n_leds, 3), dtype=np.uint8)
+        with self._changed:
+            for layer in sorted(
+                self._layers.values(), key=lambda l: (l.priority, l.updated)
+            ):
+                frame[layer.mask] = layer.frame[layer.mask]
+        return frame
+
+    def _render_loop(self):
+        display = self.display
+        period = 1 / self.fps
+        t_next = time.perf_counter()
+        while True:
+            with self._changed:
+                self._changed.wait_for(
+                    lambda: self._dirty or self._commands or self._stopping,
+                    timeout=period
+                )
+                if self._stopping:
+                    break
+                commands = list(self._commands)
+                self._commands.clear()
+                dirty = self._dirty
+                self._dirty = False
+            try:
+                for board, cmd in commands:
+                    display.send_command(board, cmd)
+                if dirty:
+                    display.submit_frame(self.compose())
+                    display.show_now()
+                    display.metrics.count('server.frames')
+                display.poll()
+            except Exception as e:
+                # Keep serving the other clients, the connections recover
+                # on their own
+                logger.warning(f'Sending to the display failed: {e}')
+                display.metrics.count('server.send_failures')
+            if dirty:
+                t_next = max(t_next + period, time.perf_counter())
+                sleep_until(t_next)
+
+
+class FrameClient():
+    """Client of a FrameServer.
+
+    Args:
+        address: address of the server (see FrameServer).
+        priority: priority of the client's layer, higher on top.
+    """
+
+    def __init__(self, address=SOCKET_PATH, priority=0):
+        self.priority = priority
+        if isinstance(address, (str, os.PathLike)):
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock.connect(address)
+
+    def info(self):
+        """Dict of the display's 'board_names', 'leds_per_board' and
+        'n_leds'."""
+        _send_message(self._sock, MSG_INFO)
+        message = _recv_message(self._sock)
+        if message is None or message[0] != MSG_INFO:
+            raise ConnectionError("no reply from the frame server")
+        return json.loads(bytes(message[3]))
+
+    def send_frame(self, rgb_array):
+        """Set every LED of the client's layer, rgb_array is uint8 of shape
+        (n_leds, 3)."""
+        _send_message(
+            self._sock, MSG_FRAME,
+            np.ascontiguousarray(rgb_array, dtype=np.uint8),
+            self.priority
+        )
+
+    def set_leds(self, leds, rgb_array):
+        """Set leds of the client's layer to the colours in rgb_array of
+        shape (N, 3)."""
+        payload = (
+            np.asarray(leds, dtype='<u2').tobytes()
+            + np.asarray(rgb_array, dtype=np.uint8).tobytes()
+        )
+        _send_message(self._sock, MSG_LEDS, payload, self.priority)
+
+    def clear(self):
+        """Unset every LED of the client's layer."""
+        _send_message(self._sock, MSG_CLEAR, priority=self.priority)
+
+    def send_command(self, board, cmd):
+        """Send a raw command (bytes or uint8 array) to a board."""
+        _send_message(
+            self._sock, MSG_COMMAND, as_uint8_array(cmd),
+            self.priority, board
+        )
+
+    def close(self):
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+
+def main(argv=None):
+    from display1593 import Display1593, NUMBER_OF_LEDS, SERIAL_PORTS
+    from led_emulator import EmulatorPorts
+    from link_profiler import LINK_PROFILE_FILE, load_profile
+    from port_map import PortMap
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--ports', nargs='+', default=SERIAL_PORTS)
+    parser.add_argument('--emulate', action='store_true',
+                        help='serve emulated boards')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--socket', default=SOCKET_PATH,
+                       help='path of the Unix domain socket')
+    group.add_argument('--tcp-port', type=int,
+                       help='serve on this loopback TCP port instead')
+    parser.add_argument('--fps', type=float, default=MAX_FPS)
+    parser.add_argument('--max-in-flight', type=int, default=4)
+    parser.add_argument('--link-profile', default=LINK_PROFILE_FILE,
+                        help='link profile to apply if it exists')
+    args = parser.parse_args(argv)
+
+    kwargs = {'max_in_flight': args.max_in_flight, 'io_threads': True}
+    if args.emulate:
+        ports = EmulatorPorts.from_number_of_leds(
+            NUMBER_OF_LEDS, bytes_per_second='baud'
+        )
+        kwargs.update(ports=ports.names, serial_factory=ports)
+    else:
+        kwargs.update(ports=args.ports, port_map=PortMap())
+    address = (
+        args.socket if args.tcp_port is None
+        else ('127.0.0.1', args.tcp_port)
+    )
+    with Display1593(**kwargs) as dis:
+        if os.path.exists(args.link_profile):
+            dis.apply_link_profile(load_profile(args.link_profile))
+        FrameServer(dis, address, fps=args.fps).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -58,18 +58,13 @@ def main():
 #         start_led = 700
 #         colors = [BLACK] + [RED, GREEN, BLUE] * 20
 #         rgb_array = np.stack(colors).astype('uint8')
-#         t_last = time.time()
+#         frames = np.zeros((200, 1593, 3), dtype='uint8')
 #         for iter in range(200):
 #             leds = [(start_led + i) % 1593 for i in range(len(colors))]
-#             dis.set_leds(leds, rgb_array)
-#             t_now = time.time()
-#             t_next = t_last + 0.05
-#             logger.info(f"Wait {t_next - t_now:.3f}s.")
-#             while t_now < t_next:
-#                 t_now = time.time()
-#             dis.show_now()
-#             t_last = t_now
+#             frames[iter, leds] = rgb_array
 #             start_led = (start_led + 1) % 1593
+#         stats = FrameScheduler(dis, fps=20, diff=True).run(frames)
+#         logger.info(f"{stats['fps']:.1f} fps, jitter {stats['jitter']:.4f}s.")
 
     logger.info(f'{filename} ended.')
 
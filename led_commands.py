@@ -0,0 +1,86 @@
+"""Builders for the LED display commands listed in led_commands.md.
+
+Each function returns the command as a uint8 array ready to be passed to
+send_data_to_arduino.
+"""
+import numpy as np
+
+from serial_comm._jit import jit
+
+
+COMMAND_LC = np.array(list(b'LC'), dtype=np.uint8)  # implemented
+COMMAND_SN = np.array(list(b'SN'), dtype=np.uint8)
+COMMAND_GT = np.array(list(b'GT'), dtype=np.uint8)
+
+
+def _make_idx_array_numpy(leds):
+    return np.stack([leds // 256 % 256, leds % 256], axis=1).astype(np.uint8)
+
+
+@jit(_make_idx_array_numpy)
+def make_idx_array(leds):
+    idx = np.empty((leds.shape[0], 2), dtype=np.uint8)
+    for i in range(leds.shape[0]):
+        idx[i, 0] = leds[i] // 256 % 256
+        idx[i, 1] = leds[i] % 256
+    #idx = np.array([(i // 256 % 256, i % 256) for i in leds], dtype=np.uint8)
+    return idx
+
+
+def cmd_l1(led_id, rgb):
+    """L1: set the colour of one LED."""
+    return np.array(
+        (76, 49, led_id // 256 % 256, led_id % 256, *rgb), dtype=np.uint8
+    )
+
+
+def cmd_ln(leds, rgb_array, idx=None):
+    """LN: set the colours of N LEDs.
+
+    Args:
+        leds: int32 or int64 array of LED ids on the board.
+        rgb_array: array of shape (N, 3) of colours.
+        idx: optional array of shape (N, 2) of the high and low bytes of
+            the LED ids, if already known (see make_idx_array).
+    """
+    if idx is None:
+        idx = make_idx_array(leds)
+    n = leds.shape[0]
+    cmd = np.empty(4 + 5 * n, dtype=np.uint8)
+    cmd[:4] = (76, 78, n // 256 % 256, n % 256)
+    body = cmd[4:].reshape(n, 5)
+    body[:, :2] = idx
+    body[:, 2:] = rgb_array
+    return cmd
+
+
+def cmd_cn(leds, rgb, idx=None):
+    """CN: set N LEDs to one colour."""
+    if idx is None:
+        idx = make_idx_array(leds)
+    n = leds.shape[0]
+    cmd = np.empty(7 + 2 * n, dtype=np.uint8)
+    cmd[:7] = (67, 78, n // 256 % 256, n % 256, *rgb)
+    cmd[7:].reshape(n, 2)[:] = idx
+    return cmd
+
+
+def cmd_la(rgb_array):
+    """LA: set all LED colours on the board."""
+    cmd = np.empty(2 + rgb_array.size, dtype=np.uint8)
+    cmd[:2] = (76, 65)
+    cmd[2:] = rgb_array.reshape(-1)
+    return cmd
+
+
+def cmd_ca(rgb):
+    """CA: set all LEDs on the board to one colour."""
+    return np.array((67, 65, *rgb), dtype=np.uint8)
+
+
+def cmd_sa(clock_ms):
+    """SA: show LED updates when the board clock reaches clock_ms (only
+    the low 16 bits are sent)."""
+    return np.array(
+        (83, 65, clock_ms // 256 % 256, clock_ms % 256), dtype=np.uint8
+    )
@@ -0,0 +1,426 @@
+"""Software emulator of the Teensy boards driving the LED display.
+
+An EmulatedBoard keeps an LED buffer and replies to the commands listed
+in led_commands.md the way the firmware does: the hello message when the
+connection is opened, a length+sum acknowledgement for each command and
+the clock time in reply to GT. It can be connected to in two ways:
+
+ - EmulatedSerial is an in-process stand-in for serial.Serial. Pass an
+   EmulatorPorts object as the serial_factory of Display1593.
+ - PtyEmulator runs the board behind a pseudo-terminal so that any
+   program can open it by path like a real port (POSIX only).
+
+Both can throttle the link to a given number of bytes per second in each
+direction and add a fixed latency.
+
+Example:
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    with Display1593(ports=ports.names, serial_factory=ports) as dis:
+        dis.set_all_leds_one_colour(RED)
+        dis.show_now()
+"""
+import os
+import time
+import select
+import threading
+from collections import deque
+
+import numpy as np
+
+from serial_comm.serial_comm import FrameParser, build_frame, START_MARKER
+
+
+HELLO_MESSAGE = b'My name is '
+
+
+def _ack(cmd):
+    """Length and sum of cmd as the board acknowledges it."""
+    return (
+        len(cmd).to_bytes(2, 'big')
+        + int(np.sum(cmd, dtype=np.uint32)).to_bytes(4, 'big')
+    )
+
+
+class EmulatedBoard():
+    """Emulated state and command processing of one board.
+
+    Args:
+        name: board name sent in the hello message.
+        n_leds: number of LEDs connected to the board.
+        clock_offset: offset of the board clock (ms).
+        clock_drift: fractional rate error of the board clock.
+        command_time: time (s) the board takes to process each command.
+    """
+
+    def __init__(
+        self, name, n_leds, clock_offset=0, clock_drift=0.0, command_time=0.0
+    ):
+        self.name = name
+        self.n_leds = n_leds
+        self.clock_offset = clock_offset
+        self.clock_drift = clock_drift
+        self.command_time = command_time
+        self.leds = np.zeros((n_leds, 3), dtype=np.uint8)
+        self.shown = np.zeros((n_leds, 3), dtype=np.uint8)
+        self.brightness = None
+        self.n_commands = 0
+        self.n_shows = 0
+        self.show_times = []
+        self._show_at = None
+        self._t_start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def hello(self):
+        return b'\x00\x00' + HELLO_MESSAGE + self.name.encode()
+
+    def clock(self):
+        """Board clock in milliseconds (32-bit)."""
+        elapsed = (time.monotonic() - self._t_start) * 1000
+        return int(
+            self.clock_offset + elapsed * (1 + self.clock_drift)
+        ) % 2 ** 32
+
+    def _show(self):
+        self.shown[:] = self.leds
+        self.n_shows += 1
+        self.show_times.append(time.time())
+
+    def update(self):
+        """Carry out a show scheduled by SA if its time has come."""
+        with self._lock:
+            if self._show_at is not None:
+                if (self._show_at - self.clock()) % 2 ** 16 > 2 ** 15:
+                    self._show_at = None
+                    self._show()
+
+    def _set(self, ids, rgb):
+        valid = ids < self.n_leds
+        self.leds[ids[valid]] = rgb[valid] if rgb.ndim == 2 else rgb
+
+    def handle(self, cmd):
+        """Process one command and return the list of reply payloads."""
+        if self.command_time > 0:
+            time.sleep(self.command_time)
+        self.update()
+        code = bytes(cmd[:2])
+        with self._lock:
+            self.n_commands += 1
+            if code == b'L1':
+                ids = cmd[2:3].astype(np.int64) * 256 + cmd[3]
+                self._set(ids, cmd[4:7])
+            elif code == b'LN':
+                n = int(cmd[2]) * 256 + int(cmd[3])
+                body = cmd[4:4 + 5 * n].reshape(-1, 5)
+                ids = body[:, 0].astype(np.int64) * 256 + body[:, 1]
+                self._set(ids, body[:, 2:])
+            elif code == b'LA':
+                rgb = cmd[2:2 + 3 * self.n_leds]
+                rgb = rgb[:rgb.shape[0] // 3 * 3].reshape(-1, 3)
+                self.leds[:rgb.shape[0]] = rgb
+            elif code == b'CN':
+                n = int(cmd[2]) * 256 + int(cmd[3])
+                idx = cmd[7:7 + 2 * n].reshape(-1, 2)
+                ids = idx[:, 0].astype(np.int64) * 256 + idx[:, 1]
+                self._set(ids, cmd[4:7])
+            elif code == b'CA':
+                self.leds[:] = cmd[2:5]
+            elif code == b'LC':
+                self.leds[:] = 0
+            elif code == b'LB':
+                self.brightness = int(cmd[2])
+            elif code == b'SN':
+                self._show()
+            elif code == b'SA':
+                self._show_at = int(cmd[2]) * 256 + int(cmd[3])
+            elif code == b'GT':
+                return [self.clock().to_bytes(4, 'big')]
+        return [_ack(cmd)]
+
+
+class _Link():
+    """One direction of a serial link with limited bandwidth and latency.
+
+    Data put on the link becomes available at the far end once it has
+    been transmitted at bytes_per_second (if given) and latency has
+    elapsed.
+    """
+
+    def __init__(self, bytes_per_second=None, latency=0.0):
+        self.bytes_per_second = bytes_per_second
+        self.latency = latency
+        self._items = deque()  # (time available, bytes)
+        self._free_time = 0.0
+
+    def put(self, data, now):
+        t = max(now, self._free_time)
+        if self.bytes_per_second:
+            t += len(data) / self.bytes_per_second
+        self._free_time = t
+        self._items.append((t + self.latency, bytes(data)))
+
+    def next_time(self):
+        return self._items[0][0] if self._items else None
+
+    def take(self, now):
+        """Return all data that has arrived by time now."""
+        out = bytearray()
+        while self._items and self._items[0][0] <= now:
+            out += self._items.popleft()[1]
+        return bytes(out)
+
+
+class EmulatedSerial():
+    """In-process stand-in for serial.Serial connected to an EmulatedBoard.
+
+    Implements the parts of the pyserial interface used by this package:
+    write, read, read_until, in_waiting, timeout, port and close. Like
+    pyserial, writing to or reading from a closed port raises an OSError,
+    so closing it emulates a board being unplugged.
+    """
+
+    def __init__(
+        self,
+        board,
+        port='emulator',
+        baudrate=57600,
+        timeout=None,
+        bytes_per_second=None,
+        latency=0.0,
+        **kwargs
+    ):
+        self.board = board
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.is_open = True
+        self._to_board = _Link(bytes_per_second, latency)
+        self._from_board = _Link(bytes_per_second, latency)
+        self._rx = bytearray()
+        self._parser = FrameParser()
+        self._cond = threading.Condition()
+        with self._cond:
+            self._from_board.put(build_frame(board.hello()), time.monotonic())
+        self._thread = threading.Thread(
+            target=self._board_loop, name=f'{port}-board', daemon=True
+        )
+        self._thread.start()
+
+    def _board_loop(self):
+        while True:
+            with self._cond:
+                while self.is_open:
+                    now = time.monotonic()
+                    t = self._to_board.next_time()
+                    if t is not None and t <= now:
+                        break
+                    timeout = 0.01 if t is None else min(t - now, 0.01)
+                    self._cond.wait(timeout)
+                    self.board.update()
+                if not self.is_open:
+                    return
+                data = self._to_board.take(time.monotonic())
+            for packet in self._parser.feed(data):
+                replies = self.board.handle(packet)
+                with self._cond:
+                    for reply in replies:
+                        self._from_board.put(
+                            build_frame(reply), time.monotonic()
+                        )
+                    self._cond.notify_all()
+
+    def _collect(self):
+        self._rx += self._from_board.take(time.monotonic())
+
+    def _wait(self, deadline):
+        # Wait until more data may have arrived or the deadline passes
+        t = self._from_board.next_time()
+        if deadline is not None:
+            t = deadline if t is None else min(t, deadline)
+        timeout = None if t is None else max(t - time.monotonic(), 0)
+        self._cond.wait(timeout)
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            self._collect()
+            return len(self._rx)
+
+    def _check_open(self):
+        if not self.is_open:
+            raise OSError(f'{self.port} is not open')
+
+    def write(self, data):
+        self._check_open()
+        with self._cond:
+            self._to_board.put(data, time.monotonic())
+            self._cond.notify_all()
+        return len(data)
+
+    def read(self, size=1):
+        self._check_open()
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                self._collect()
+                if len(self._rx) >= size or not self.is_open:
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                self._wait(deadline)
+            data = bytes(self._rx[:size])
+            del self._rx[:size]
+        return data
+
+    def read_until(self, expected=b'\n', size=None):
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                self._collect()
+                i = self._rx.find(expected)
+                if i != -1:
+                    n = i + len(expected)
+                    break
+                if size is not None and len(self._rx) >= size:
+                    n = size
+                    break
+                if not self.is_open or (
+                    deadline is not None and time.monotonic() >= deadline
+                ):
+                    n = len(self._rx)
+                    break
+                self._wait(deadline)
+            if size is not None:
+                n = min(n, size)
+            data = bytes(self._rx[:n])
+            del self._rx[:n]
+        return data
+
+    def reset_input_buffer(self):
+        with self._cond:
+            self._collect()
+            self._rx.clear()
+
+    def close(self):
+        with self._cond:
+            self.is_open = False
+            self._cond.notify_all()
+        self._thread.join()
+
+
+class EmulatorPorts():
+    """Serial factory opening EmulatedSerial connections to boards by name.
+
+    Args:
+        boards: dict of port name to EmulatedBoard.
+        bytes_per_second: link throughput in each direction (None for
+            unlimited, 'baud' to use baudrate / 10).
+        latency: one-way link latency (s).
+    """
+
+    def __init__(self, boards, bytes_per_second=None, latency=0.0):
+        self.boards = boards
+        self.bytes_per_second = bytes_per_second
+        self.latency = latency
+
+    @classmethod
+    def from_number_of_leds(cls, number_of_leds, **kwargs):
+        """Create one board per entry of a NUMBER_OF_LEDS style dict, on
+        ports named 'emulator0', 'emulator1', ..."""
+        boards = {
+            f'emulator{i}': EmulatedBoard(name, n_leds)
+            for i, (name, n_leds) in enumerate(number_of_leds.items())
+        }
+        return cls(boards, **kwargs)
+
+    @property
+    def names(self):
+        return list(self.boards.keys())
+
+    def __call__(self, port, baudrate=57600, timeout=None, **kwargs):
+        bytes_per_second = self.bytes_per_second
+        if bytes_per_second == 'baud':
+            bytes_per_second = baudrate / 10
+        return EmulatedSerial(
+            self.boards[port],
+            port=port,
+            baudrate=baudrate,
+            timeout=timeout,
+            bytes_per_second=bytes_per_second,
+            latency=self.latency
+        )
+
+
+class PtyEmulator():
+    """EmulatedBoard served on a pseudo-terminal.
+
+    Open the path in .port with serial.Serial (or pass it to Display1593)
+    like a real port. Opening a port flushes its input, so until the first
+    command arrives the board repeats its hello message every
+    hello_interval seconds.
+    """
+
+    def __init__(
+        self, board, bytes_per_second=None, latency=0.0, hello_interval=0.1
+    ):
+        import tty
+        self.board = board
+        self.bytes_per_second = bytes_per_second
+        self.latency = latency
+        self.hello_interval = hello_interval
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._parser = FrameParser()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(
+            target=self._board_loop, name=f'{board.name}-pty', daemon=True
+        )
+        self._thread.start()
+
+    def _delay(self, n_bytes):
+        t = self.latency
+        if self.bytes_per_second:
+            t += n_bytes / self.bytes_per_second
+        if t > 0:
+            time.sleep(t)
+
+    def _board_loop(self):
+        contacted = False
+        while not self._stopping.is_set():
+            ready, _, _ = select.select(
+                [self._master], [], [], self.hello_interval
+            )
+            self.board.update()
+            if not ready:
+                if not contacted:
+                    os.write(self._master, build_frame(self.board.hello()))
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                return
+            self._delay(len(data))
+            if START_MARKER in data:
+                contacted = True
+            for packet in self._parser.feed(data):
+                for reply in self.board.handle(packet):
+                    frame = build_frame(reply)
+                    self._delay(len(frame))
+                    os.write(self._master, frame)
+
+    def close(self):
+        self._stopping.set()
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
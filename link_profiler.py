@@ -0,0 +1,228 @@
+"""Measurement of the cost model of the link to each board.
+
+The profiler sends LN commands of a range of payload sizes and escape
+byte densities to each board of a connected Display1593, with a range of
+in-flight windows (pipelining depths), and times how long they take to be
+acknowledged. A model
+
+    time per command = latency + wire bytes / bytes_per_second
+
+is fitted by least squares to the unpipelined (depth 1) samples of each
+board. The result is saved as JSON, one entry per board name, so that it
+can be measured once per site and loaded at start-up:
+
+    python link_profiler.py --output ~/.display1593_links.json
+
+Display1593.apply_link_profile then uses it to weigh the cost of extra
+commands when planning frame updates (see command_overhead).
+
+The LN commands overwrite the LED buffers of the boards (without showing
+them), so the next frame submitted is sent in full.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+from serial_comm.serial_comm import encoded_len, SPECIAL_BYTE
+from led_commands import cmd_ln
+
+
+LINK_PROFILE_FILE = os.path.join(
+    os.path.expanduser('~'), '.display1593_links.json'
+)
+
+PAYLOAD_SIZES = (16, 64, 256, 1024, 4096, 8192)
+ESCAPE_DENSITIES = (0.0, 0.25)
+DEPTHS = (1, 2, 4)
+N_COMMANDS = 20
+
+
+def profile_command(size, escape_density, n_leds, rng):
+    """LN command of at most size bytes setting LEDs (cycling over the
+    n_leds of the board) to random colours, escape_density of the colour
+    bytes needing escaping."""
+    n = max((size - 4) // 5, 1)
+    leds = np.arange(n) % n_leds
+    rgb = rng.integers(0, SPECIAL_BYTE, (n, 3), dtype=np.uint8)
+    escaped = rng.random((n, 3)) < escape_density
+    rgb[escaped] = rng.integers(
+        SPECIAL_BYTE, 256, np.count_nonzero(escaped), dtype=np.uint8
+    )
+    return cmd_ln(leds, rgb)
+
+
+def time_commands(display, board, cmds, depth, timer=time.perf_counter):
+    """Seconds taken, as measured by timer, to send cmds to board with
+    depth commands in flight and receive all their acknowledgements."""
+    display.flush()
+    max_in_flight = display.set_max_in_flight(board, depth)
+    try:
+        t0 = timer()
+        for cmd in cmds:
+            display.send_command(board, cmd)
+        display.flush()
+        return timer() - t0
+    finally:
+        display.set_max_in_flight(board, max_in_flight)
+
+
+def fit_link_model(wire_bytes, seconds):
+    """Least squares fit of seconds = latency + wire_bytes / bandwidth.
+
+    Returns:
+        (latency in seconds, bandwidth in bytes per second).
+    """
+    slope, latency = np.polyfit(
+        np.asarray(wire_bytes, dtype=np.float64),
+        np.asarray(seconds, dtype=np.float64),
+        1
+    )
+    bytes_per_second = 1 / slope if slope > 0 else np.inf
+    return max(float(latency), 0.0), float(bytes_per_second)
+
+
+def profile_link(
+    display,
+    board,
+    sizes=PAYLOAD_SIZES,
+    escape_densities=ESCAPE_DENSITIES,
+    depths=DEPTHS,
+    n_commands=N_COMMANDS,
+    seed=0,
+    timer=time.perf_counter
+):
+    """Measure and fit the cost model of the link to one board.
+
+    Payload sizes above the board's packet buffer are skipped. timer is the
+    clock the commands are timed with (see time_commands).
+
+    Returns:
+        Dict with the fitted 'latency' (s) and 'bytes_per_second', the
+        board's 'max_packet_len' and the 'samples' measured, each with the
+        command length, wire bytes, escape density, depth and seconds per
+        command.
+    """
+    rng = np.random.default_rng(seed)
+    n_leds = int(display.leds_per_board[board])
+    max_packet_len = int(display.max_packet_len[board])
+    samples = []
+    for size in sizes:
+        if size > max_packet_len:
+            continue
+        for escape_density in escape_densities:
+            cmds = [
+                profile_command(size, escape_density, n_leds, rng)
+                for _ in range(n_commands)
+            ]
+            wire_bytes = np.mean([encoded_len(cmd) + 2 for cmd in cmds])
+            for depth in depths:
+                seconds = time_commands(display, board, cmds, depth, timer)
+                samples.append({
+                    'size': len(cmds[0]),
+                    'wire_bytes': float(wire_bytes),
+                    'escape_density': escape_density,
+                    'depth': depth,
+                    'seconds_per_command': seconds / n_commands,
+                    'bytes_per_second': wire_bytes * n_commands / seconds,
+                })
+    # The LED buffer of the board no longer matches the shadow copy
+    display.invalidate_shadow(board)
+    unpipelined = [s for s in samples if s['depth'] == 1]
+    if len({s['wire_bytes'] for s in unpipelined}) < 2:
+        raise ValueError("need at least two payload sizes at depth 1")
+    latency, bytes_per_second = fit_link_model(
+        [s['wire_bytes'] for s in unpipelined],
+        [s['seconds_per_command'] for s in unpipelined]
+    )
+    return {
+        'latency': latency,
+        'bytes_per_second': bytes_per_second,
+        'max_packet_len': max_packet_len,
+        'samples': samples,
+    }
+
+
+def profile_display(display, **kwargs):
+    """profile_link for each board, as a dict keyed by board name."""
+    return {
+        name: profile_link(display, board, **kwargs)
+        for board, name in enumerate(display.board_names)
+    }
+
+
+def command_overhead(link, max_in_flight=1):
+    """Cost of one more command in wire bytes: the bytes the link could
+    have carried during the command latency, shared by the commands in
+    flight."""
+    if not np.isfinite(link['bytes_per_second']):
+        return 0
+    return int(round(
+        link['latency'] * link['bytes_per_second'] / max_in_flight
+    ))
+
+
+def save_profile(links, path=LINK_PROFILE_FILE):
+    # Write to a temporary file first so the profile is never left corrupt
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(links, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_profile(path=LINK_PROFILE_FILE):
+    """Dict of board name to link profile saved by save_profile."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def main(argv=None):
+    from display1593 import Display1593, NUMBER_OF_LEDS, SERIAL_PORTS
+    from led_emulator import EmulatorPorts
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--ports', nargs='+', default=SERIAL_PORTS)
+    parser.add_argument('--emulate', action='store_true',
+                        help='profile emulated boards at the baud rate')
+    parser.add_argument('--output', default=LINK_PROFILE_FILE,
+                        help='JSON file to write the profile to')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=list(PAYLOAD_SIZES))
+    parser.add_argument('--escape-densities', type=float, nargs='+',
+                        default=list(ESCAPE_DENSITIES))
+    parser.add_argument('--depths', type=int, nargs='+',
+                        default=list(DEPTHS))
+    parser.add_argument('--commands', type=int, default=N_COMMANDS,
+                        help='commands sent per measurement')
+    args = parser.parse_args(argv)
+
+    kwargs = {}
+    if args.emulate:
+        ports = EmulatorPorts.from_number_of_leds(
+            NUMBER_OF_LEDS, bytes_per_second='baud', latency=0.001
+        )
+        kwargs.update(ports=ports.names, serial_factory=ports)
+    else:
+        kwargs.update(ports=args.ports)
+    with Display1593(**kwargs) as dis:
+        links = profile_display(
+            dis,
+            sizes=args.sizes,
+            escape_densities=args.escape_densities,
+            depths=args.depths,
+            n_commands=args.commands
+        )
+    save_profile(links, args.output)
+    for name, link in links.items():
+        print(
+            f"{name}: latency {link['latency'] * 1000:.2f} ms, "
+            f"{link['bytes_per_second'] / 1000:.1f} kB/s",
+            file=sys.stderr
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""In-memory instrumentation of the commands sent to the display.
+
+A MetricsRegistry keeps counters, latency histograms and a fixed-size
+ring buffer with one record per command sent. Recording is a few array
+writes so it can stay on for every frame, unlike logging to a file. Use
+snapshot() to read everything at once, e.g. to export it as JSON.
+"""
+import json
+import threading
+from collections import defaultdict
+
+import numpy as np
+
+
+# Stages of sending a command whose durations are recorded
+STAGES = ('build', 'encode', 'write', 'ack_wait')
+
+# Histogram bucket upper edges (seconds): 1 us to ~10 s, 10 per decade
+BUCKET_EDGES = 10.0 ** np.arange(-6, 1.01, 0.1)
+
+EVENT_DTYPE = np.dtype([
+    ('seq', np.int64),
+    ('time', np.float64),
+    ('board', np.int16),
+    ('command', 'S2'),
+    ('n_bytes', np.int32),
+    ('n_escapes', np.int32),
+    ('build', np.float32),
+    ('encode', np.float32),
+    ('write', np.float32),
+    ('ack_wait', np.float32),
+])
+
+
+class Histogram():
+    """Latency histogram with fixed logarithmic buckets."""
+
+    def __init__(self, edges=BUCKET_EDGES):
+        self.edges = edges
+        self.counts = np.zeros(len(edges) + 1, dtype=np.int64)
+        self.n = 0
+        self.total = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def observe(self, value):
+        self.counts[np.searchsorted(self.edges, value)] += 1
+        self.n += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def observe_array(self, values):
+        """Add each value in a NumPy array."""
+        if values.shape[0] == 0:
+            return
+        self.counts += np.bincount(
+            np.searchsorted(self.edges, values), minlength=len(self.counts)
+        )
+        self.n += values.shape[0]
+        self.total += float(np.sum(values))
+        self.min = min(self.min, float(np.min(values)))
+        self.max = max(self.max, float(np.max(values)))
+
+    def quantile(self, q):
+        """Upper edge of the bucket containing quantile q (within the
+        range of the values observed)."""
+        if self.n == 0:
+            return np.nan
+        i = int(np.searchsorted(np.cumsum(self.counts), q * self.n))
+        edge = self.edges[i] if i < len(self.edges) else self.max
+        return float(min(max(edge, self.min), self.max))
+
+    def summary(self):
+        if self.n == 0:
+            return {'count': 0}
+        return {
+            'count': self.n,
+            'mean': self.total / self.n,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+        }
+
+
+class TimingStats():
+    """Count, mean, standard deviation, range and quantiles of a stream of
+    durations, in constant memory."""
+
+    def __init__(self):
+        self.n = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.histogram = Histogram()
+
+    def add(self, values):
+        if values.shape[0] == 0:
+            return
+        self.n += values.shape[0]
+        self.total += float(np.sum(values))
+        self.total_sq += float(np.sum(values * values))
+        self.histogram.observe_array(values)
+
+    def summary(self):
+        if self.n == 0:
+            return {'count': 0}
+        mean = self.total / self.n
+        return dict(
+            self.histogram.summary(),
+            std=np.sqrt(max(self.total_sq / self.n - mean * mean, 0.0))
+        )
+
+
+class MetricsRegistry():
+    """Counters, histograms and a ring buffer of per-command records.
+
+    Args:
+        ring_size: number of most recent commands kept in the ring buffer.
+    """
+
+    def __init__(self, ring_size=4096):
+        self.ring_size = ring_size
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(int)
+            self.histograms = defaultdict(Histogram)
+            self._events = np.zeros(self.ring_size, dtype=EVENT_DTYPE)
+            self._events['seq'] = -1
+            self._seq = 0
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def observe(self, name, value):
+        with self._lock:
+            self.histograms[name].observe(value)
+
+    def record_command(
+        self, t, board, command, n_bytes, n_escapes, build, encode, write
+    ):
+        """Record a command that was written to a board.
+
+        Returns a sequence number to pass to record_ack when the command is
+        acknowledged.
+        """
+        with self._lock:
+            code = bytes(command[:2]).decode('ascii', 'replace')
+            self.counters['commands'] += 1
+            self.counters[f'commands.{code}'] += 1
+            self.counters['bytes'] += n_bytes
+            self.counters[f'bytes.{code}'] += n_bytes
+            self.counters['escape_bytes'] += n_escapes
+            for stage, value in zip(STAGES, (build, encode, write)):
+                self.histograms[f'{code}.{stage}'].observe(value)
+            seq = self._seq
+            self._seq += 1
+            self._events[seq % self.ring_size] = (
+                seq, t, board, bytes(command[:2]), n_bytes, n_escapes,
+                build, encode, write, np.nan
+            )
+            return seq
+
+    def record_ack(self, seq, command, ack_wait):
+        """Record the time from writing command until its acknowledgement."""
+        with self._lock:
+            code = bytes(command[:2]).decode('ascii', 'replace')
+            self.histograms[f'{code}.ack_wait'].observe(ack_wait)
+            event = self._events[seq % self.ring_size]
+            if event['seq'] == seq:
+                event['ack_wait'] = ack_wait
+
+    def events(self):
+        """Records of the most recent commands, oldest first."""
+        with self._lock:
+            events = self._events[self._events['seq'] >= 0]
+            return np.sort(events, order='seq')
+
+    def snapshot(self):
+        """Dict of the counters, histogram summaries and recent events."""
+        events = self.events()
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {
+                    name: hist.summary()
+                    for name, hist in sorted(self.histograms.items())
+                },
+                'events': {
+                    name: events[name].tolist() if name != 'command'
+                    else [c.decode('ascii', 'replace') for c in events[name]]
+                    for name in EVENT_DTYPE.names
+                },
+            }
+
+    def export_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f)
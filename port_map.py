@@ -0,0 +1,84 @@
+"""Persisted mapping of USB serial numbers to board names.
+
+The port a board appears on can change when it is plugged in again (e.g.
+/dev/ttyACM0 becomes /dev/ttyACM2) but its USB serial number does not.
+Display1593 records the name each board gave in its hello message
+against the serial number of its port. It then uses the mapping to open
+the boards directly, without waiting for their hello messages, the next
+time it connects.
+"""
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+PORT_MAP_FILE = os.path.join(
+    os.path.expanduser('~'), '.display1593_ports.json'
+)
+
+
+def list_usb_ports():
+    """List of (device, USB serial number) of the serial ports present."""
+    from serial.tools import list_ports
+    return [
+        (port.device, port.serial_number) for port in list_ports.comports()
+    ]
+
+
+class PortMap():
+    """Mapping of USB serial number to board name saved in a JSON file.
+
+    Args:
+        path: JSON file the mapping is loaded from and saved to.
+        list_ports: function returning the (device, serial number) pairs of
+            the ports present.
+    """
+
+    def __init__(self, path=PORT_MAP_FILE, list_ports=list_usb_ports):
+        self.path = path
+        self.list_ports = list_ports
+        self.boards = {}  # Serial number: board name
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.boards = json.load(f)
+        except FileNotFoundError:
+            self.boards = {}
+        except (OSError, ValueError) as e:
+            logger.info(f'Ignoring port map {self.path}: {e}')
+            self.boards = {}
+
+    def save(self):
+        # Write to a temporary file first so the map is never left corrupt
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.boards, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def find(self, board_names):
+        """Dict of board name to the device of each board known and
+        present, among board_names."""
+        devices = {}
+        for device, serial_number in self.list_ports():
+            name = self.boards.get(serial_number)
+            if name in board_names:
+                devices[name] = device
+        return devices
+
+    def update(self, devices):
+        """Record the board names of a dict of device to board name and
+        save the mapping if it changed."""
+        serial_numbers = dict(self.list_ports())
+        changed = False
+        for device, name in devices.items():
+            serial_number = serial_numbers.get(device)
+            if serial_number is None:
+                continue
+            if self.boards.get(serial_number) != name:
+                self.boards[serial_number] = name
+                changed = True
+        if changed:
+            self.save()
@@ -0,0 +1,51 @@
+"""Compilation of the numba kernels.
+
+Kernels are compiled on their first call rather than at import and the
+machine code is cached on disk (numba's cache=True), so only the first
+run after installing or changing them pays the compile cost.
+
+Set the environment variable SERIAL_COMM_NO_NUMBA=1 to not import numba
+at all and use pure NumPy versions of the kernels instead, e.g. for
+tools where start-up time matters more than throughput.
+"""
+import os
+
+
+NUMBA_DISABLED = os.environ.get('SERIAL_COMM_NO_NUMBA', '0') not in ('', '0')
+
+
+def _numba():
+    if NUMBA_DISABLED:
+        return None
+    try:
+        import numba
+    except ImportError:
+        return None
+    return numba
+
+
+def jit(fallback=None):
+    """Decorator compiling a function lazily with numba.njit(cache=True).
+
+    If numba is disabled or not installed, fallback (a pure NumPy version
+    of the function) is returned instead, or the undecorated function if
+    no fallback is given.
+    """
+    def decorator(func):
+        numba = _numba()
+        if numba is not None:
+            return numba.njit(cache=True)(func)
+        return func if fallback is None else fallback
+    return decorator
+
+
+def load_aot_module():
+    """Return the ahead-of-time compiled kernels (see serial_comm.aot),
+    or None if they have not been built or numba is disabled."""
+    if NUMBA_DISABLED:
+        return None
+    try:
+        from serial_comm import _codec_aot
+    except ImportError:
+        return None
+    return _codec_aot
@@ -0,0 +1,156 @@
+"""Byte-stuffing kernels.
+
+The functions here are plain Python written for numba's nopython mode.
+serial_comm.serial_comm compiles them (see _jit.py), or uses the
+ahead-of-time compiled versions built by serial_comm.aot, or falls back
+to the pure NumPy versions at the end of this module.
+"""
+import numpy as np
+
+
+START_MARKER = 254
+END_MARKER = 255
+SPECIAL_BYTE = 253
+
+
+def encoded_len(data):
+    # Each byte >= SPECIAL_BYTE is replaced by two bytes
+    n = len(data)
+    for i in range(len(data)):
+        if data[i] >= SPECIAL_BYTE:
+            n += 1
+    return n
+
+
+def encode(dst, src):
+    j = 0
+    for i in range(len(src)):
+        x = src[i]
+        if x >= SPECIAL_BYTE:
+            dst[j] = SPECIAL_BYTE
+            dst[j + 1] = x - SPECIAL_BYTE
+            j += 2
+        else:
+            dst[j] = x
+            j += 1
+    return j
+
+
+def encode_frame(dst, src):
+    # Same as encode but between a start and an end marker
+    dst[0] = START_MARKER
+    j = 1
+    for i in range(len(src)):
+        x = src[i]
+        if x >= SPECIAL_BYTE:
+            dst[j] = SPECIAL_BYTE
+            dst[j + 1] = x - SPECIAL_BYTE
+            j += 2
+        else:
+            dst[j] = x
+            j += 1
+    dst[j] = END_MARKER
+    return j + 1
+
+
+def encode_frame_ack(dst, ack, src):
+    # encode_frame fused with the acknowledgement the board replies with:
+    # the length of src (2 bytes) and the 32-bit sum of its bytes (4 bytes)
+    dst[0] = START_MARKER
+    j = 1
+    total = np.uint32(0)
+    for i in range(len(src)):
+        x = src[i]
+        total += x
+        if x >= SPECIAL_BYTE:
+            dst[j] = SPECIAL_BYTE
+            dst[j + 1] = x - SPECIAL_BYTE
+            j += 2
+        else:
+            dst[j] = x
+            j += 1
+    dst[j] = END_MARKER
+    n = len(src)
+    ack[0] = (n >> 8) & 0xFF
+    ack[1] = n & 0xFF
+    ack[2] = (total >> 24) & 0xFF
+    ack[3] = (total >> 16) & 0xFF
+    ack[4] = (total >> 8) & 0xFF
+    ack[5] = total & 0xFF
+    return j + 1
+
+
+def decoded_len(data):
+    # Returns -1 if data ends with an unpaired SPECIAL_BYTE
+    n = 0
+    i = 0
+    while i < len(data):
+        if data[i] == SPECIAL_BYTE:
+            i += 1
+            if i == len(data):
+                return -1
+        n += 1
+        i += 1
+    return n
+
+
+def decode(dst, src):
+    i = 0
+    j = 0
+    while i < len(src):
+        x = src[i]
+        if x == SPECIAL_BYTE:
+            i += 1
+            x = SPECIAL_BYTE + src[i]
+        dst[j] = x
+        i += 1
+        j += 1
+    return j
+
+
+# Pure NumPy versions, used when numba is not available or disabled.
+# The decoders assume well-formed input, in which the byte following a
+# SPECIAL_BYTE is always less than SPECIAL_BYTE.
+
+def encoded_len_numpy(data):
+    return len(data) + int(np.count_nonzero(data >= SPECIAL_BYTE))
+
+
+def encode_numpy(dst, src):
+    escaped = src >= SPECIAL_BYTE
+    # Position of each source byte in the output
+    pos = np.arange(len(src)) + np.cumsum(escaped) - escaped
+    dst[pos] = np.where(escaped, SPECIAL_BYTE, src)
+    dst[pos[escaped] + 1] = src[escaped] - SPECIAL_BYTE
+    return len(src) + int(np.count_nonzero(escaped))
+
+
+def encode_frame_numpy(dst, src):
+    dst[0] = START_MARKER
+    n = encode_numpy(dst[1:], src)
+    dst[n + 1] = END_MARKER
+    return n + 2
+
+
+def encode_frame_ack_numpy(dst, ack, src):
+    ack[:2] = divmod(len(src), 256)
+    ack[2:] = np.frombuffer(
+        int(np.sum(src, dtype=np.uint32)).to_bytes(4, 'big'), dtype=np.uint8
+    )
+    return encode_frame_numpy(dst, src)
+
+
+def decoded_len_numpy(data):
+    n_escapes = int(np.count_nonzero(data == SPECIAL_BYTE))
+    if len(data) > 0 and data[-1] == SPECIAL_BYTE:
+        return -1
+    return len(data) - n_escapes
+
+
+def decode_numpy(dst, src):
+    escaped = src == SPECIAL_BYTE
+    values = src.copy()
+    values[np.flatnonzero(escaped) + 1] += SPECIAL_BYTE
+    n = len(src) - int(np.count_nonzero(escaped))
+    dst[:n] = values[~escaped]
+    return n
@@ -0,0 +1,41 @@
+"""Ahead-of-time compilation of the byte-stuffing kernels.
+
+Run
+
+    python -m serial_comm.aot
+
+to build the extension module serial_comm/_codec_aot next to this file.
+When it is present serial_comm uses it instead of compiling the kernels
+with numba at run time, so the first packet sent costs no compile time.
+Building needs numba and a C compiler, but using the module does not.
+"""
+import os
+
+from numba import njit
+from numba.pycc import CC
+
+from serial_comm import _kernels
+
+
+# Signatures of the exported kernels (C-contiguous uint8 arrays)
+SIGNATURES = {
+    'encoded_len': 'intp(uint8[::1])',
+    'encode': 'intp(uint8[::1], uint8[::1])',
+    'encode_frame': 'intp(uint8[::1], uint8[::1])',
+    'encode_frame_ack': 'intp(uint8[::1], uint8[::1], uint8[::1])',
+    'decoded_len': 'intp(uint8[::1])',
+    'decode': 'intp(uint8[::1], uint8[::1])',
+}
+
+
+def build(output_dir=None):
+    cc = CC('_codec_aot')
+    cc.output_dir = output_dir or os.path.dirname(os.path.abspath(__file__))
+    cc.verbose = True
+    for name, signature in SIGNATURES.items():
+        cc.export(name, signature)(njit(getattr(_kernels, name)))
+    cc.compile()
+
+
+if __name__ == "__main__":
+    build()
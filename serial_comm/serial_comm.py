@@ -6,104 +6,441 @@ May 2025
 
 """
 import time
+import weakref
+from collections import OrderedDict
+
 import numpy as np
-import numba as nb
-from numba import jit, types
-from itertools import chain
+
+from serial_comm import _kernels
+from serial_comm._kernels import START_MARKER, END_MARKER, SPECIAL_BYTE
+from serial_comm._jit import jit, load_aot_module
 
 
 MY_NAME = "HostComputer"
-START_MARKER = 254
-END_MARKER = 255
-SPECIAL_BYTE = 253
 MAX_PACKAGE_LEN = 8192
+ACK_LEN = 6  # Length and sum of the data received
+HELLO_POLL_INTERVAL = 0.001  # seconds
+HELLO_TIMEOUT = 10  # seconds to wait for a board's hello message
 
 
-# Define the array types
-readonly_uint8_array = types.Array(types.uint8, 1, 'C', readonly=True)
-writable_uint8_array = types.Array(types.uint8, 1, 'C')
-
 
-
-def connect_to_arduino(ser, timeout_time=10, hello_message=b'My name is '):
-    # Wait for the initial hello message from the Arduino
+def connect_to_arduino(
+    ser, timeout_time=HELLO_TIMEOUT, hello_message=b'My name is '
+):
+    # Wait for the initial hello message from the Arduino. Reads block
+    # for up to the port's read timeout, so this only polls (every
+    # HELLO_POLL_INTERVAL) if the port was opened without one.
     t0 = time.time()
+    parser = FrameParser()
+    status, message = 1, "Timeout"
     while (time.time() - t0) < timeout_time:
-        if ser.in_waiting > 0:
-            data_received = receive_data_from_arduino(ser)
-            if np.array_equal(data_received[:2], [0, 0]):
-                message_bytes = bytes(data_received[2:])
-                assert message_bytes.startswith(hello_message)
+        n = ser.in_waiting
+        if n == 0 and ser.timeout is None:
+            time.sleep(HELLO_POLL_INTERVAL)
+            continue
+        for data_received in parser.feed(ser.read(max(1, n))):
+            message_bytes = bytes(data_received[2:])
+            if (
+                np.array_equal(data_received[:2], [0, 0])
+                and message_bytes.startswith(hello_message)
+            ):
                 message = message_bytes.removeprefix(
                     hello_message
-                ).decode('utf')
-                status = 0
-                break
-            else:
-                status, message = 2, "No hello message in data received"
-        if (time.time() - t0) >= timeout_time:
-            status, message = 1, "Timeout"
+                ).decode('utf', errors='replace')
+                return 0, message
+            status, message = 2, "No hello message in data received"
     return status, message
 
 
-def send_data_to_arduino(ser, data):
-    global START_MARKER, END_MARKER
-    # TODO: Make this non-blocking
-    ser.write(chain.from_iterable([
-        [START_MARKER],
-        encode_data(data.astype(np.uint8)),
-        [END_MARKER]
-    ]))
+class FrameBuffer:
+    """Reusable scratch buffer for building framed packets.
+
+    build() writes START_MARKER, the byte-stuffed data and END_MARKER into
+    one contiguous buffer which is only reallocated when a larger packet
+    than any before it is built. The buffer has room for the longest
+    possible encoding of the data, so packets are built in one pass.
+    """
+
+    def __init__(self, size=256):
+        self._allocate(size)
+
+    def _allocate(self, size):
+        self._buf = bytearray(size)
+        self._arr = np.frombuffer(self._buf, dtype=np.uint8)
+
+    def build(self, data):
+        """Frame data and return a memoryview of the packet bytes.
+
+        The view is only valid until the next call to build().
+        """
+        src = as_uint8_array(data)
+        self._reserve(src.shape[0])
+        n = _encode_frame_kernel(self._arr, src)
+        return memoryview(self._buf)[:n]
+
+    def build_ack(self, data):
+        """Same as build() but also returns the acknowledgement the board
+        replies with (see PreparedCommand), computed in the same pass."""
+        src = as_uint8_array(data)
+        self._reserve(src.shape[0])
+        ack = np.empty(ACK_LEN, dtype=np.uint8)
+        n = _encode_frame_ack_kernel(self._arr, ack, src)
+        return memoryview(self._buf)[:n], ack
+
+    def _reserve(self, data_len):
+        # Room for every byte escaped plus the markers
+        n = 2 * data_len + 2
+        if n > len(self._buf):
+            self._allocate(max(n, 2 * len(self._buf)))
+
+
+class PreparedCommand:
+    """Command framed once, to be sent any number of times.
+
+    Attributes:
+        data: the command (uint8 array).
+        wire: the framed and byte-stuffed packet (bytes).
+        ack: the acknowledgement the board replies with (uint8 array of
+            ACK_LEN bytes): the length of data (16-bit big-endian) and
+            the sum of its bytes (32-bit big-endian).
+    """
+
+    __slots__ = ('data', 'wire', 'ack')
+
+    def __init__(self, data):
+        src = as_uint8_array(data)
+        buf = np.empty(2 * src.shape[0] + 2, dtype=np.uint8)
+        self.ack = np.empty(ACK_LEN, dtype=np.uint8)
+        n = _encode_frame_ack_kernel(buf, self.ack, src)
+        self.data = src.copy()
+        self.data.flags.writeable = False
+        self.ack.flags.writeable = False
+        self.wire = buf[:n].tobytes()
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __repr__(self):
+        return f"PreparedCommand({bytes(self.data)!r})"
+
+
+class CommandCache:
+    """LRU cache of PreparedCommands keyed on the command bytes.
+
+    Constant and frequently repeated commands are framed and checksummed
+    only the first time they are sent. Commands longer than max_len
+    bytes are prepared but not stored.
+    """
+
+    def __init__(self, maxsize=1024, max_len=64):
+        self.maxsize = maxsize
+        self.max_len = max_len
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def get(self, data):
+        """PreparedCommand of data (bytes or uint8 array)."""
+        if not isinstance(data, bytes):
+            data = as_uint8_array(data).tobytes()
+        key = data
+        prepared = self._cache.get(key)
+        if prepared is not None:
+            self.hits += 1
+            self._cache.move_to_end(key)
+            return prepared
+        self.misses += 1
+        prepared = PreparedCommand(key)
+        if len(key) <= self.max_len:
+            self._cache[key] = prepared
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return prepared
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, data):
+        return as_uint8_array(data).tobytes() in self._cache
+
+    def clear(self):
+        self._cache.clear()
+
+
+# One scratch buffer per serial connection
+_frame_buffers = weakref.WeakKeyDictionary()
+
+
+def build_frame(data):
+    """Return START_MARKER + stuffed data + END_MARKER as a new bytearray."""
+    src = as_uint8_array(data)
+    out = bytearray(_encoded_len(src) + 2)
+    _encode_frame_kernel(np.frombuffer(out, dtype=np.uint8), src)
+    return out
+
+
+def send_data_to_arduino(ser, data, frame_buffer=None):
+    """Frame data and write it to ser, blocking until it is written.
+
+    For sends that don't block the caller, use the I/O threads of
+    display1593.Display1593 (io_threads=True) or async_display1593.
+    """
+    if frame_buffer is None:
+        frame_buffer = _frame_buffers.get(ser)
+        if frame_buffer is None:
+            frame_buffer = _frame_buffers[ser] = FrameBuffer()
+    ser.write(frame_buffer.build(data))
+
+
+class FramingError(Exception):
+    """Data received from the device is not a correctly framed packet."""
 
 
 def receive_data_from_arduino(ser):
-    global START_MARKER, END_MARKER
     # Read data until the start character is found
     bytes_seq = ser.read_until(
         bytes([START_MARKER]), size=MAX_PACKAGE_LEN * 2 + 1
     )
-    assert bytes_seq[-1] == START_MARKER, "No start marker found"
+    if len(bytes_seq) == 0 or bytes_seq[-1] != START_MARKER:
+        raise FramingError("No start marker found")
     # Read data until the end marker is found
     bytes_seq = ser.read_until(
         bytes([END_MARKER]), size=MAX_PACKAGE_LEN * 2 + 1
     )
-    assert bytes_seq[-1] == END_MARKER, \
-        f"No end marker found after {MAX_PACKAGE_LEN * 2 + 1} bytes read"
+    if len(bytes_seq) == 0 or bytes_seq[-1] != END_MARKER:
+        raise FramingError(
+            f"No end marker found after {len(bytes_seq)} bytes read"
+        )
     # Convert to numpy array and decode, omitting end marker
     data = np.frombuffer(bytes_seq[:-1], dtype=np.uint8)
-    data = decode_data(data)
-    assert data.shape[0] <= MAX_PACKAGE_LEN, \
-        f"More than {MAX_PACKAGE_LEN} data bytes in package"
+    try:
+        data = decode_data(data)
+    except ValueError as e:
+        raise FramingError(str(e)) from e
+    if data.shape[0] > MAX_PACKAGE_LEN:
+        raise FramingError(f"More than {MAX_PACKAGE_LEN} data bytes in package")
     return data
 
 
-@jit([writable_uint8_array(readonly_uint8_array), 
-      writable_uint8_array(writable_uint8_array)], nopython=True)
+class FrameParser:
+    """Incremental parser for the framed packet stream from a device.
+
+    Feed it arbitrary chunks of bytes as they arrive and it returns the
+    decoded contents of every packet completed by that chunk. Bytes
+    outside a START_MARKER ... END_MARKER pair are discarded. A
+    START_MARKER in the middle of a packet drops the partial packet and
+    starts a new one, so the parser resynchronises on its own rather than
+    failing. Packets that are too long or that cannot be decoded are
+    dropped and counted in n_errors.
+    """
+
+    def __init__(self, max_package_len=MAX_PACKAGE_LEN):
+        self.max_encoded_len = max_package_len * 2
+        self.max_package_len = max_package_len
+        self._buf = bytearray()
+        self._in_packet = False
+        self.n_resyncs = 0
+        self.n_errors = 0
+
+    def reset(self):
+        """Discard any partially received packet."""
+        self._buf.clear()
+        self._in_packet = False
+
+    def feed(self, chunk):
+        """Parse chunk and return a list of decoded packets (uint8 arrays)."""
+        if not isinstance(chunk, (bytes, bytearray)):
+            chunk = bytes(chunk)
+        packets = []
+        start, end = bytes([START_MARKER]), bytes([END_MARKER])
+        pos, n = 0, len(chunk)
+        while pos < n:
+            if not self._in_packet:
+                i = chunk.find(start, pos)
+                if i == -1:
+                    break
+                self._in_packet = True
+                self._buf.clear()
+                pos = i + 1
+                continue
+            j = chunk.find(end, pos)
+            i = chunk.find(start, pos, n if j == -1 else j)
+            if i != -1:
+                # Stray start marker - restart packet from here
+                self.n_resyncs += 1
+                self._buf.clear()
+                pos = i + 1
+                continue
+            if j == -1:
+                self._buf += chunk[pos:]
+                if len(self._buf) > self.max_encoded_len:
+                    self.n_errors += 1
+                    self.reset()
+                break
+            self._buf += chunk[pos:j]
+            pos = j + 1
+            self._in_packet = False
+            packet = self._decode(bytes(self._buf))
+            if packet is not None:
+                packets.append(packet)
+        return packets
+
+    def _decode(self, encoded):
+        try:
+            data = decode_data(encoded)
+        except ValueError:
+            self.n_errors += 1
+            return None
+        if data.shape[0] > self.max_package_len:
+            self.n_errors += 1
+            return None
+        return data
+
+
+def receive_packets(ser, parser):
+    """Read all bytes waiting on ser in one call and return any packets
+    completed by them."""
+    n = ser.in_waiting
+    if n == 0:
+        return []
+    return parser.feed(ser.read(n))
+
+
+def as_uint8_array(data):
+    """Return a 1-d uint8 array view of data without copying if possible.
+
+    Accepts bytes, bytearray, memoryview, uint8 NumPy arrays or any
+    sequence of ints in the range 0-255 (which has to be copied).
+    """
+    if isinstance(data, np.ndarray):
+        if data.dtype != np.uint8:
+            data = data.astype(np.uint8)
+        return np.ascontiguousarray(data.reshape(-1))
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return np.frombuffer(data, dtype=np.uint8)
+    return np.asarray(data, dtype=np.uint8).reshape(-1)
+
+
+# Byte-stuffing kernels, ahead-of-time compiled if available, otherwise
+# compiled by numba on first use
+_aot = load_aot_module()
+if _aot is not None:
+    _encoded_len = _aot.encoded_len
+    _encode_kernel = _aot.encode
+    _encode_frame_kernel = _aot.encode_frame
+    _encode_frame_ack_kernel = getattr(_aot, 'encode_frame_ack', None)
+    _decoded_len = _aot.decoded_len
+    _decode_kernel = _aot.decode
+else:
+    _encoded_len = jit(_kernels.encoded_len_numpy)(_kernels.encoded_len)
+    _encode_kernel = jit(_kernels.encode_numpy)(_kernels.encode)
+    _encode_frame_kernel = jit(_kernels.encode_frame_numpy)(
+        _kernels.encode_frame
+    )
+    _decoded_len = jit(_kernels.decoded_len_numpy)(_kernels.decoded_len)
+    _decode_kernel = jit(_kernels.decode_numpy)(_kernels.decode)
+if _aot is None or _encode_frame_ack_kernel is None:
+    # Also for modules built before this kernel was added
+    _encode_frame_ack_kernel = jit(_kernels.encode_frame_ack_numpy)(
+        _kernels.encode_frame_ack
+    )
+
+
+def encoded_len(data):
+    """Number of bytes data occupies after byte-stuffing."""
+    return _encoded_len(as_uint8_array(data))
+
+
+def _writable_uint8_array(buf):
+    """1-d uint8 array sharing memory with buf, which is written to.
+
+    Raises TypeError if buf is not a buffer of bytes and ValueError if it
+    is read-only or not contiguous, rather than copying it.
+    """
+    if isinstance(buf, np.ndarray):
+        if buf.dtype != np.uint8:
+            raise TypeError(f"buffer dtype must be uint8, not {buf.dtype}")
+        arr = buf
+    else:
+        try:
+            view = memoryview(buf)
+        except TypeError:
+            raise TypeError(
+                f"{type(buf).__name__} object is not a writable buffer"
+            ) from None
+        if view.itemsize != 1:
+            raise TypeError(
+                f"buffer format must be bytes, not {view.format!r}"
+            )
+        if not view.c_contiguous:
+            raise ValueError("buffer is not contiguous")
+        arr = np.frombuffer(view, dtype=np.uint8)
+    if arr.ndim != 1 or not arr.flags.c_contiguous:
+        raise ValueError("buffer must be 1-d and contiguous")
+    if not arr.flags.writeable:
+        raise ValueError("buffer is read-only")
+    return arr
+
+
+def encode_into(dst, src):
+    """Byte-stuff src into the caller-owned buffer dst.
+
+    Args:
+        dst: writable, contiguous buffer of bytes (bytearray, memoryview
+            or 1-d uint8 array) with room for at least encoded_len(src)
+            bytes. Other buffers raise TypeError or ValueError.
+        src: data to encode (any type accepted by as_uint8_array).
+
+    Returns:
+        Number of bytes written to dst.
+    """
+    src = as_uint8_array(src)
+    dst = _writable_uint8_array(dst)
+    if dst.shape[0] < _encoded_len(src):
+        raise ValueError("destination buffer too small")
+    return _encode_kernel(dst, src)
+
+
 def encode_data(data):
-    # TODO: Could this be converted to return bytes?
-    global SPECIAL_BYTE
-    data_out: nb.uint8[:] = []
-    for x in data:
-        if x >= SPECIAL_BYTE:
-            data_out.append(SPECIAL_BYTE)
-            data_out.append(x - SPECIAL_BYTE)
-        else:
-            data_out.append(x)
-    return np.array(data_out, dtype=np.uint8)
-
-
-@jit([writable_uint8_array(readonly_uint8_array), 
-      writable_uint8_array(writable_uint8_array)], nopython=True)
-def decode_data(data_in):
-    # TODO: Could this be converted to accept bytes?
-    global SPECIAL_BYTE
-    data_out: nb.uint8[:] = []
-    n = 0
-    while n < len(data_in):
-        x = data_in[n]
-        if x == SPECIAL_BYTE:
-            n += 1
-            x = SPECIAL_BYTE + data_in[n]
-        data_out.append(x)
-        n += 1
-    return np.array(data_out, dtype=np.uint8)
+    """Byte-stuff data so that it contains no marker bytes.
+
+    Every byte >= SPECIAL_BYTE is replaced by SPECIAL_BYTE followed by
+    its offset from SPECIAL_BYTE. Returns a new uint8 array.
+    """
+    src = as_uint8_array(data)
+    dst = np.empty(_encoded_len(src), dtype=np.uint8)
+    _encode_kernel(dst, src)
+    return dst
+
+
+def decode_data(data):
+    """Reverse the byte-stuffing done by encode_data.
+
+    Returns a new uint8 array.
+    """
+    src = as_uint8_array(data)
+    n = _decoded_len(src)
+    if n < 0:
+        raise ValueError("encoded data ends with an unpaired special byte")
+    dst = np.empty(n, dtype=np.uint8)
+    _decode_kernel(dst, src)
+    return dst
+
+
+def encode_bytes(data):
+    """Same as encode_data but returns a bytearray."""
+    src = as_uint8_array(data)
+    out = bytearray(_encoded_len(src))
+    _encode_kernel(np.frombuffer(out, dtype=np.uint8), src)
+    return out
+
+
+def decode_bytes(data):
+    """Same as decode_data but returns a bytearray."""
+    src = as_uint8_array(data)
+    n = _decoded_len(src)
+    if n < 0:
+        raise ValueError("encoded data ends with an unpaired special byte")
+    out = bytearray(n)
+    _decode_kernel(np.frombuffer(out, dtype=np.uint8), src)
+    return out
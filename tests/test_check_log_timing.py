@@ -0,0 +1,39 @@
+import numpy as np
+from check_log_timing import analyze_log_timing
+
+
+def write_log(path):
+    t = 0
+    lines = []
+    for i in range(50):
+        t += 3000 if i == 30 else 100
+        for method, dt in (('show_now', 0), ('set_led', 20)):
+            for message, dt_msg in (('', 0), (' done', 5)):
+                ms = t + dt + dt_msg
+                lines.append(
+                    f"2024-01-01 00:{ms // 60000:02d}:{ms // 1000 % 60:02d}."
+                    f"{ms % 1000:03d}|DEBUG|display1593|Method {method}"
+                    f"{message}."
+                )
+        lines.append("2024-01-01 00:00:00.000|INFO|display1593|Debug msg")
+    path.write_text('\n'.join(lines) + '\n')
+    return lines
+
+
+def test_analyze_log_timing(tmp_path, capsys):
+    log = tmp_path / 'display1593.log'
+    lines = write_log(log)
+    result = analyze_log_timing(log, n_top=2, n_context=1, chunk_size=1000)
+    show_now = result['methods']['show_now']
+    assert show_now['interval']['count'] == 49
+    assert np.isclose(show_now['interval']['max'], 3.0)
+    assert np.isclose(show_now['interval']['min'], 0.1)
+    assert result['methods']['set_led']['duration']['count'] == 50
+    assert np.isclose(result['methods']['set_led']['duration']['mean'], 0.005)
+
+    gap, method, line_before, line_after, _, _ = result['gaps'][0]
+    assert np.isclose(gap, 3.0) and method == 'show_now'
+    assert (line_before, line_after) == (29 * 5, 30 * 5)
+    assert len(result['gaps']) == 2
+    out = capsys.readouterr().out
+    assert lines[line_after] in out and lines[line_after + 1] in out
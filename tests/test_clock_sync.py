@@ -0,0 +1,18 @@
+import numpy as np
+from clock_sync import ClockSync, CLOCK_WRAP
+
+
+def test_clock_sync_offset_and_drift():
+    sync = ClockSync(2, min_drift_span=10.0)
+    rate, offset = 1 + 2e-4, CLOCK_WRAP - 5000
+    for t in np.linspace(1000.0, 1300.0, 16):
+        board_ms = int(offset + rate * (t - 1000.0) * 1000) % CLOCK_WRAP
+        sync.add_sample(1, t - 0.002, board_ms, t + 0.002)
+    assert abs(sync.drift(1) - 2e-4) < 1e-6
+    predicted = sync.board_time(1, 1400.0)
+    assert abs(predicted - (offset + rate * 400000)) < 2
+
+    # Too short a span to estimate drift
+    sync.add_sample(0, 10.0, 500, 10.01)
+    assert sync.drift(0) == 0
+    assert abs(sync.board_time(0, 11.005) - 1500) < 1e-6
@@ -0,0 +1,25 @@
+import time
+import pytest
+import numpy as np
+from display1593 import Display1593
+
+
+def test_split_by_board():
+    dis = Display1593(number_of_leds={'A': 3, 'B': 0, 'C': 4, 'D': 2})
+    assert dis._led_board.tolist() == [0, 0, 0, 2, 2, 2, 2, 3, 3]
+    assert dis._led_local.tolist() == [0, 1, 2, 0, 1, 2, 3, 0, 1]
+    leds = np.array([8, 1, 3, 0, 6], dtype='int32')
+    split = dis._split_by_board(leds)
+    assert [(board, pos.tolist()) for board, pos in split] == [
+        (0, [1, 3]), (2, [2, 4]), (3, [0])
+    ]
+
+
+def test_show_at_horizon():
+    # SA times are compared modulo 2**16 ms, so only the next 32.768 s
+    # can be told apart from the past
+    dis = Display1593(number_of_leds={'A': 3})
+    assert dis._show_at_commands(time.time() + 32.7) == []
+    for ahead in (32.8, 60.0, -1.0):
+        with pytest.raises(ValueError):
+            dis._show_at_commands(time.time() + ahead)
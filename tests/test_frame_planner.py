@@ -0,0 +1,81 @@
+import pytest
+import numpy as np
+from frame_planner import (
+    plan_board_update, plan_colour_groups, command_cost, split_command
+)
+from led_commands import cmd_ln, cmd_cn, cmd_la
+
+
+def test_plan_board_update():
+    old = np.zeros((100, 3), dtype=np.uint8)
+    new = old.copy()
+    assert plan_board_update(new, old) == []
+
+    new[5] = (1, 2, 3)
+    cmds = plan_board_update(new, old)
+    assert [bytes(cmd[:2]) for cmd in cmds] == [b'L1']
+
+    new[:] = (255, 254, 253)
+    cmds = plan_board_update(new, old)
+    assert [bytes(cmd[:2]) for cmd in cmds] == [b'CA']
+
+    new = np.random.default_rng(0).integers(0, 256, (100, 3), dtype=np.uint8)
+    cmds = plan_board_update(new, None)
+    assert [bytes(cmd[:2]) for cmd in cmds] == [b'LA']
+
+
+def test_command_cost_counts_escapes():
+    cmd = cmd_ln(np.array([1, 2]), np.array([[0, 0, 0], [255, 254, 0]]))
+    assert command_cost(cmd) == len(cmd) + 2 + 2
+
+
+def test_plan_colour_groups():
+    leds = np.arange(40)
+    rgb_array = np.zeros((40, 3), dtype=np.uint8)
+    rgb_array[:30] = (10, 20, 30)
+    rgb_array[30:] = np.arange(30).reshape(10, 3)
+    cmds = plan_colour_groups(leds, rgb_array)
+    assert [bytes(cmd[:2]) for cmd in cmds] == [b'CN', b'LN']
+    assert cmds[0][2:4].tolist() == [0, 30]
+    assert cmds[1][2:4].tolist() == [0, 10]
+
+    # Repeated LED ids keep the last colour given
+    rgb_array = np.array([[1, 1, 1], [2, 2, 2]], dtype=np.uint8)
+    cmds = plan_colour_groups(np.array([3, 3]), rgb_array)
+    assert [cmd.tolist() for cmd in cmds] == [[67, 78, 0, 1, 2, 2, 2, 0, 3]]
+
+
+def test_split_command():
+    rng = np.random.default_rng(0)
+    leds = np.arange(100)
+    rgb_array = rng.integers(0, 256, (100, 3), dtype=np.uint8)
+    cmd = cmd_ln(leds, rgb_array)
+    assert split_command(cmd, len(cmd)) == [cmd]
+    cmds = split_command(cmd, 104)
+    assert [len(c) for c in cmds] == [104] * 5
+    assert np.array_equal(
+        np.concatenate([c[4:] for c in cmds]), cmd[4:]
+    )
+    assert [c[3] for c in cmds] == [20] * 5
+
+    cmds = split_command(cmd_cn(leds, (1, 2, 3)), 100)
+    assert [c[3] for c in cmds] == [33, 33, 34]
+    assert all(bytes(c[:7]) == b'CN' + bytes((0, c[3], 1, 2, 3)) for c in cmds)
+
+    # A partial LA is undefined, so a long LA is sent as LN commands only
+    cmds = split_command(cmd_la(rgb_array), 200)
+    assert [bytes(c[:2]) for c in cmds] == [b'LN'] * 3
+    assert all(len(c) <= 200 for c in cmds)
+    assert np.array_equal(np.concatenate([c[4:] for c in cmds]), cmd[4:])
+
+    with pytest.raises(ValueError):
+        split_command(np.frombuffer(b'L1' + bytes(5), dtype=np.uint8), 4)
+
+
+def test_plans_respect_max_len():
+    new = np.random.default_rng(1).integers(0, 256, (100, 3), dtype=np.uint8)
+    for cmds in (
+        plan_board_update(new, None, max_len=64),
+        plan_colour_groups(np.arange(100), new, max_len=64),
+    ):
+        assert max(len(cmd) for cmd in cmds) <= 64
@@ -0,0 +1,54 @@
+import numpy as np
+from display1593 import Display1593, RED
+from frame_recorder import FrameRecorder, Recording
+from led_emulator import EmulatorPorts
+
+NUMBER_OF_LEDS = {'TEENSY1': 30, 'TEENSY2': 20}
+
+
+def test_record_and_replay(tmp_path):
+    path = tmp_path / 'show.rec'
+    rng = np.random.default_rng(0)
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    with FrameRecorder(path) as recorder, Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        serial_factory=ports,
+        recorder=recorder
+    ) as dis:
+        dis.set_all_leds_one_colour(RED)
+        for _ in range(3):
+            frame = rng.integers(0, 256, (50, 3), dtype=np.uint8)
+            dis.submit_frame(frame)
+            dis.show_now()
+        dis.request(0, b'GT')
+        n_commands = recorder.n_commands
+
+    replay_ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    with Recording(path) as recording, Display1593(
+        ports=replay_ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        serial_factory=replay_ports
+    ) as dis:
+        assert len(recording) == n_commands
+        assert bytes(recording.command(0)) == b'CA' + bytes(RED)
+        assert recording.flags[-1] == 1 and recording.boards[-1] == 0
+        result = recording.replay(dis, speed=None)
+    assert result['n_commands'] == n_commands
+    for board in replay_ports.boards.values():
+        assert board.n_shows == 3
+    shown = [board.shown for board in replay_ports.boards.values()]
+    assert np.array_equal(np.concatenate(shown), frame)
+
+
+def test_truncated_recording(tmp_path):
+    path = tmp_path / 'show.rec'
+    with FrameRecorder(path) as recorder:
+        recorder.write(0, b'SN', t=1.0)
+        recorder.write(1, b'SN', t=2.0)
+    with open(path, 'ab') as f:
+        f.write(b'\x00' * 5)
+    with Recording(path) as recording:
+        assert len(recording) == 2
+        assert list(recording.boards) == [0, 1]
+        assert recording.duration == 1.0
@@ -0,0 +1,94 @@
+import numpy as np
+from display1593 import Display1593
+from frame_scheduler import FrameScheduler
+from led_emulator import EmulatorPorts
+
+NUMBER_OF_LEDS = {'TEENSY1': 30, 'TEENSY2': 20}
+
+
+class FakeClock():
+    """Timer for the scheduler that only advances when it sleeps, by a
+    microsecond per reading and by the modelled time of the writes to the
+    emulated ports, so that the tests don't depend on the host."""
+
+    def __init__(self, bytes_per_second=None):
+        self.bytes_per_second = bytes_per_second
+        self.t = 0.0
+
+    def __call__(self):
+        self.t += 1e-6
+        return self.t
+
+    def sleep(self, seconds):
+        self.t += seconds
+
+    def serial_factory(self, ports):
+        def open_port(port, **kwargs):
+            ser = ports(port, **kwargs)
+            write = ser.write
+
+            def timed_write(data):
+                if self.bytes_per_second is not None:
+                    self.t += len(data) / self.bytes_per_second
+                return write(data)
+            ser.write = timed_write
+            return ser
+        return open_port
+
+
+def make_display(clock):
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    dis = Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        max_in_flight=4,
+        serial_factory=clock.serial_factory(ports)
+    )
+    return dis, list(ports.boards.values())
+
+
+def make_scheduler(dis, clock, fps, **kwargs):
+    return FrameScheduler(
+        dis, fps, spin_time=0, timer=clock, sleep=clock.sleep, **kwargs
+    )
+
+
+def test_scheduler_keeps_frame_rate():
+    frames = np.random.default_rng(0).integers(
+        0, 256, (20, 50, 3), dtype=np.uint8
+    )
+    clock = FakeClock()
+    dis, boards = make_display(clock)
+    with dis:
+        stats = make_scheduler(dis, clock, fps=100).run(frames)
+        dis.flush()
+    assert stats['n_sent'] == 20 and stats['n_dropped'] == 0
+    assert np.isclose(stats['fps'], 100, rtol=1e-3)
+    assert stats['jitter'] < 1e-5
+    assert np.array_equal(boards[0].shown, frames[-1, :30])
+
+
+def test_scheduler_drops_late_frames():
+    frames = np.random.default_rng(0).integers(
+        0, 256, (20, 50, 3), dtype=np.uint8
+    )
+    # Commands of ~100 bytes at 10 kB/s take ~10 ms per frame
+    clock = FakeClock(bytes_per_second=10000)
+    dis, boards = make_display(clock)
+    with dis:
+        scheduler = make_scheduler(dis, clock, fps=200, diff=True)
+        stats = scheduler.run(iter(frames))
+        dis.flush()
+        assert stats['n_dropped'] > 0
+        assert stats['n_sent'] + stats['n_dropped'] == 20
+        assert dis.metrics.snapshot()['counters']['frames.dropped'] == (
+            stats['n_dropped']
+        )
+        # The last frame is sent even though it is late
+        shown = np.concatenate([board.shown for board in boards])
+        assert np.array_equal(shown, frames[-1])
+
+        stats = make_scheduler(dis, clock, fps=200, policy='delay').run(frames)
+        dis.flush()
+    assert stats['n_sent'] == 20 and stats['n_dropped'] == 0
+    assert np.array_equal(boards[1].shown, frames[-1, 30:])
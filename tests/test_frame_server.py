@@ -0,0 +1,138 @@
+import time
+import socket
+import pytest
+import numpy as np
+from display1593 import Display1593, RED, BLUE
+from led_emulator import EmulatorPorts
+from frame_server import FrameServer, FrameClient
+
+NUMBER_OF_LEDS = {'TEENSY1': 30, 'TEENSY2': 20}
+
+
+def wait_until(condition, timeout=5.0):
+    t_end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < t_end, "timed out"
+        time.sleep(0.01)
+
+
+def test_clients_layers_by_priority(tmp_path):
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    boards = list(ports.boards.values())
+
+    def shown():
+        return np.concatenate([board.shown for board in boards])
+
+    address = str(tmp_path / 'display.sock')
+    with Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        max_in_flight=4,
+        serial_factory=ports
+    ) as dis, FrameServer(dis, address, fps=100):
+        background = FrameClient(address, priority=0)
+        overlay = FrameClient(address, priority=1)
+        assert background.info() == {
+            'board_names': ['TEENSY1', 'TEENSY2'],
+            'leds_per_board': [30, 20],
+            'n_leds': 50,
+        }
+        overlay.set_leds([0, 1, 45], np.array([BLUE] * 3))
+        # Only the latest frame from a client matters
+        for colour in ((1, 2, 3), RED):
+            background.send_frame(np.tile(colour, (50, 1)))
+        expected = np.tile(RED, (50, 1))
+        expected[[0, 1, 45]] = BLUE
+        wait_until(lambda: np.array_equal(shown(), expected))
+
+        overlay.close()
+        wait_until(lambda: np.all(shown() == RED))
+
+        background.send_command(1, b'LB\x03')
+        wait_until(lambda: boards[1].brightness == 3)
+        background.clear()
+        wait_until(lambda: np.all(shown() == 0))
+        background.close()
+        assert dis.metrics.counters['server.frames'] >= 3
+
+
+def test_loopback_tcp_and_bad_client():
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    with Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        io_threads=True,
+        serial_factory=ports
+    ) as dis, FrameServer(dis, ('127.0.0.1', 0)) as server:
+        # A malformed frame only drops that client
+        with FrameClient(server.address) as bad:
+            bad.send_frame(np.zeros((49, 3), dtype=np.uint8))
+            assert bad._sock.recv(1) == b''
+        with FrameClient(server.address) as client:
+            client.set_leds([49], np.array([RED]))
+            board = ports.boards['emulator1']
+            wait_until(lambda: np.all(board.shown[19] == RED))
+
+
+def test_socket_path_in_use(tmp_path):
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    with Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        serial_factory=ports
+    ) as dis:
+        not_socket = tmp_path / 'file'
+        not_socket.write_bytes(b'keep')
+        with pytest.raises(FileExistsError):
+            FrameServer(dis, str(not_socket)).start()
+        assert not_socket.read_bytes() == b'keep'
+
+        # Socket file of a server that is gone
+        address = str(tmp_path / 'display.sock')
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(address)
+        stale.close()
+        with FrameServer(dis, address):
+            with pytest.raises(FileExistsError):
+                FrameServer(dis, address).start()
+            with FrameClient(address) as client:
+                assert client.info()['n_leds'] == 50
+
+
+def test_send_failures_counted():
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    with Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        serial_factory=ports
+    ) as dis, FrameServer(dis, ('127.0.0.1', 0)) as server:
+        def send_command(board, cmd, reply=False):
+            raise OSError("port gone")
+        dis.send_command = send_command
+        with FrameClient(server.address) as client:
+            client.send_command(0, b'LB\x03')
+            wait_until(
+                lambda: dis.metrics.counters.get('server.send_failures') == 1
+            )
+
+
+def test_raw_commands_resend_frame():
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    boards = list(ports.boards.values())
+    with Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        serial_factory=ports
+    ) as dis, FrameServer(dis, ('127.0.0.1', 0)) as server:
+        with FrameClient(server.address) as a, \
+                FrameClient(server.address) as b:
+            b.send_frame(np.tile(RED, (50, 1)))
+            wait_until(lambda: np.all(boards[0].shown == RED))
+            b.send_command(0, b'LC')
+            b.send_command(0, b'SN')
+            wait_until(lambda: np.all(boards[0].shown == 0))
+            # The board no longer holds the frame last sent to it, so the
+            # next frame is sent in full rather than as changes
+            a.set_leds([0], np.array([BLUE]))
+            wait_until(lambda: np.all(boards[0].shown[1:] == RED))
+            assert np.all(boards[0].shown[0] == BLUE)
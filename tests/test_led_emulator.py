@@ -0,0 +1,379 @@
+import asyncio
+import pytest
+import numpy as np
+from serial_comm.serial_comm import PreparedCommand
+from display1593 import (
+    Display1593, ResponseError, RED, BLUE, MAX_RECOVERIES
+)
+from async_display1593 import AsyncDisplay1593
+from led_emulator import EmulatorPorts, EmulatedBoard, PtyEmulator
+
+NUMBER_OF_LEDS = {'TEENSY1': 30, 'TEENSY2': 20}
+
+
+def check_display(dis, boards):
+    dis.clear_all()
+    dis.clear_all()
+    dis.set_led(1, RED)
+    dis.set_leds([0, 29, 30, 49], np.array([BLUE] * 4))
+    frame = np.zeros((50, 3), dtype=np.uint8)
+    frame[[0, 29, 30, 49]] = BLUE
+    frame[1] = RED
+    frame[40:45] = (255, 254, 253)
+    dis.submit_frame(frame)
+    show = PreparedCommand(b'SN')
+    futures = [dis.send_command(board, show) for board in range(2)]
+    dis.flush()
+    assert all(future.result() is not None for future in futures)
+    assert np.array_equal(boards[0].shown, frame[:30])
+    assert np.array_equal(boards[1].shown, frame[30:])
+    counters = dis.metrics.snapshot()['counters']
+    assert counters['commands'] == dis.metrics.events().shape[0]
+    assert counters['commands.SN'] == 2
+    assert counters['escape_bytes'] > 0
+    assert not np.isnan(dis.metrics.events()['ack_wait']).any()
+    # LC is framed once and L1 once
+    assert (dis.command_cache.misses, dis.command_cache.hits) == (2, 1)
+
+
+def test_display_with_emulator():
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    # Connect in the opposite order to the board names
+    with Display1593(
+        ports=ports.names[::-1],
+        number_of_leds=NUMBER_OF_LEDS,
+        max_in_flight=4,
+        serial_factory=ports
+    ) as dis:
+        check_display(dis, list(ports.boards.values()))
+
+
+def test_threaded_display_with_emulator():
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS, latency=0.001)
+    with Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        io_threads=True,
+        serial_factory=ports
+    ) as dis:
+        check_display(dis, list(ports.boards.values()))
+
+
+def test_async_display_with_pty_emulator():
+    boards = [EmulatedBoard(name, n) for name, n in NUMBER_OF_LEDS.items()]
+    emulators = [PtyEmulator(board) for board in boards]
+
+    async def run():
+        async with AsyncDisplay1593(
+            ports=[emulator.port for emulator in emulators],
+            number_of_leds=NUMBER_OF_LEDS
+        ) as dis:
+            await dis.set_all_leds_one_colour(RED)
+            await dis.show_now()
+            await dis.flush()
+            return dis.metrics.events()
+
+    try:
+        events = asyncio.run(run())
+    finally:
+        for emulator in emulators:
+            emulator.close()
+    assert np.all(boards[0].shown == RED) and np.all(boards[1].shown == RED)
+    assert list(events['command']) == [b'CA', b'CA', b'SN', b'SN']
+    assert not np.isnan(events['ack_wait']).any()
+
+
+def test_play_frames_from_files(tmp_path):
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 256, (4, 50, 3), dtype=np.uint8)
+    np.save(tmp_path / 'show.npy', frames)
+    frames.tofile(tmp_path / 'show.raw')
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    boards = list(ports.boards.values())
+    with Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        max_in_flight=2,
+        serial_factory=ports
+    ) as dis:
+        assert dis.play(tmp_path / 'show.npy') == 4
+        dis.flush()
+        assert np.array_equal(boards[1].shown, frames[-1, 30:])
+        assert len(dis._la_pools[0]) <= 3
+        dis.play(tmp_path / 'show.raw', fps=200, diff=True)
+        dis.flush()
+        assert boards[0].n_shows == 8
+        assert np.array_equal(dis._shadow, frames[-1])
+
+
+def test_recover_lost_ack():
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    board = ports.boards['emulator0']
+    handle = board.handle
+    dropped = []
+
+    def drop_first_ack(cmd):
+        replies = handle(cmd)
+        if not dropped:
+            dropped.append(bytes(cmd))
+            return []
+        return replies
+
+    with Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        timeout=0.2,
+        serial_factory=ports
+    ) as dis:
+        board.handle = drop_first_ack
+        dis.set_all_leds_one_colour(RED)
+        dis.show_now()
+        dis.flush()
+        snapshot = dis.metrics.snapshot()
+    assert dropped == [b'CA' + bytes(RED)]
+    assert np.all(board.shown == RED)
+    assert snapshot['counters']['recoveries'] == 1
+    assert snapshot['histograms']['recovery']['count'] == 1
+    assert snapshot['histograms']['recovery']['max'] < 0.2
+
+
+@pytest.mark.parametrize('io_threads', [False, True])
+def test_corrupt_debug_message(io_threads):
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    board = ports.boards['emulator0']
+    handle = board.handle
+
+    def debug_then_ack(cmd):
+        return [b'\x00\x00\xff\xfe not utf-8'] + handle(cmd)
+
+    with Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        io_threads=io_threads,
+        serial_factory=ports
+    ) as dis:
+        board.handle = debug_then_ack
+        dis.set_led(0, RED)
+        dis.set_led(1, BLUE)
+        dis.show_now()
+        dis.flush()
+    assert np.all(board.shown[0] == RED) and np.all(board.shown[1] == BLUE)
+
+
+@pytest.mark.parametrize('io_threads', [False, True])
+def test_resend_on_bad_ack(io_threads):
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    board = ports.boards['emulator0']
+    handle = board.handle
+    corrupted = []
+
+    def corrupt_acks(cmd):
+        replies = handle(cmd)
+        if bytes(cmd[:2]) in (b'CA', b'L1') and len(corrupted) < limit:
+            corrupted.append(bytes(cmd))
+            replies[-1] = replies[-1][:-1] + b'\x00'
+        return replies
+
+    with Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        max_in_flight=4,
+        io_threads=io_threads,
+        serial_factory=ports
+    ) as dis:
+        board.handle = corrupt_acks
+        # A corrupted ack gets the command sent again
+        limit = 1
+        future = dis.send_command(0, b'CA' + bytes(RED))
+        dis.show_now()
+        dis.flush()
+        assert future.result() is not None
+        assert np.all(board.shown == RED)
+        assert dis.metrics.counters['recoveries'] == 1
+        # Until max_recoveries attempts have failed
+        limit = 10
+        future = dis.send_command(0, b'L1\x00\x01' + bytes(BLUE))
+        dis.flush()
+        with pytest.raises(ResponseError):
+            future.result()
+        assert dis.metrics.counters['recoveries.failed'] == 1
+        assert len(corrupted) == 1 + 1 + MAX_RECOVERIES
+        limit = 0
+        dis.set_all_leds_one_colour(BLUE)
+        dis.show_now()
+        dis.flush()
+    assert np.all(board.shown == BLUE)
+
+
+@pytest.mark.parametrize('io_threads', [False, True])
+def test_recover_unplugged_board(io_threads):
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    boards = list(ports.boards.values())
+    frame = np.random.default_rng(0).integers(0, 256, (50, 3), dtype=np.uint8)
+    with Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        max_in_flight=2,
+        io_threads=io_threads,
+        serial_factory=ports
+    ) as dis:
+        dis.set_all_leds(frame)
+        dis.flush()
+        # Unplug the first board, which loses its LED state
+        old_ser = dis._connections[0].ser
+        old_ser.close()
+        boards[0].leds[:] = 0
+        dis.set_led(1, RED)
+        dis.show_now()
+        dis.flush()
+        assert dis._connections[0].ser is not old_ser
+        assert dis.metrics.counters['recoveries'] == 1
+    frame[1] = RED
+    assert np.array_equal(boards[0].shown, frame[:30])
+    assert np.array_equal(boards[1].shown, frame[30:])
+
+
+def test_disconnect_closes_all_ports():
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    unplugged = []
+
+    def serial_factory(port, **kwargs):
+        if port in unplugged:
+            raise OSError(f'{port} not found')
+        return ports(port, **kwargs)
+
+    dis = Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        max_in_flight=2,
+        serial_factory=serial_factory
+    )
+    dis.connect()
+    sers = [conn.ser for conn in dis._connections]
+    dis.send_command(0, b'LC')
+    # The first board is unplugged before its ack is read
+    unplugged.append(sers[0].port)
+    sers[0].close()
+    with pytest.raises(ConnectionError):
+        dis.disconnect()
+    assert dis._connections == []
+    assert not any(ser.is_open for ser in sers)
+
+
+def test_commands_split_to_max_packet_len():
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    boards = list(ports.boards.values())
+    lengths = {board.name: [] for board in boards}
+    for board in boards:
+        def handle(cmd, handle=board.handle, lengths=lengths[board.name]):
+            lengths.append(len(cmd))
+            return handle(cmd)
+        board.handle = handle
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, (50, 3), dtype=np.uint8)
+    with Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        max_in_flight=4,
+        serial_factory=ports,
+        max_packet_len={'TEENSY1': 40}
+    ) as dis:
+        assert dis.max_packet_len.tolist() == [40, 8192]
+        dis.set_all_leds(frame)
+        dis.set_leds_one_colour(np.arange(25), RED)
+        frame[:25] = RED
+        leds = np.arange(10, 40)
+        dis.set_leds(leds, frame[leds[::-1]])
+        frame[leds] = frame[leds[::-1]]
+        dis.show_now()
+        dis.flush()
+        assert np.array_equal(boards[0].shown, frame[:30])
+        assert np.array_equal(boards[1].shown, frame[30:])
+        frame = rng.integers(0, 256, (50, 3), dtype=np.uint8)
+        dis.submit_frame(frame)
+        dis.show_now()
+        dis.flush()
+    assert np.array_equal(boards[0].shown, frame[:30])
+    assert max(lengths['TEENSY1']) <= 40
+    assert max(lengths['TEENSY2']) > 40
+
+
+def test_async_recover_closed_pty():
+    boards = [EmulatedBoard(name, n) for name, n in NUMBER_OF_LEDS.items()]
+    emulators = [PtyEmulator(board) for board in boards]
+    frame = np.random.default_rng(0).integers(0, 256, (50, 3), dtype=np.uint8)
+
+    async def run():
+        async with AsyncDisplay1593(
+            ports=[emulator.port for emulator in emulators],
+            number_of_leds=NUMBER_OF_LEDS
+        ) as dis:
+            await dis.set_all_leds(frame)
+            await dis.flush()
+            # The first board comes back on another port, without its LEDs
+            emulators.append(PtyEmulator(boards[0]))
+            port = emulators[-1].port
+            conn = dis._connections[0]
+            conn.reopen = lambda: dis._open_port(port)
+            emulators[0].close()
+            boards[0].leds[:] = 0
+            await dis.set_led(1, RED)
+            await dis.show_now()
+            await dis.flush()
+            assert dis.metrics.counters['recoveries'] == 1
+
+            # The second board never comes back
+            conn = dis._connections[1]
+            emulators[1].close()
+            future = await dis.send_command(1, b'SN')
+            with pytest.raises(ConnectionError):
+                await asyncio.wait_for(future, 1)
+            # Its port is no longer polled
+            assert not asyncio.get_running_loop().remove_reader(conn._fd)
+            assert dis.metrics.counters['recoveries.failed'] == 1
+
+    try:
+        asyncio.run(run())
+    finally:
+        for emulator in emulators:
+            if emulator._thread.is_alive():
+                emulator.close()
+    frame[1] = RED
+    assert np.array_equal(boards[0].shown, frame[:30])
+
+
+def test_async_resend_on_bad_ack():
+    boards = [EmulatedBoard(name, n) for name, n in NUMBER_OF_LEDS.items()]
+    handle = boards[0].handle
+    corrupted = []
+
+    def corrupt_first_ack(cmd):
+        replies = handle(cmd)
+        if bytes(cmd[:2]) == b'CA' and not corrupted:
+            corrupted.append(bytes(cmd))
+            replies[-1] = replies[-1][:-1] + b'\x00'
+        return replies
+
+    boards[0].handle = corrupt_first_ack
+    emulators = [PtyEmulator(board) for board in boards]
+
+    async def run():
+        async with AsyncDisplay1593(
+            ports=[emulator.port for emulator in emulators],
+            number_of_leds=NUMBER_OF_LEDS,
+            max_in_flight=4
+        ) as dis:
+            await dis.set_all_leds_one_colour(RED)
+            await dis.set_led(0, BLUE)
+            await dis.show_now()
+            await dis.flush()
+            return dis.metrics.counters['recoveries']
+
+    try:
+        recoveries = asyncio.run(run())
+    finally:
+        for emulator in emulators:
+            emulator.close()
+    assert corrupted and recoveries == 1
+    assert np.all(boards[0].shown[0] == BLUE)
+    assert np.all(boards[0].shown[1:] == RED)
@@ -0,0 +1,107 @@
+import numpy as np
+from display1593 import Display1593
+from led_emulator import EmulatorPorts
+from link_profiler import (
+    fit_link_model, profile_display, command_overhead, save_profile,
+    load_profile
+)
+
+NUMBER_OF_LEDS = {'TEENSY1': 300, 'TEENSY2': 200}
+
+
+def test_fit_link_model():
+    wire_bytes = np.array([100, 1000, 5000])
+    latency, bytes_per_second = fit_link_model(
+        wire_bytes, 0.002 + wire_bytes / 50000
+    )
+    assert np.isclose(latency, 0.002)
+    assert np.isclose(bytes_per_second, 50000)
+
+
+class LinkClock():
+    """Fake timer advanced by the modelled time of each write to the
+    emulated ports, so that profiling doesn't depend on the host."""
+
+    def __init__(self, ports, latency, bytes_per_second):
+        self.ports = ports
+        self.latency = latency
+        self.bytes_per_second = bytes_per_second
+        self.t = 0.0
+
+    def __call__(self):
+        return self.t
+
+    def open(self, port, **kwargs):
+        ser = self.ports(port, **kwargs)
+        write = ser.write
+
+        def timed_write(data):
+            self.t += self.latency + len(data) / self.bytes_per_second
+            return write(data)
+        ser.write = timed_write
+        return ser
+
+
+def test_profile_emulated_links(tmp_path):
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    clock = LinkClock(ports, latency=0.002, bytes_per_second=200000)
+    with Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        serial_factory=clock.open,
+        max_packet_len={'TEENSY2': 1024}
+    ) as dis:
+        links = profile_display(
+            dis, sizes=(64, 512, 1500), escape_densities=(0.0, 0.5),
+            depths=(1, 4), n_commands=5, timer=clock
+        )
+        assert [conn.max_in_flight for conn in dis._connections] == [
+            dis.max_in_flight
+        ] * 2
+        path = str(tmp_path / 'links.json')
+        save_profile(links, path)
+        dis.apply_link_profile(load_profile(path))
+        assert dis.max_packet_len.tolist() == [8192, 1024]
+        assert np.all(dis.command_overhead > 0)
+        assert not dis._shadow_valid.any()
+        frame = np.full((dis.n_leds, 3), 7, dtype=np.uint8)
+        dis.submit_frame(frame)
+        dis.show_now()
+        dis.flush()
+    boards = list(ports.boards.values())
+    assert np.all(boards[0].shown == 7) and np.all(boards[1].shown == 7)
+    for name, link in links.items():
+        assert np.isclose(link['latency'], 0.002)
+        assert np.isclose(link['bytes_per_second'], 200000)
+        assert command_overhead(link) == 400
+        assert command_overhead(link, 4) == 100
+    assert {s['size'] for s in links['TEENSY2']['samples']} == {64, 509}
+    samples = links['TEENSY1']['samples']
+    assert len(samples) == 3 * 2 * 2
+    assert max(s['escape_density'] for s in samples) == 0.5
+
+
+def test_link_profile_keeps_full_frames_whole():
+    ports = EmulatorPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    frame = np.random.default_rng(0).integers(
+        0, 256, (500, 3), dtype=np.uint8
+    )
+    # A slow link, about 57600 baud
+    link = {'latency': 0.005, 'bytes_per_second': 5760.0}
+
+    def wire_bytes(dis):
+        counters = dis.metrics.counters
+        before = counters['bytes'], counters['commands']
+        dis.set_all_leds(frame)
+        dis.flush()
+        return counters['bytes'] - before[0], counters['commands'] - before[1]
+
+    with Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        serial_factory=ports
+    ) as dis:
+        unprofiled = wire_bytes(dis)
+        dis.apply_link_profile({name: link for name in dis.board_names})
+        assert wire_bytes(dis) == unprofiled
+    assert unprofiled[1] == 2
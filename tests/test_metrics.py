@@ -0,0 +1,47 @@
+import json
+import numpy as np
+from metrics import MetricsRegistry, Histogram
+
+
+def test_histogram_quantiles():
+    hist = Histogram()
+    for value in np.linspace(1e-3, 1e-2, 100):
+        hist.observe(value)
+    summary = hist.summary()
+    assert summary['count'] == 100
+    assert summary['min'] == 1e-3 and summary['max'] == 1e-2
+    # Quantiles are bucket edges, accurate to a bucket width (~26%)
+    assert 5.5e-3 / 1.3 < summary['p50'] < 5.5e-3 * 1.3
+    assert Histogram().summary() == {'count': 0}
+
+
+def test_registry_ring_buffer(tmp_path):
+    metrics = MetricsRegistry(ring_size=4)
+    for i in range(6):
+        seq = metrics.record_command(
+            float(i), i % 2, np.frombuffer(b'L1abc', np.uint8),
+            7 + i, i, 1e-6, 2e-6, 3e-6
+        )
+        assert seq == i
+    metrics.record_ack(5, b'L1', 0.01)
+    metrics.record_ack(0, b'L1', 0.02)  # Overwritten in the ring buffer
+    events = metrics.events()
+    assert list(events['seq']) == [2, 3, 4, 5]
+    assert list(events['n_bytes']) == [9, 10, 11, 12]
+    assert np.isnan(events['ack_wait'][:3]).all()
+    assert np.isclose(events['ack_wait'][3], 0.01)
+
+    metrics.count('calls.set_led')
+    snapshot = metrics.snapshot()
+    assert snapshot['counters']['commands.L1'] == 6
+    assert snapshot['counters']['escape_bytes'] == 15
+    assert snapshot['counters']['calls.set_led'] == 1
+    assert snapshot['histograms']['L1.ack_wait']['count'] == 2
+    assert snapshot['events']['command'] == ['L1'] * 4
+
+    metrics.export_json(tmp_path / 'metrics.json')
+    with open(tmp_path / 'metrics.json') as f:
+        assert json.load(f)['counters']['bytes'] == sum(range(7, 13))
+
+    metrics.reset()
+    assert metrics.events().shape == (0,)
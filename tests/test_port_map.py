@@ -0,0 +1,67 @@
+import time
+import pytest
+import display1593
+from display1593 import Display1593, RED
+from led_emulator import EmulatorPorts
+from port_map import PortMap
+
+NUMBER_OF_LEDS = {'TEENSY1': 30, 'TEENSY2': 20}
+
+
+class SlowPorts(EmulatorPorts):
+    """Emulated ports that take open_time to open."""
+
+    open_time = 0.2
+
+    def __call__(self, port, **kwargs):
+        time.sleep(self.open_time)
+        return super().__call__(port, **kwargs)
+
+
+def test_parallel_connect_and_port_map(tmp_path, monkeypatch):
+    ports = SlowPorts.from_number_of_leds(NUMBER_OF_LEDS)
+    serial_numbers = {'emulator0': 'SN0', 'emulator1': 'SN1'}
+    port_map = PortMap(
+        str(tmp_path / 'ports.json'),
+        list_ports=lambda: list(serial_numbers.items())
+    )
+    dis = Display1593(
+        ports=ports.names,
+        number_of_leds=NUMBER_OF_LEDS,
+        serial_factory=ports,
+        port_map=port_map
+    )
+    t0 = time.perf_counter()
+    dis.connect()
+    # Ports are opened and handshaken concurrently
+    assert time.perf_counter() - t0 < 2 * SlowPorts.open_time
+    dis.disconnect()
+    assert PortMap(port_map.path).boards == {
+        'SN0': 'TEENSY1', 'SN1': 'TEENSY2'
+    }
+
+    # Boards known by serial number are opened without a handshake, on
+    # whichever devices they now appear
+    def no_handshake(*args, **kwargs):
+        raise AssertionError("handshake not expected")
+
+    monkeypatch.setattr(display1593, 'connect_to_arduino', no_handshake)
+    serial_numbers.clear()
+    serial_numbers.update({'emulator0': 'SN1', 'emulator1': 'SN0'})
+    ports.boards = dict(zip(ports.names, list(ports.boards.values())[::-1]))
+    with dis:
+        assert [conn.port for conn in dis._connections] == [
+            'emulator1', 'emulator0'
+        ]
+        dis.set_led(0, RED)
+        dis.show_now()
+    assert (ports.boards['emulator1'].shown[0] == RED).all()
+
+    # A board missing from the map means a full handshake
+    del port_map.boards['SN1']
+    with pytest.raises(AssertionError, match='handshake'):
+        dis.connect()
+    monkeypatch.undo()
+    with dis:
+        pass
+    assert port_map.boards == {'SN0': 'TEENSY1', 'SN1': 'TEENSY2'}
@@ -1,5 +1,10 @@
 import numpy as np
-from serial_comm.serial_comm import encode_data, decode_bytes
+import pytest
+from serial_comm.serial_comm import (
+    encode_data, decode_data, decode_bytes, encode_bytes, encode_into,
+    encoded_len, FrameBuffer, FrameParser, PreparedCommand, CommandCache,
+    build_frame, START_MARKER, END_MARKER
+)
 
 
 def test_serial_comm():
@@ -7,3 +12,115 @@ def test_serial_comm():
     encoded_data = encode_data(data)
     decoded_data = decode_bytes(encoded_data)
     assert np.array_equal(decoded_data, data)
+
+
+def test_encode_decode_buffer_types():
+    data = bytes([1, 253, 2, 254, 255, 0])
+    expected = [1, 253, 0, 2, 253, 1, 253, 2, 0]
+    for x in [data, bytearray(data), memoryview(data),
+              np.frombuffer(data, dtype=np.uint8)]:
+        assert np.array_equal(encode_data(x), expected)
+        assert encode_bytes(x) == bytearray(expected)
+    assert decode_bytes(bytes(expected)) == data
+    assert np.array_equal(decode_data(memoryview(bytes(expected))), list(data))
+    with pytest.raises(ValueError):
+        decode_data(bytes([1, 253]))
+
+
+def test_encode_into():
+    data = np.arange(240, 256, dtype=np.uint8)
+    buf = bytearray(64)
+    n = encode_into(buf, data)
+    assert n == encoded_len(data) == 16 + 3
+    assert np.array_equal(decode_data(buf[:n]), data)
+    with pytest.raises(ValueError):
+        encode_into(bytearray(16), data)
+    out = np.zeros(64, dtype=np.uint8)
+    assert encode_into(memoryview(out)[8:], data) == n
+    assert np.array_equal(out[8:8 + n], np.frombuffer(buf[:n], np.uint8))
+    # Buffers that would have to be copied are rejected
+    for dst, error in (
+        (bytes(64), ValueError),
+        (np.zeros(64, dtype=np.uint8)[::2], ValueError),
+        (memoryview(bytearray(128))[::2], ValueError),
+        (np.zeros(64, dtype=np.int32), TypeError),
+        (memoryview(np.zeros(64, dtype=np.int32)), TypeError),
+        ([0] * 64, TypeError),
+    ):
+        with pytest.raises(error):
+            encode_into(dst, data)
+
+
+def test_frame_buffer():
+    fb = FrameBuffer(size=4)
+    frame = fb.build(np.array([1, 254, 2], dtype=np.uint8))
+    assert bytes(frame) == bytes([START_MARKER, 1, 253, 1, 2, END_MARKER])
+    assert bytes(frame) == build_frame(b'\x01\xfe\x02')
+    frame = fb.build(b'SN')
+    assert bytes(frame) == bytes([START_MARKER]) + b'SN' + bytes([END_MARKER])
+
+
+def test_prepared_command():
+    data = bytes([76, 65]) + bytes(range(256)) * 4
+    cmd = PreparedCommand(data)
+    assert cmd.wire == build_frame(data)
+    total = sum(data)
+    assert bytes(cmd.ack) == len(data).to_bytes(2, 'big') + total.to_bytes(
+        4, 'big'
+    )
+    assert len(cmd) == len(data) and bytes(cmd.data) == data
+    frame, ack = FrameBuffer(size=4).build_ack(data)
+    assert bytes(frame) == cmd.wire and np.array_equal(ack, cmd.ack)
+
+
+def test_command_cache():
+    cache = CommandCache(maxsize=2, max_len=8)
+    sn = cache.get(b'SN')
+    assert cache.get(np.array([83, 78], dtype=np.uint8)) is sn
+    cache.get(b'LC')
+    cache.get(b'SN')
+    cache.get(b'CA\x01\x02\x03')  # Evicts LC, the least recently used
+    assert b'SN' in cache and b'LC' not in cache
+    long_cmd = cache.get(bytes(9))
+    assert long_cmd.wire == build_frame(bytes(9)) and len(cache) == 2
+    assert (cache.hits, cache.misses) == (2, 4)
+
+
+def test_frame_parser():
+    parser = FrameParser()
+    stream = (
+        b'junk' + build_frame(b'\x00\x06\x00\x00\x00\xfe')
+        + build_frame(b'SN') + bytes([START_MARKER]) + b'partial'
+        + build_frame(b'LC')[:2]
+    )
+    packets = []
+    for i in range(0, len(stream), 3):
+        packets.extend(parser.feed(stream[i:i + 3]))
+    packets.extend(parser.feed(build_frame(b'LC')[2:]))
+    assert [bytes(p) for p in packets] == [
+        b'\x00\x06\x00\x00\x00\xfe', b'SN', b'LC'
+    ]
+    assert parser.n_resyncs == 1
+
+
+def test_numpy_kernels_match_numba_kernels():
+    from serial_comm import _kernels
+    rng = np.random.default_rng(0)
+    src = rng.integers(0, 256, 1000).astype(np.uint8)
+    n = _kernels.encoded_len_numpy(src)
+    assert n == encoded_len(src)
+    dst = np.zeros(n + 2, dtype=np.uint8)
+    assert _kernels.encode_frame_numpy(dst, src) == n + 2
+    assert bytes(dst) == build_frame(src)
+    encoded = dst[1:-1]
+    assert _kernels.decoded_len_numpy(encoded) == len(src)
+    out = np.zeros(len(src), dtype=np.uint8)
+    assert _kernels.decode_numpy(out, encoded) == len(src)
+    assert np.array_equal(out, src)
+    ack = np.zeros(6, dtype=np.uint8)
+    dst[:] = 0
+    assert _kernels.encode_frame_ack_numpy(dst, ack, src) == n + 2
+    assert bytes(dst) == build_frame(src)
+    assert np.array_equal(ack, PreparedCommand(src).ack)
+    unpaired = np.array([1, 253], dtype=np.uint8)
+    assert _kernels.decoded_len_numpy(unpaired) == -1